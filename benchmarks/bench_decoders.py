@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Compare the speed of the available JSON decoder backends.
+
+Usage::
+
+    python benchmarks/bench_decoders.py [recording]
+
+``recording`` is a file of newline delimited messages as received from the
+streaming API, e.g. captured with ``parse_json=False, decode_unicode=False``
+and written one message per line. Without it a synthetic stream built from
+varied copies of a real tweet is used.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from tweetstream.decoders import decoders
+
+
+def synthetic_messages(count=20000):
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(here, '..', 'tests'))
+    from test_tweetstream import single_tweet
+    tweet = json.loads(single_tweet)
+    messages = []
+    for n in range(count):
+        tweet['id'] = tweet['id'] + 1
+        tweet['text'] = tweet['text'][:(n % 140) + 1]
+        messages.append(json.dumps(tweet).encode('utf-8'))
+    return messages
+
+
+def recorded_messages(path):
+    with open(path, 'rb') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def bench(decoder, messages, repeat=3):
+    best = None
+    for n in range(repeat):
+        start = time.time()
+        for message in messages:
+            decoder(message)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv):
+    if len(argv) > 1:
+        messages = recorded_messages(argv[1])
+    else:
+        messages = synthetic_messages()
+    size = sum(len(m) for m in messages)
+    print("%d messages, %.1f MB" % (len(messages), size / 1e6))
+    for name, decoder in decoders:
+        elapsed = bench(decoder, messages)
+        print("%-10s %10.0f msgs/s %8.1f MB/s" % (
+            name, len(messages) / elapsed, size / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""Benchmark SampleStream and FilterStream against a synthetic firehose.
+
+Usage::
+
+    python benchmarks/bench_stream.py [--count N] [--repeat R] [--quick]
+        [--json results.json] [--baseline old.json] [--tolerance 0.25]
+
+Every combination of stream class, framing (newline or ``delimited=length``),
+processing mode (raw bytes, decoded text, parsed JSON) and transport is run
+against a local :class:`servercontext.FirehoseServer`, which sends messages
+of varied sizes cut into irregular chunks, with delimiters split between
+chunks and keep-alives mixed in. For each one the suite measures:
+
+* throughput, reading ``count`` messages as fast as possible, best of
+  ``--repeat`` runs
+* latency from the server sending a message to the iterator returning it,
+  at a steady rate of :data:`LATENCY_RATE` messages a second
+* peak memory allocated while reading, traced with :mod:`tracemalloc`
+
+and finally the throughput of a :class:`~tweetstream.ResilientStream` over
+a server that drops the connection every :data:`DISCONNECT_EVERY` messages.
+
+``--json`` writes the results to a file. ``--baseline`` compares them with
+an earlier results file and exits with status 1 if any throughput dropped,
+or latency or memory grew, by more than ``--tolerance``.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+from itertools import product
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', 'tests'))
+
+from tweetstream import SampleStream, FilterStream, ResilientStream
+from tweetstream import ConnectionError
+from servercontext import firehose_server
+from test_tweetstream import single_tweet
+
+#: Chunk sizes cycled through by the server in the throughput runs.
+CHUNK_SIZES = (1000, 4096, 65536, 1500, 16384, 7)
+
+#: Messages per second sent in the latency runs.
+LATENCY_RATE = 2000
+
+#: Messages per connection in the disconnect run.
+DISCONNECT_EVERY = 1000
+
+STREAMS = (
+    ('sample', SampleStream, {}),
+    ('filter', FilterStream, dict(track=['twitter'])),
+)
+
+FRAMINGS = (
+    ('newline', None),
+    ('length', 'length'),
+)
+
+MODES = (
+    ('raw', dict(parse_json=False, decode_unicode=False)),
+    ('unicode', dict(parse_json=False, decode_unicode=True)),
+    ('json', dict(parse_json=True, decode_unicode=True)),
+)
+
+TRANSPORTS = ('requests', 'socket')
+
+
+def sized_messages(count=1000, mean=2500, sigma=0.6, seed=0):
+    """Tweets with lognormally distributed sizes around ``mean`` bytes,
+    roughly like those of the real sample stream"""
+    rng = random.Random(seed)
+    tweet = json.loads(single_tweet)
+    tweet['text'] = ''
+    base = len(json.dumps(tweet).encode('utf-8'))
+    messages = []
+    for n in range(count):
+        size = int(rng.lognormvariate(0, sigma) * mean)
+        tweet['id'] += 1
+        tweet['text'] = 'x' * max(size - base, 0)
+        messages.append(json.dumps(tweet).encode('utf-8'))
+    return messages
+
+
+def read(stream, limit, times=None):
+    """Read up to ``limit`` messages, appending the time each arrived to
+    ``times``. Returns the number read."""
+    received = 0
+    try:
+        for message in stream:
+            received += 1
+            if times is not None:
+                times.append(time.time())
+            if received >= limit:
+                break
+    except ConnectionError:
+        pass
+    stream.close()
+    return received
+
+
+def make_stream(cls, options, url, delimited, mode, transport):
+    kwargs = dict(options, url=url, delimited=delimited, transport=transport)
+    kwargs.update(mode)
+    return cls(**kwargs)
+
+
+def throughput(messages, count, repeat, cls, options, delimited, mode,
+               transport):
+    best = None
+    with firehose_server(messages, count=count, keepalive_every=100,
+                         chunk_sizes=CHUNK_SIZES, split_crlf=True,
+                         delimited=delimited) as server:
+        for n in range(repeat):
+            stream = make_stream(cls, options, server.baseurl, delimited,
+                                 mode, transport)
+            start = time.time()
+            received = read(stream, count)
+            elapsed = time.time() - start
+            assert received == count, (received, count)
+            best = elapsed if best is None else min(best, elapsed)
+    return dict(
+        messages_per_s=count / best,
+        mb_per_s=stream.metrics.bytes / best / 1e6,
+    )
+
+
+def latency(messages, count, cls, options, delimited, mode, transport):
+    with firehose_server(messages, count=count, rate=LATENCY_RATE,
+                         keepalive_every=100,
+                         delimited=delimited) as server:
+        stream = make_stream(cls, options, server.baseurl, delimited, mode,
+                             transport)
+        times = []
+        read(stream, count, times)
+        sent = server.sent
+    delays = sorted(r - s for r, s in zip(times, sent))
+
+    def quantile(q):
+        return delays[min(int(q * len(delays)), len(delays) - 1)] * 1e3
+
+    return dict(latency_p50_ms=quantile(0.5), latency_p99_ms=quantile(0.99),
+                latency_max_ms=delays[-1] * 1e3)
+
+
+def memory(messages, count, cls, options, delimited, mode, transport):
+    if tracemalloc is None:
+        return {}
+    with firehose_server(messages, count=count, keepalive_every=100,
+                         chunk_sizes=CHUNK_SIZES, split_crlf=True,
+                         delimited=delimited) as server:
+        stream = make_stream(cls, options, server.baseurl, delimited, mode,
+                             transport)
+        tracemalloc.start()
+        try:
+            read(stream, count)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return dict(peak_memory_kb=peak / 1024.0)
+
+
+def disconnects(messages, count):
+    with firehose_server(messages, disconnect_after=DISCONNECT_EVERY,
+                         chunk_sizes=CHUNK_SIZES) as server:
+        stream = ResilientStream(SampleStream, url=server.baseurl,
+                                 parse_json=False, decode_unicode=False,
+                                 jitter=0)
+        start = time.time()
+        received = read(stream, count)
+        elapsed = time.time() - start
+    return dict(messages_per_s=received / elapsed,
+                reconnects=server.connections - 1)
+
+
+def run(count, quick=False, repeat=3):
+    messages = sized_messages()
+    cases = product(STREAMS, FRAMINGS, MODES, TRANSPORTS)
+    if quick:
+        cases = [case for case in cases
+                 if case[0][0] == 'sample' and case[3] == 'requests']
+    results = []
+    for (stream, cls, options), (framing, delimited), (mode_name, mode), \
+            transport in cases:
+        name = '/'.join((stream, framing, mode_name, transport))
+        args = (cls, options, delimited, mode, transport)
+        result = dict(name=name)
+        result.update(throughput(messages, count, repeat, *args))
+        result.update(latency(messages, min(count, LATENCY_RATE), *args))
+        result.update(memory(messages, min(count, 5000), *args))
+        results.append(result)
+        print(format_result(result))
+        sys.stdout.flush()
+    result = dict(name='sample/disconnects')
+    result.update(disconnects(messages, count))
+    results.append(result)
+    print(format_result(result))
+    return results
+
+
+def format_result(result):
+    parts = ['%-32s' % result['name'],
+             '%9.0f msgs/s' % result['messages_per_s']]
+    if 'mb_per_s' in result:
+        parts.append('%7.1f MB/s' % result['mb_per_s'])
+    if 'latency_p50_ms' in result:
+        parts.append('p50 %6.2f ms  p99 %6.2f ms' % (
+            result['latency_p50_ms'], result['latency_p99_ms']))
+    if 'peak_memory_kb' in result:
+        parts.append('%8.0f KiB' % result['peak_memory_kb'])
+    if 'reconnects' in result:
+        parts.append('%d reconnects' % result['reconnects'])
+    return '  '.join(parts)
+
+
+def compare(results, baseline, tolerance):
+    """Return descriptions of the results that are worse than the
+    baseline by more than ``tolerance``"""
+    previous = dict((r['name'], r) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        old = previous.get(result['name'])
+        if old is None:
+            continue
+        for key, higher_is_better in (('messages_per_s', True),
+                                      ('latency_p99_ms', False),
+                                      ('peak_memory_kb', False)):
+            if key not in result or key not in old or not old[key]:
+                continue
+            change = result[key] / old[key] - 1
+            if higher_is_better:
+                change = -change
+            if change > tolerance:
+                regressions.append('%s %s: %.4g -> %.4g' % (
+                    result['name'], key, old[key], result[key]))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark streams against a synthetic firehose.')
+    parser.add_argument('--count', type=int, default=20000,
+                        help='messages per throughput run')
+    parser.add_argument('--quick', action='store_true',
+                        help='only SampleStream with the requests transport')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='throughput runs per case, keeping the best')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed fractional regression')
+    args = parser.parse_args(argv[1:])
+
+    results = run(args.count, args.quick, args.repeat)
+    report = dict(
+        python=platform.python_version(),
+        platform=platform.platform(),
+        time=time.time(),
+        count=args.count,
+        results=results,
+    )
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
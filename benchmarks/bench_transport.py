@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Compare the read path of the requests and socket transports.
+
+Usage::
+
+    python benchmarks/bench_transport.py [count]
+
+A local server sends ``count`` messages (default 100000) as a chunked HTTP
+response, and each transport reads them as raw bytes, so the time is spent
+receiving, de-chunking and framing rather than parsing.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import socket
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from tweetstream import SampleStream, ConnectionError
+from bench_decoders import synthetic_messages
+
+
+def chunked_body(messages, chunk_size=4096):
+    data = b"".join(m + b"\r\n" for m in messages)
+    chunks = []
+    for n in range(0, len(data), chunk_size):
+        chunk = data[n:n + chunk_size]
+        chunks.append(b"%x\r\n" % len(chunk) + chunk + b"\r\n")
+    return b"".join(chunks) + b"0\r\n\r\n"
+
+
+def serve(body, repeat):
+    """Serve ``body`` to ``repeat`` connections, returning the address"""
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+
+    def run():
+        for n in range(repeat):
+            conn, _ = server.accept()
+            request = b""
+            while b"\r\n\r\n" not in request:
+                request += conn.recv(4096)
+            conn.sendall(b"HTTP/1.1 200 OK\r\n"
+                         b"Transfer-Encoding: chunked\r\n\r\n" + body)
+            conn.close()
+        server.close()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return "http://127.0.0.1:%d/" % server.getsockname()[1]
+
+
+def bench(url, transport):
+    stream = SampleStream(url=url, parse_json=False, decode_unicode=False,
+                          transport=transport)
+    count = 0
+    start = time.time()
+    try:
+        for line in stream:
+            count += 1
+    except ConnectionError:
+        pass
+    return count, time.time() - start
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+    messages = synthetic_messages(count)
+    body = chunked_body(messages)
+    print("%d messages, %.1f MB" % (count, len(body) / 1e6))
+    repeat = 3
+    for transport in ('requests', 'socket'):
+        url = serve(body, repeat)
+        best = None
+        for n in range(repeat):
+            received, elapsed = bench(url, transport)
+            assert received == count, received
+            best = elapsed if best is None else min(best, elapsed)
+        print("%-10s %10.0f msgs/s %8.1f MB/s" % (
+            transport, count / best, len(body) / best / 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,6 +1,13 @@
 # content of conftest.py
 
+import sys
 import pytest
+
+# The asyncio streams, and their tests, need Python 3.6 or later
+collect_ignore = []
+if sys.version_info < (3, 6):
+    collect_ignore.append('tests/test_asyncstreams.py')
+
 def pytest_addoption(parser):
     parser.addoption("--runslow", action="store_true",
         help="run slow tests")
@@ -1,12 +1,18 @@
+import time
 import socket
+import struct
 import random
+import zlib
 import threading
+import itertools
 import contextlib
-from wsgiref.simple_server import make_server
+from wsgiref.simple_server import make_server, WSGIServer
 try:
     from http.server import BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
 except ImportError:
     from BaseHTTPServer import BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
 
 # Python 3
 try:
@@ -21,6 +27,12 @@ http_responses.update({
 })
 
 
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """Serves each request in its own thread, so a stream that is still
+    being sent doesn't hold up other connections."""
+    daemon_threads = True
+
+
 class ServerContext(object):
     """Context object with information about a running test server."""
 
@@ -43,9 +55,12 @@ class TestServerThread(threading.Thread):
 
     daemon = True
 
-    def __init__(self, response, status, headers):
+    def __init__(self, response, status, headers, delimited=None,
+                 compress=False):
         self.address = 'localhost'
         self.port = None
+        self._delimited = delimited
+        self._compress = compress
         self._app = self._make_app(response, status, headers)
         self._server = None
         self.error = None
@@ -62,11 +77,32 @@ class TestServerThread(threading.Thread):
             raise ValueError('Status must be string or int')
         return status
 
+    def _encode(self, data):
+        data = data.encode('utf-8')
+        if self._delimited == 'length' and data.strip():
+            # Twitter's delimited=length framing: the size in bytes of the
+            # message, including its trailing newline, on a line of its own.
+            data = str(len(data)).encode('ascii') + b'\r\n' + data
+        return data
+
     def _make_app(self, response, status, headers):
         status = self._format_status(status)
 
         def app(environ, start_response):
-            start_response(status, list(headers))
+            response_headers = list(headers)
+            encode = self._encode
+            compressor = None
+            if (self._compress and
+                    'gzip' in environ.get('HTTP_ACCEPT_ENCODING', '')):
+                # Flush after every piece, as a streaming server must
+                response_headers.append(('Content-Encoding', 'gzip'))
+                compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                              16 + zlib.MAX_WBITS)
+
+                def encode(data):
+                    return (compressor.compress(self._encode(data)) +
+                            compressor.flush(zlib.Z_SYNC_FLUSH))
+            start_response(status, response_headers)
             if response:
                 iter_resp = None
                 if callable(response):
@@ -75,9 +111,11 @@ class TestServerThread(threading.Thread):
                     iter_resp = response
                 if iter_resp:
                     for x in iter_resp:
-                        yield x.encode('utf-8')
+                        yield encode(x)
                 else:
-                    yield response.encode('utf-8')
+                    yield encode(response)
+            if compressor is not None:
+                yield compressor.flush()
 
         return app
 
@@ -86,7 +124,8 @@ class TestServerThread(threading.Thread):
         while attempts < 10:
             self.port = random.randint(1025, 49151)
             try:
-                self._server = make_server(self.address, self.port, app)
+                self._server = make_server(self.address, self.port, app,
+                                           server_class=ThreadingWSGIServer)
             except socket.error as exc:
                 self.error = exc
                 attempts += 1
@@ -114,11 +153,18 @@ class TestServerThread(threading.Thread):
 
 
 @contextlib.contextmanager
-def test_server(response=None, status='200 OK', headers=[]):
-    """Context that makes available a web server in a separate thread"""
+def test_server(response=None, status='200 OK', headers=[], delimited=None,
+                compress=False):
+    """Context that makes available a web server in a separate thread.
+
+    If ``delimited`` is ``"length"``, every non-blank string the response
+    yields is sent with a length prefix, like Twitter's ``delimited=length``
+    streams. If ``compress`` is True, the response is gzipped for clients
+    that accept it."""
 
     thread = TestServerThread(response=response, status=status,
-                              headers=headers)
+                              headers=headers, delimited=delimited,
+                              compress=compress)
     thread.start()
     thread.startup_finished.wait()
     if thread.error:
@@ -131,3 +177,230 @@ def test_server(response=None, status='200 OK', headers=[]):
         thread.join(5)
         if thread.isAlive():
             raise Warning("Test server could not be stopped")
+
+
+class FirehoseServer(threading.Thread):
+    """Synthetic streaming server for benchmarks.
+
+    Speaks just enough HTTP/1.1 to send every connection a chunked stream of
+    ``messages`` (raw bytes, cycled through as often as needed), without
+    wsgiref in the way. The stream can be shaped with:
+
+    :keyword count: Messages per connection, then the response ends. None
+      keeps sending until the client goes away.
+    :keyword rate: Messages per second to aim for. None sends as fast as
+      the client reads.
+    :keyword keepalive_every: Send a blank keep-alive line after every this
+      many messages.
+    :keyword chunk_sizes: Sizes of the HTTP chunks the stream is cut into,
+      cycled through, regardless of where messages start and end. None
+      sends every message and keep-alive in a chunk of its own.
+    :keyword split_crlf: Move every cut forward so that it falls between the
+      ``\\r`` and ``\\n`` of a message delimiter.
+    :keyword disconnect_after: Drop the connection, without ending the
+      chunked response, after this many messages.
+    :keyword reset: Drop it by resetting the connection instead of closing
+      it cleanly.
+    :keyword delimited: ``"length"`` to prefix every message with its
+      length, like Twitter's ``delimited=length`` streams.
+
+    .. attribute:: sent
+
+        Times at which each message of the latest connection was sent, for
+        working out latency.
+
+    .. attribute:: connections
+
+        Number of connections accepted.
+    """
+
+    daemon = True
+
+    def __init__(self, messages, count=None, rate=None, keepalive_every=None,
+                 chunk_sizes=None, split_crlf=False, disconnect_after=None,
+                 delimited=None, reset=False):
+        self.messages = list(messages)
+        self.count = count
+        self.rate = rate
+        self.keepalive_every = keepalive_every
+        self.chunk_sizes = chunk_sizes
+        self.split_crlf = split_crlf
+        self.disconnect_after = disconnect_after
+        self.delimited = delimited
+        self.reset = reset
+        self.sent = []
+        self.connections = 0
+
+        self.address = '127.0.0.1'
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.bind((self.address, 0))
+        self._listener.listen(16)
+        self._listener.settimeout(0.1)
+        self.port = self._listener.getsockname()[1]
+        self._stopped = threading.Event()
+        # Finite responses are encoded once up front, and at full speed
+        # joined into large blocks, so that the server competes as little
+        # as possible with the client for time and memory
+        self._encoded = None
+        if count is not None or disconnect_after is not None:
+            self._encoded = list(self._encode_chunks())
+            if rate is None:
+                self._encoded = self._coalesce(self._encoded)
+        threading.Thread.__init__(self)
+
+    @property
+    def baseurl(self):
+        return "http://%s:%s" % (self.address, self.port)
+
+    def _frames(self):
+        """Yield ``(frame, is_message)`` pairs for one connection"""
+        messages = self.messages
+        limit = self.count
+        if self.disconnect_after is not None:
+            limit = min(limit or self.disconnect_after, self.disconnect_after)
+        for n in itertools.count():
+            if limit is not None and n >= limit:
+                return
+            if self.keepalive_every and n and n % self.keepalive_every == 0:
+                yield b"\r\n", False
+            message = messages[n % len(messages)]
+            if self.delimited == 'length':
+                yield (str(len(message) + 2).encode('ascii') + b"\r\n" +
+                       message + b"\r\n"), True
+            else:
+                yield message + b"\r\n", True
+
+    def _chunks(self):
+        """Yield ``(chunk, messages)`` pairs, where ``messages`` is the
+        number of messages the chunk completes"""
+        if self.chunk_sizes is None:
+            for frame, is_message in self._frames():
+                yield frame, int(is_message)
+            return
+        sizes = itertools.cycle(self.chunk_sizes)
+        size = next(sizes)
+        buf = bytearray()
+        ends = []  # offsets in buf just past the end of each message
+        for frame, is_message in self._frames():
+            buf += frame
+            if is_message:
+                ends.append(len(buf))
+            while len(buf) >= size:
+                cut = size
+                if self.split_crlf:
+                    cut = buf.find(b"\r\n", size - 1) + 1
+                    if cut <= 0:
+                        break
+                chunk = bytes(buf[:cut])
+                del buf[:cut]
+                done = len([end for end in ends if end <= cut])
+                ends = [end - cut for end in ends[done:]]
+                yield chunk, done
+                size = next(sizes)
+        if buf:
+            yield bytes(buf), len(ends)
+
+    def _encode_chunks(self):
+        for chunk, messages in self._chunks():
+            yield (("%x\r\n" % len(chunk)).encode('ascii') + chunk +
+                   b"\r\n"), messages
+
+    @staticmethod
+    def _coalesce(encoded, size=262144):
+        """Join encoded chunks into blocks of about ``size`` bytes, to be
+        sent in one go"""
+        blocks = []
+        pending = []
+        pending_size = pending_messages = 0
+        for data, messages in encoded:
+            pending.append(data)
+            pending_size += len(data)
+            pending_messages += messages
+            if pending_size >= size:
+                blocks.append((b"".join(pending), pending_messages))
+                pending = []
+                pending_size = pending_messages = 0
+        if pending:
+            blocks.append((b"".join(pending), pending_messages))
+        return blocks
+
+    def _serve(self, conn):
+        try:
+            request = b""
+            while b"\r\n\r\n" not in request:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                request += data
+            # Read the body of filter requests too, or closing the
+            # connection with it unread would reset it
+            head, body = request.split(b"\r\n\r\n", 1)
+            length = 0
+            for line in head.split(b"\r\n")[1:]:
+                name, _, value = line.partition(b":")
+                if name.strip().lower() == b"content-length":
+                    length = int(value)
+            while len(body) < length:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                body += data
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn.sendall(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: application/json\r\n"
+                         b"Transfer-Encoding: chunked\r\n\r\n")
+            sent = self.sent = []
+            start = time.time()
+            chunks = self._encoded
+            if chunks is None:
+                chunks = self._encode_chunks()
+            for data, messages in chunks:
+                if self._stopped.is_set():
+                    return
+                if self.rate:
+                    delay = start + len(sent) / float(self.rate) - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                conn.sendall(data)
+                if messages:
+                    sent.extend([time.time()] * messages)
+            if self.disconnect_after is None:
+                conn.sendall(b"0\r\n\r\n")
+            elif self.reset:
+                conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                struct.pack('ii', 1, 0))
+        except socket.error:
+            pass  # the client went away
+        finally:
+            conn.close()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                conn, _ = self._listener.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            conn.settimeout(None)
+            self.connections += 1
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+        self._listener.close()
+
+    def stop(self):
+        self._stopped.set()
+
+
+@contextlib.contextmanager
+def firehose_server(messages, **options):
+    """Context that runs a :class:`FirehoseServer` in a separate thread,
+    passing it ``options``"""
+    server = FirehoseServer(messages, **options)
+    server.start()
+    try:
+        yield server
+    finally:
+        server.stop()
+        server.join(5)
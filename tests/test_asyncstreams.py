@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+
+import pytest
+from pytest import raises
+
+from tweetstream import (
+    AsyncSampleStream, AsyncFilterStream, ConnectionError,
+    AuthenticationError, EnhanceYourCalmError, ReconnectExponentiallyError,
+    FatalError,
+)
+
+from servercontext import test_server
+from test_tweetstream import single_tweet, BASIC_AUTH
+
+streamtypes = [
+    dict(cls=AsyncSampleStream, kwargs=dict(auth=BASIC_AUTH)),
+    dict(cls=AsyncFilterStream, kwargs=dict(auth=BASIC_AUTH,
+                                            track=['υƞιϲɸδε', 'foo'])),
+]
+stream_ids = [s['cls'].__name__ for s in streamtypes]
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+async def drain(stream):
+    """Read a stream until it disconnects, returning the tweets it yielded"""
+    tweets = []
+    try:
+        async with stream:
+            async for tweet in stream:
+                tweets.append(tweet)
+    except ConnectionError:
+        return tweets
+    raise AssertionError("Stream ended without a ConnectionError")
+
+
+@pytest.mark.parametrize('streamtype', streamtypes, ids=stream_ids)
+@pytest.mark.parametrize(('status_code', 'exception'), [
+    (401, AuthenticationError),
+    (404, FatalError),
+    (406, FatalError),
+    (418, ReconnectExponentiallyError),
+    (420, EnhanceYourCalmError),
+])
+def test_reponse_code_exceptions(streamtype, status_code, exception):
+    with test_server(status=status_code) as server:
+        stream = streamtype['cls'](url=server.baseurl, **streamtype['kwargs'])
+        with raises(exception):
+            run(stream.__anext__())
+
+
+@pytest.mark.parametrize('streamtype', streamtypes, ids=stream_ids)
+@pytest.mark.parametrize('delimited', [None, 'length'])
+def test_keepalive(streamtype, delimited):
+    def tweetsource():
+        yield single_tweet
+        yield "\r\n"
+        yield single_tweet
+        yield "\r\n"
+        yield "\r\n"
+        yield single_tweet
+
+    with test_server(response=tweetsource, delimited=delimited) as server:
+        stream = streamtype['cls'](url=server.baseurl, delimited=delimited,
+                                   **streamtype['kwargs'])
+        tweets = run(drain(stream))
+    assert len(tweets) == stream.count == 3
+    assert tweets[0]['id'] == 2190767504
+
+
+@pytest.mark.parametrize('streamtype', streamtypes, ids=stream_ids)
+def test_compression(streamtype):
+    def tweetsource():
+        for n in range(5):
+            yield single_tweet
+
+    with test_server(response=tweetsource, compress=True) as server:
+        stream = streamtype['cls'](url=server.baseurl, compression=True,
+                                   **streamtype['kwargs'])
+        tweets = run(drain(stream))
+    assert len(tweets) == 5
+    assert stream.metrics.wire_bytes * 2 < stream.metrics.bytes
+
+
+def test_bad_content():
+    def bad_content():
+        yield "[1,2,3]\r\n"
+        yield "[1,2, I need no stinking close brace\r\n"
+
+    async def read_all(stream):
+        async for tweet in stream:
+            pass
+
+    with test_server(response=bad_content) as server:
+        stream = AsyncSampleStream(url=server.baseurl, auth=BASIC_AUTH)
+        with raises(ConnectionError) as excinfo:
+            run(read_all(stream))
+    assert excinfo.value.reason == "Got invalid data from twitter"
+    assert not stream.connected
+
+
+def test_stall_watchdog():
+    def tweetsource():
+        yield single_tweet
+        time.sleep(2)
+        yield single_tweet
+
+    async def read_all(stream):
+        async for tweet in stream:
+            pass
+
+    with test_server(response=tweetsource) as server:
+        stream = AsyncSampleStream(url=server.baseurl, auth=BASIC_AUTH,
+                                   keepalive_interval=0.3)
+        with raises(ConnectionError) as excinfo:
+            run(read_all(stream))
+    assert 'stalled' in excinfo.value.reason
+    assert stream.metrics.stalls == 1
+
+
+def test_bad_host():
+    stream = AsyncSampleStream(url="http://wedfwecfghhreewerewads.foo",
+                               auth=BASIC_AUTH)
+    with raises(ReconnectExponentiallyError):
+        run(stream.__anext__())
+
+
+def test_many_streams_one_loop():
+    """A single event loop drives several streams at once"""
+    def tweetsource():
+        for n in range(5):
+            yield single_tweet
+
+    async def main(url):
+        streams = [AsyncSampleStream(url=url, auth=BASIC_AUTH)
+                   for n in range(10)]
+        return await asyncio.gather(*[drain(s) for s in streams])
+
+    with test_server(response=tweetsource) as server:
+        results = run(main(server.baseurl))
+    assert [len(r) for r in results] == [5] * 10
+
+
+def test_sync_iteration_refused():
+    with raises(TypeError):
+        iter(AsyncSampleStream(auth=BASIC_AUTH))
+    with raises(TypeError):
+        AsyncSampleStream(auth=BASIC_AUTH).iter_batches()
+
+
+def test_update_filter():
+    def tweetsource():
+        yield single_tweet
+
+    async def main(stream):
+        await stream._init_conn()
+        with raises(TypeError):
+            stream.update_filter(track=['new'])
+        await stream.close()
+
+    stream = AsyncFilterStream(auth=BASIC_AUTH, track=['old'])
+    stream.update_filter(track=['new'])
+    assert stream.parameters['track'] == ['new']
+    with test_server(response=tweetsource) as server:
+        stream.url = server.baseurl
+        run(main(stream))
+    assert stream.parameters['track'] == ['new']
@@ -1,21 +1,50 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import os
+import json
 import time
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
 
 import pytest
 from pytest import raises
 slow = pytest.mark.slow
 
 from tweetstream import (
-    SampleStream, FilterStream, ConnectionError, AuthenticationError, 
+    SampleStream, FilterStream, BackgroundReader, ResilientStream,
+    ShardedFilterStream, ReplayStream, Pipeline, Hub, Relay,
+    ConnectionError, ReconnectImmediatelyError, ReconnectLinearlyError,
+    AuthenticationError, 
     EnhanceYourCalmError, ReconnectExponentiallyError, FatalError,
 )
 
-from servercontext import test_server
+from tweetstream.framing import LineFramer, LengthFramer
+from tweetstream.transport import (
+    ChunkedDecoder, SocketResponse, _read_head, parse_response_head,
+)
+from tweetstream.decoders import decoders
+from tweetstream.messages import classify
+from tweetstream.matching import LocalFilter
+from tweetstream.records import Record, LazyRecord
+from tweetstream.resilient import LinearBackoff
+from tweetstream.sharding import assign
+from tweetstream.metrics import RateWindow
+from tweetstream.archive import ArchiveWriter, ArchiveReader
+from tweetstream.pipeline import _Ring
+from tweetstream.checkpoint import Checkpoint
+from tweetstream.sinks import JSONLinesSink, SQLiteSink
+from tweetstream.columns import Columns, TYPE_CODES, parse_time
+from tweetstream.users import UserCache
+from servercontext import test_server, firehose_server
 
 single_tweet = (r"""{"in_reply_to_status_id":null,"in_reply_to_user_id":null,"favorited":false,"created_at":"Tue Jun 16 10:40:14 +0000 2009","in_reply_to_screen_name":null,"text":"ʀεϲɸʀδ ιƞδυστʀψ just keeps on amazing me: http:\/\/is.gd\/13lFo - $150k per song you've SHARED, not that somebody has actually DOWNLOADED.","user":{"notifications":null,"profile_background_tile":false,"followers_count":206,"time_zone":"Copenhagen","utc_offset":3600,"friends_count":191,"profile_background_color":"ffffff","profile_image_url":"http:\/\/s3.amazonaws.com\/twitter_production\/profile_images\/250715794\/profile_normal.png","description":"Digital product developer, currently at Opera Software. My tweets are my opinions, not those of my employer.","verified_profile":false,"protected":false,"favourites_count":0,"profile_text_color":"3C3940","screen_name":"eiriksnilsen","name":"Eirik Stridsklev N.","following":null,"created_at":"Tue May 06 12:24:12 +0000 2008","profile_background_image_url":"http:\/\/s3.amazonaws.com\/twitter_production\/profile_background_images\/10531192\/160x600opera15.gif","profile_link_color":"0099B9","profile_sidebar_fill_color":"95E8EC","url":"http:\/\/www.stridsklev-nilsen.no\/eirik","id":14672543,"statuses_count":506,"profile_sidebar_border_color":"5ED4DC","location":"Oslo, Norway"},"id":2190767504,"truncated":false,"source":"<a href=\"http:\/\/widgets.opera.com\/widget\/7206\">Twitter Opera widget<\/a>"}"""
                 + '\r\n')
 
+delete_message = '{"delete":{"status":{"id":1234,"id_str":"1234","user_id":3,"user_id_str":"3"}}}\r\n'
+limit_message = '{ "limit" : {"track":1234}}\r\n'
+
 BASIC_AUTH = ('username', 'password')
 
 streamtypes = [
@@ -24,6 +53,11 @@ streamtypes = [
                                                 track=['υƞιϲɸδε', 'foo'],
                                                 follow=['υƞιϲɸδε', 'foo'],
                                                 locations=['υƞιϲɸδε', 'foo'])),
+    dict(cls=SampleStream, args=[], kwargs=dict(auth=BASIC_AUTH,
+                                                transport='socket')),
+    dict(cls=FilterStream, args=[], kwargs=dict(auth=BASIC_AUTH,
+                                                track=['υƞιϲɸδε', 'foo'],
+                                                transport='socket')),
 ]
 
 
@@ -194,3 +228,1672 @@ def test_buffering(cls, args, kwargs):
         first = time.time()
         diff = first - start
         assert diff < 1, "Getting first tweet took too long! %i > 1" % (diff)
+
+
+def test_line_framer_split_delimiter():
+    """Frames must be found even when chunk boundaries fall inside a message
+    or between the two bytes of the delimiter"""
+    data = b"[1]\r\n\r\n[2,3]\r\n  \r\n[4]\r\n"
+    for size in (1, 2, 3, 5, len(data)):
+        framer = LineFramer()
+        frames = []
+        for n in range(0, len(data), size):
+            frames.extend(framer.feed(data[n:n + size]))
+        assert frames == [b"[1]", b"[2,3]", b"[4]"]
+        assert framer.pending == 0
+
+
+@parameterized(streamtypes)
+def test_length_delimited(cls, args, kwargs):
+    """Length delimited streams yield the same tweets, and keepalive newlines
+    between messages are ignored"""
+
+    def tweetsource():
+        yield single_tweet
+        yield "\r\n"
+        yield single_tweet
+        yield "\r\n"
+        yield "\r\n"
+        yield single_tweet
+
+    with test_server(response=tweetsource, delimited='length') as server:
+        cls.url = server.baseurl
+        stream = cls(*args, delimited='length', **kwargs)
+        try:
+            for tweet in stream:
+                assert tweet['id'] == 2190767504
+        except ConnectionError:
+            assert stream.count == 3, "Got %s, wanted 3" % stream.count
+        else:
+            assert False, "Didn't handle keepalive"
+
+
+@parameterized(streamtypes)
+def test_malformed_length_prefix(cls, args, kwargs):
+    """A length prefix that isn't a number is treated as invalid data"""
+
+    def bad_content():
+        yield "%d\r\n" % len(single_tweet.encode('utf-8'))
+        yield single_tweet
+        yield "twelve\r\n[1,2,3]\r\n"
+
+    with test_server(response=bad_content) as server:
+        cls.url = server.baseurl
+        stream = cls(*args, delimited='length', **kwargs)
+        tweets = []
+        with raises(ConnectionError) as excinfo:
+            for tweet in stream:
+                tweets.append(tweet)
+
+    assert excinfo.value.reason == "Got invalid data from twitter"
+    assert len(tweets) == 1
+
+
+def test_length_framer_split_chunks():
+    """Length prefixes and bodies may be split across chunk boundaries"""
+    data = b"5\r\n[1]\r\n\r\n7\r\n[2,3]\r\n5\r\n[4]\r\n"
+    for size in (1, 2, 3, 5, len(data)):
+        framer = LengthFramer()
+        frames = []
+        for n in range(0, len(data), size):
+            frames.extend(framer.feed(data[n:n + size]))
+        assert frames == [b"[1]", b"[2,3]", b"[4]"]
+        assert framer.pending == 0
+
+
+def test_length_framer_bad_prefix():
+    """Frames before a malformed prefix are returned first"""
+    framer = LengthFramer()
+    assert framer.feed(b"5\r\n[1]\r\ntwelve\r\n") == [b"[1]"]
+    with raises(ValueError):
+        framer.feed(b"5\r\n[2]\r\n")
+
+
+def test_read_in_chunk():
+    """Without read1, reads stop at the end of each HTTP chunk"""
+    import io
+    try:
+        from http.client import HTTPResponse
+    except ImportError:
+        from httplib import HTTPResponse
+
+    class FakeSocket(object):
+        def makefile(self, *args, **kwargs):
+            return io.BytesIO(b"HTTP/1.1 200 OK\r\n"
+                              b"Transfer-Encoding: chunked\r\n\r\n"
+                              b"3\r\nabc\r\n5\r\ndefgh\r\n0\r\n\r\n")
+
+    response = HTTPResponse(FakeSocket())
+    response.begin()
+    reads = list(iter(lambda: SampleStream._read_in_chunk(response, 3), b""))
+    assert reads == [b"a", b"bc", b"d", b"efg", b"h"]
+
+
+def test_chunked_decoder():
+    """Chunked transfer encoding is decoded however the data is split up"""
+    data = b"5\r\n[1]\r\n\r\n7;ext=1\r\n[2,3]\r\n\r\n0\r\nX-Foo: bar\r\n\r\n"
+    for size in (1, 2, 3, 7, len(data)):
+        decoder = ChunkedDecoder()
+        body = b""
+        for n in range(0, len(data), size):
+            body += b"".join(decoder.feed(data[n:n + size]))
+        assert body == b"[1]\r\n[2,3]\r\n"
+        assert decoder.done
+
+
+def test_chunked_decoder_buffer():
+    """Given a buffer and size, fragments are views into the buffer"""
+    data = b"5\r\n[1]\r\n\r\n7;ext=1\r\n[2,3]\r\n\r\n0\r\n\r\n"
+    for size in (1, 3, len(data)):
+        decoder = ChunkedDecoder()
+        buf = bytearray(64)
+        body = b""
+        for n in range(0, len(data), size):
+            piece = data[n:n + size]
+            buf[:len(piece)] = piece
+            fragments = decoder.feed(buf, len(piece))
+            assert all(isinstance(f, memoryview) for f in fragments)
+            body += b"".join(f.tobytes() for f in fragments)
+        assert body == b"[1]\r\n[2,3]\r\n"
+        assert decoder.done
+
+
+def socket_response(*pieces):
+    """A SocketResponse reading the given pieces from a socket pair"""
+    import socket
+    ours, theirs = socket.socketpair()
+    for piece in pieces:
+        theirs.sendall(piece)
+    theirs.close()
+    head, rest = _read_head(ours)
+    status, reason, headers = parse_response_head(head)
+    return SocketResponse(ours, status, reason, headers, rest)
+
+
+def test_socket_response_chunked():
+    response = socket_response(
+        b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n5\r\n[1]",
+        b"\r\n\r\n7\r\n[2,3]\r\n\r\n0\r\n\r\nignored")
+    assert response.status == 200
+    body = b"".join(bytes(piece) for piece in response.iter_body(4))
+    assert body == b"[1]\r\n[2,3]\r\n"
+    response.close()
+
+
+def test_chunked_decoder_bad_size():
+    """Fragments before a malformed size line are returned first"""
+    decoder = ChunkedDecoder()
+    assert decoder.feed(b"3\r\n[1]\r\nzz\r\n") == [b"[1]"]
+    with raises(ValueError):
+        decoder.feed(b"3\r\n[2]\r\n")
+    with raises(ValueError):
+        ChunkedDecoder().feed(b"zz\r\n")
+
+
+def test_socket_bad_chunk_size():
+    """Malformed chunked encoding is invalid data like any other"""
+    tweet = single_tweet.encode('utf-8')
+    stream = SampleStream(auth=BASIC_AUTH, transport='socket')
+    stream._conn = socket_response(
+        b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n",
+        ("%x\r\n" % len(tweet)).encode('ascii') + tweet + b"\r\nzz\r\n")
+    stream.connected = True
+    tweets = []
+    with raises(ReconnectImmediatelyError) as excinfo:
+        for tweet in stream:
+            tweets.append(tweet)
+    assert excinfo.value.reason == "Got invalid data from twitter"
+    assert len(tweets) == 1
+    assert not stream.connected
+
+
+def test_socket_response_incomplete():
+    from tweetstream.transport import IncompleteRead
+    response = socket_response(
+        b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n",
+        b"a\r\n[1]")
+    with raises(IncompleteRead):
+        for piece in response.iter_body():
+            pass
+
+    response = socket_response(
+        b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n[1]\r\nignored")
+    assert b"".join(bytes(p) for p in response.iter_body()) == b"[1]\r\n"
+
+
+@parameterized(streamtypes)
+def test_custom_decoder(cls, args, kwargs):
+    """A decoder callable is handed the raw bytes of each message"""
+    seen = []
+
+    def decoder(data):
+        seen.append(data)
+        return {'text': 'decoded'}
+
+    def tweetsource():
+        yield single_tweet
+        yield single_tweet
+
+    with test_server(response=tweetsource) as server:
+        cls.url = server.baseurl
+        stream = cls(*args, decoder=decoder, **kwargs)
+        assert next(stream) == {'text': 'decoded'}
+    assert seen == [single_tweet.rstrip().encode('utf-8')]
+
+
+@pytest.mark.parametrize(('name', 'decoder'), decoders)
+def test_decoder_backends(name, decoder):
+    """Every available backend parses bytes and rejects invalid JSON"""
+    data = single_tweet.encode('utf-8')
+    assert decoder(data)['id'] == 2190767504
+    with raises(ValueError):
+        decoder(b"[1,2, I need no stinking close brace")
+
+
+def test_unknown_decoder():
+    with raises(ValueError):
+        SampleStream(auth=BASIC_AUTH, decoder='no-such-json')
+
+
+@pytest.mark.parametrize(('data', 'message_type'), [
+    (single_tweet, 'tweet'),
+    (delete_message, 'delete'),
+    (limit_message, 'limit'),
+    ('{"scrub_geo":{"user_id":14090452,"up_to_status_id":23260136625}}', 'scrub_geo'),
+    ('{"warning":{"code":"FALLING_BEHIND","percent_full":60}}', 'warning'),
+    ('[1,2,3]', 'unknown'),
+    ('', 'unknown'),
+])
+def test_classify(data, message_type):
+    assert classify(data.encode('utf-8')) == message_type
+
+
+@parameterized(streamtypes)
+def test_drop_and_handlers(cls, args, kwargs):
+    """Dropped message types are never seen, handled ones go to their
+    handlers and everything else is yielded"""
+    def tweetsource():
+        yield single_tweet
+        yield delete_message
+        yield limit_message
+        yield single_tweet
+        yield limit_message
+
+    with test_server(response=tweetsource) as server:
+        cls.url = server.baseurl
+        stream = cls(*args, drop=['delete'], **kwargs)
+        limits = []
+        stream.on('limit', limits.append)
+        tweets = []
+        with raises(ConnectionError):
+            for tweet in stream:
+                tweets.append(tweet)
+
+    assert [t['id'] for t in tweets] == [2190767504, 2190767504]
+    assert limits == [{'limit': {'track': 1234}}] * 2
+    assert stream.count == 2
+
+
+def test_unknown_message_type():
+    with raises(ValueError):
+        SampleStream(auth=BASIC_AUTH, drop=['tweets'])
+    with raises(ValueError):
+        SampleStream(auth=BASIC_AUTH).on('deleted', lambda message: None)
+
+
+def make_tweet(**fields):
+    tweet = {"id": 1, "text": "", "user": {"id": 10, "screen_name": "someone"},
+             "entities": {"hashtags": [], "urls": [], "user_mentions": []},
+             "coordinates": None, "place": None}
+    tweet.update(fields)
+    return tweet
+
+
+@pytest.mark.parametrize(('tweet', 'candidate', 'match'), [
+    (make_tweet(text="Opera is a browser"), True, True),
+    (make_tweet(text="firefox and safari are too"), True, True),
+    # Only one word of the phrase, so a candidate but not a match
+    (make_tweet(text="firefox only"), True, False),
+    # Term appears outside the searched fields
+    (make_tweet(text="nothing", user={"id": 10, "screen_name": "opera"}), True, False),
+    (make_tweet(text="ʀεϲɸʀδ υƞιϲɸδε"), True, True),
+    # Non-ASCII terms match in any case, escaped or not
+    (make_tweet(text="CAFÉ"), True, True),
+    (make_tweet(text="CaFé au lait"), True, True),
+    (make_tweet(text="ΥȠΙϹɸΔΕ"), True, True),
+    # Terms match whole words only
+    (make_tweet(text="#Opera! operas"), True, True),
+    (make_tweet(text="Operatic"), True, False),
+    # Retweets and quotes match through the tweet they retweet or quote
+    (make_tweet(text="RT @someone: nothing",
+                retweeted_status=make_tweet(id=2, text="Opera is a browser")),
+     True, True),
+    (make_tweet(text="nothing", quoted_status=make_tweet(
+        id=2, entities={"hashtags": [{"text": "opera"}], "urls": [],
+                        "user_mentions": []})),
+     True, True),
+    (make_tweet(text="nothing to see"), False, False),
+    (make_tweet(text="nothing", user={"id": 124}), True, True),
+    (make_tweet(text="nothing", user={"id": 1124}), False, False),
+    (make_tweet(text="nothing", coordinates={"type": "Point",
+                                             "coordinates": [-122.4, 37.1]}),
+     True, True),
+    (make_tweet(text="nothing", coordinates={"type": "Point",
+                                             "coordinates": [10.7, 59.9]}),
+     False, False),
+    (make_tweet(text="nothing", place={"bounding_box": {
+        "type": "Polygon", "coordinates": [[[-123, 37], [-123, 38],
+                                            [-122, 38], [-122, 37]]]}}),
+     True, True),
+])
+def testlocal_filter(tweet, candidate, match):
+    import json
+    local_filter = LocalFilter(track=["opera", "firefox safari", "υƞιϲɸδε",
+                                      "café"],
+                               follow=[123, 124, 125],
+                               locations=["-122.75,36.8", "-121.75,37.8"])
+    for raw in (json.dumps(tweet), json.dumps(tweet, ensure_ascii=False)):
+        raw = raw.encode('utf-8')
+        assert local_filter.candidate(raw) == candidate
+        if candidate:
+            assert local_filter.matches(json.loads(raw.decode('utf-8'))) == match
+
+
+@pytest.mark.parametrize('parse_json', [True, False])
+def test_filterstreamlocal_filter(parse_json):
+    """Tweets not matching the local filter are never yielded"""
+    other_tweet = single_tweet.replace('amazing', 'boring')
+
+    def tweetsource():
+        yield single_tweet
+        yield other_tweet
+        yield delete_message
+        yield other_tweet
+        yield single_tweet
+
+    with test_server(response=tweetsource) as server:
+        stream = FilterStream(auth=BASIC_AUTH, track=['amazing', 'boring'],
+                              local_filter=dict(track=['AMAZING']),
+                              parse_json=parse_json, url=server.baseurl)
+        tweets = []
+        with raises(ConnectionError):
+            for tweet in stream:
+                tweets.append(tweet)
+
+    assert len(tweets) == 3
+    assert stream.count == 2
+    assert stream.local_filter.checked == 4
+    assert stream.local_filter.candidates == 2
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_field_projection(lazy):
+    """Projected records hold only the selected fields"""
+    fields = ['id', 'text', 'user.screen_name', 'user.no_such_field']
+
+    def tweetsource():
+        yield single_tweet
+        yield single_tweet
+
+    with test_server(response=tweetsource) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl,
+                              fields=fields, lazy=lazy)
+        record = next(stream)
+
+    assert isinstance(record, LazyRecord if lazy else Record)
+    assert not hasattr(record, '__dict__')
+    assert record.id == 2190767504
+    assert record['user.screen_name'] == record.user_screen_name == 'eiriksnilsen'
+    assert record.user_no_such_field is None
+    assert record.get('user.no_such_field', 'default') == 'default'
+    assert record._asdict()['text'].startswith('ʀεϲɸʀδ')
+    with raises(KeyError):
+        record['created_at']
+
+
+def test_lazy_record_without_fields():
+    """Lazy records without a projection look up any path on demand,
+    parsing the message once"""
+    parsed = []
+
+    def decoder(data):
+        parsed.append(data)
+        return json.loads(data.decode('utf-8'))
+
+    with test_server(response=[single_tweet]) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl, lazy=True,
+                              decoder=decoder)
+        record = next(stream)
+
+    assert record.raw == single_tweet.rstrip().encode('utf-8')
+    assert parsed == []
+    assert record['user.location'] == 'Oslo, Norway'
+    assert record['id'] == 2190767504
+    assert record['nothing.here'] is None
+    assert record._asdict()['text'].startswith('ʀεϲɸʀδ')
+    assert len(parsed) == 1
+
+
+def test_projection_needs_parse_json():
+    with raises(ValueError):
+        SampleStream(auth=BASIC_AUTH, parse_json=False, fields=['id'])
+
+
+@parameterized(streamtypes)
+def test_iter_batches(cls, args, kwargs):
+    """Batches are limited by size, and the count and disconnect behaviour
+    match plain iteration"""
+    def tweetsource():
+        for n in range(25):
+            yield single_tweet
+            yield delete_message
+
+    with test_server(response=tweetsource) as server:
+        cls.url = server.baseurl
+        stream = cls(*args, drop=['delete'], **kwargs)
+        batches = []
+        with raises(ConnectionError):
+            for batch in stream.iter_batches(max_items=20, max_latency=5):
+                batches.append(batch)
+
+    assert sum(len(b) for b in batches) == stream.count == 25
+    assert all(len(b) <= 20 for b in batches)
+    assert batches[0][0]['id'] == 2190767504
+
+
+def test_iter_batches_latency():
+    """A partial batch is returned once max_latency has passed"""
+    def tweetsource():
+        yield single_tweet
+        yield single_tweet
+        time.sleep(2)
+        yield single_tweet
+
+    with test_server(response=tweetsource) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl)
+        batches = stream.iter_batches(max_items=100, max_latency=0.2)
+        start = time.time()
+        first = next(batches)
+        assert time.time() - start < 1.5
+        assert len(first) == 2
+        assert next(batches) == [first[0]]
+
+
+def test_iter_batches_raw():
+    def tweetsource():
+        yield single_tweet
+        yield "\r\n"
+        yield delete_message
+        yield single_tweet
+
+    with test_server(response=tweetsource) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl,
+                              parse_json=False, decode_unicode=False)
+        blocks = []
+        with raises(ConnectionError):
+            for block in stream.iter_batches(max_items=10, raw=True):
+                blocks.append(block)
+
+    expected = (single_tweet + delete_message + single_tweet).encode('utf-8')
+    assert b"".join(blocks) == expected
+    assert stream.count == 2
+
+
+def test_iter_batches_bad_content():
+    """Messages before invalid data are delivered before the error"""
+    def bad_content():
+        yield single_tweet
+        yield single_tweet
+        yield "[1,2, I need no stinking close brace\r\n"
+        yield single_tweet
+
+    with test_server(response=bad_content) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl)
+        batches = []
+        with raises(ConnectionError) as excinfo:
+            for batch in stream.iter_batches(max_items=10, max_latency=5):
+                batches.append(batch)
+
+    assert excinfo.value.reason == "Got invalid data from twitter"
+    assert [len(b) for b in batches] == [2]
+    assert stream.count == 2
+
+
+@pytest.mark.parametrize('transport', ['requests', 'socket'])
+def test_iter_batches_dropped_connection(transport):
+    """Messages read before the connection drops are delivered before the
+    error"""
+    messages = [single_tweet.encode('utf-8')[:-2]]
+    with firehose_server(messages, disconnect_after=5) as server:
+        stream = SampleStream(url=server.baseurl, transport=transport)
+        batches = []
+        with raises(ConnectionError):
+            for batch in stream.iter_batches(max_items=100, max_latency=5):
+                batches.append(batch)
+    assert sum(len(b) for b in batches) == stream.count == 5
+
+
+def read_in_background(policy, total=30, maxsize=10):
+    """Let a background reader take in a whole stream before consuming it"""
+    def tweetsource():
+        for n in range(total):
+            yield single_tweet.replace('2190767504', str(n))
+
+    with test_server(response=tweetsource) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl)
+        reader = BackgroundReader(stream, maxsize=maxsize, policy=policy)
+        reader.start()
+        if policy != 'block':
+            reader._thread.join(5)
+            assert reader.depth == (total if policy == 'spill' else maxsize)
+        ids = []
+        with raises(ConnectionError):
+            for tweet in reader:
+                ids.append(tweet['id'])
+        reader.close()
+    return reader, ids
+
+
+@pytest.mark.parametrize(('policy', 'expected'), [
+    ('block', list(range(30))),
+    ('spill', list(range(30))),
+    ('drop_oldest', list(range(20, 30))),
+    ('drop_newest', list(range(10))),
+])
+def test_background_reader_policies(policy, expected):
+    reader, ids = read_in_background(policy)
+    assert ids == expected
+    assert reader.dropped == 30 - len(expected)
+    assert reader.stream.count == len(expected)
+    if policy == 'spill':
+        assert reader.spilled == 20
+        assert reader.spill_size == 0
+
+
+def test_background_reader_errors():
+    """Errors from the reader thread reach the consumer after the messages
+    received before them"""
+    def bad_content():
+        yield single_tweet
+        yield "[1,2, I need no stinking close brace\r\n"
+
+    with test_server(response=bad_content) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl)
+        with BackgroundReader(stream) as reader:
+            tweets = []
+            with raises(ConnectionError) as excinfo:
+                for tweet in reader:
+                    tweets.append(tweet)
+    assert len(tweets) == 1
+    assert excinfo.value.reason == "Got invalid data from twitter"
+
+
+fast_schedules = [(ConnectionError, LinearBackoff(0.01, 0.01, 0.05))]
+
+
+def test_resilient_stream_reconnects():
+    """Disconnects are followed by reconnects on the same session"""
+    def tweetsource():
+        yield single_tweet
+        yield single_tweet
+
+    with test_server(response=tweetsource) as server:
+        with ResilientStream(SampleStream, auth=BASIC_AUTH, url=server.baseurl,
+                             schedules=fast_schedules) as stream:
+            session = None
+            for n, tweet in enumerate(stream):
+                session = session or stream.stream._client
+                assert stream.stream._client is session
+                if n == 6:
+                    break
+
+    assert stream.reconnects == 3
+    assert stream.stream.count == 7
+    assert stream.failures == 0
+    assert stream.errors['ReconnectImmediatelyError'] == 3
+
+
+@pytest.mark.parametrize('transport', ['requests', 'socket'])
+def test_resilient_stream_connection_reset(transport):
+    """A connection reset by the server is a disconnect like any other"""
+    messages = [single_tweet.encode('utf-8')[:-2]]
+    with firehose_server(messages, disconnect_after=3, reset=True) as server:
+        with ResilientStream(SampleStream, url=server.baseurl,
+                             transport=transport,
+                             schedules=fast_schedules) as stream:
+            for n, tweet in enumerate(stream):
+                if n == 6:
+                    break
+
+    assert stream.reconnects >= 2
+    assert stream.errors['ReconnectImmediatelyError'] == stream.reconnects
+
+
+@pytest.mark.parametrize(('status_code', 'exception', 'failures'), [
+    (404, FatalError, 0),
+    (420, EnhanceYourCalmError, 3),
+    (500, ReconnectExponentiallyError, 3),
+])
+def test_resilient_stream_gives_up(status_code, exception, failures):
+    with test_server(status=status_code) as server:
+        stream = ResilientStream(SampleStream, auth=BASIC_AUTH,
+                                 url=server.baseurl, max_failures=3,
+                                 schedules=fast_schedules)
+        with raises(exception):
+            for tweet in stream:
+                pass
+    assert stream.failures == failures
+
+
+@pytest.mark.parametrize(('error', 'delays'), [
+    (ReconnectImmediatelyError(), [0, 0.25, 0.5, 0.75]),
+    (ReconnectLinearlyError(), [0.25, 0.5, 0.75, 1.0]),
+    (ReconnectExponentiallyError(), [10, 20, 40, 80, 160, 240, 240]),
+    (AuthenticationError(), [10, 20, 40]),
+    (EnhanceYourCalmError(), [60, 120, 240, 480, 960, 960]),
+])
+def test_resilient_stream_schedules(error, delays):
+    stream = ResilientStream(SampleStream, auth=BASIC_AUTH, jitter=0)
+    assert [stream._backoff(error) for d in delays] == delays
+
+
+def test_resilient_stream_calm_jitter():
+    """Jitter never shortens the wait Twitter asks for after a 420"""
+    stream = ResilientStream(SampleStream, auth=BASIC_AUTH, jitter=0.5)
+    delays = []
+    for n in range(50):
+        delays.append(stream._backoff(EnhanceYourCalmError()))
+        stream._reset()
+    assert min(delays) >= 60
+    assert max(delays) > 60
+
+
+@pytest.mark.parametrize(('compression', 'transport'), [
+    (False, 'requests'), (True, 'requests'), (False, 'socket'),
+    (True, 'socket')])
+def test_update_filter(compression, transport, tmpdir):
+    """Updating the filter switches connections without losing tweets or
+    returning duplicates"""
+    import itertools
+    connections = itertools.count()
+
+    def numbered(n):
+        return single_tweet.replace('2190767504', str(n))
+
+    def tweetsource():
+        if next(connections) == 0:
+            for n in (1, 2, 3):
+                yield numbered(n)
+            time.sleep(1)
+            # 4 is only sent on the old connection, after the new one
+            # has started delivering
+            for n in (4, 5):
+                yield numbered(n)
+        else:
+            for n in (5, 6, 7):
+                yield numbered(n)
+            # Sent after the switch, in the middle of the body
+            for n in (8, 9):
+                time.sleep(1)
+                yield numbered(n)
+
+    with test_server(response=tweetsource, compress=compression) as server:
+        path = str(tmpdir.join('archive'))
+        stream = FilterStream(auth=BASIC_AUTH, track=['old'],
+                              url=server.baseurl, compression=compression,
+                              transport=transport, record=path)
+        ids = []
+        with raises(ConnectionError):
+            for tweet in stream:
+                ids.append(tweet['id'])
+                if tweet['id'] == 1:
+                    stream.update_filter(track=['new'])
+                    assert stream.parameters['track'] == ['new']
+        stream.close()
+
+    assert ids == [1, 2, 3, 4, 5, 6, 7, 8, 9]
+    assert stream.count == 9
+    # Both connections' messages are counted, but recorded once
+    assert stream.metrics.messages == 10
+    assert [tweet['id'] for tweet in ReplayStream(path)] == ids
+
+
+def test_update_filter_batches():
+    """iter_batches switches connections too"""
+    import itertools
+    connections = itertools.count()
+
+    def numbered(n):
+        return single_tweet.replace('2190767504', str(n))
+
+    def tweetsource():
+        if next(connections) == 0:
+            yield numbered(1)
+            time.sleep(1)
+            yield numbered(2)
+        else:
+            for n in (2, 3):
+                yield numbered(n)
+
+    with test_server(response=tweetsource) as server:
+        stream = FilterStream(auth=BASIC_AUTH, track=['amazing'],
+                              url=server.baseurl, local_filter=True)
+        ids = []
+        with raises(ConnectionError):
+            for batch in stream.iter_batches(max_items=1):
+                ids.extend(tweet['id'] for tweet in batch)
+                if ids == [1]:
+                    stream.update_filter(track=['shared'])
+
+    assert ids == [1, 2, 3]
+    assert stream._incoming is None
+    assert stream.local_filter.phrases == [['shared']]
+
+
+def test_update_filter_local_filter():
+    """A local filter made from the parameters follows them"""
+    stream = FilterStream(auth=BASIC_AUTH, track=['old'], local_filter=True)
+    stream.update_filter(track=['new'])
+    assert stream.local_filter.phrases == [['new']]
+
+    given = LocalFilter(track=['given'])
+    stream = FilterStream(auth=BASIC_AUTH, track=['old'], local_filter=given)
+    stream.update_filter(track=['new'])
+    assert stream.local_filter is given
+
+
+def test_update_filter_failure():
+    """If the new connection fails the old one is kept"""
+    def tweetsource():
+        yield single_tweet
+        yield single_tweet
+
+    with test_server(response=tweetsource) as server:
+        stream = FilterStream(auth=BASIC_AUTH, track=['old'],
+                              url=server.baseurl)
+        next(stream)
+        stream.url = "http://wedfwecfghhreewerewads.foo"
+        with raises(ConnectionError):
+            stream.update_filter(track=['new'])
+        assert stream.parameters['track'] == ['old']
+        assert next(stream)['id'] == 2190767504
+
+
+def test_filterstream_locations_only():
+    stream = FilterStream(auth=BASIC_AUTH, locations=['-122.75,36.8',
+                                                      '-121.75,37.8'])
+    assert stream._get_post_data() == {'locations': '-122.75,36.8,-121.75,37.8'}
+
+
+def test_assign():
+    terms = ['term%d' % n for n in range(1000)]
+    shards = assign(terms, 4, 300)
+    assert sorted(sum(shards, [])) == sorted(terms)
+    assert all(len(shard) <= 300 for shard in shards)
+    assert assign(reversed(terms), 4, 300) == shards
+
+    # Adding a term, or a shard, moves few of the others
+    added = assign(terms + ['new'], 4, 300)
+    moved = [t for t in terms if not any(t in a and t in b
+                                         for a, b in zip(shards, added))]
+    assert len(moved) <= 1
+    grown = assign(terms, 5, 300)
+    moved = [t for t in terms if not any(t in a and t in b
+                                         for a, b in zip(shards, grown))]
+    assert len(moved) < 300
+
+    with raises(ValueError):
+        assign(terms, 3, 300)
+
+
+def test_sharded_partition():
+    stream = ShardedFilterStream(auth=BASIC_AUTH,
+                                 track=['t%d' % n for n in range(1000)],
+                                 follow=range(10),
+                                 locations=['-122.75,36.8,-121.75,37.8'])
+    assert len(stream.shards) == 4
+    for shard in stream.shards:
+        assert len(shard.parameters['track']) <= 400
+    assert sum(len(s.parameters['follow']) for s in stream.shards) == 10
+    assert sum(len(s.parameters['locations']) for s in stream.shards) == 1
+
+    changed = stream.update_filter(track=['t%d' % n for n in range(1001)],
+                                   follow=range(10),
+                                   locations=['-122.75,36.8,-121.75,37.8'])
+    assert len(changed) == 1
+
+
+def test_sharded_update_local_filter():
+    """A local filter made from the parameters follows them"""
+    stream = ShardedFilterStream(auth=BASIC_AUTH, track=['old'],
+                                 local_filter=True)
+    stream.update_filter(track=['new'])
+    assert stream.local_filter.phrases == [['new']]
+
+
+def test_sharded_merge_and_dedupe():
+    """Tweets arriving on several shards are returned once"""
+    def numbered(n):
+        return single_tweet.replace('2190767504', str(n))
+
+    def tweetsource():
+        for n in range(5):
+            yield numbered(n)
+
+    with test_server(response=tweetsource) as server:
+        stream = ShardedFilterStream(auth=BASIC_AUTH, shards=3,
+                                     track=['a', 'b', 'c', 'd', 'e', 'f'],
+                                     url=server.baseurl,
+                                     schedules=fast_schedules)
+        assert len([s for s in stream.shards if s.stream]) == 3
+        ids = []
+        with stream:
+            for tweet in stream:
+                ids.append(tweet['id'])
+                if len(ids) == 5:
+                    break
+            assert sorted(ids) == list(range(5))
+            assert stream.count == 5
+        assert not stream.connected
+    assert all(s['received'] >= 1 for s in stream.stats())
+
+
+def test_sharded_fatal_error():
+    with test_server(status=404) as server:
+        stream = ShardedFilterStream(auth=BASIC_AUTH, shards=2,
+                                     track=['a', 'b', 'c', 'd'],
+                                     url=server.baseurl)
+        with raises(FatalError):
+            next(stream)
+    assert not stream.connected
+
+
+@parameterized(streamtypes)
+def test_metrics(cls, args, kwargs):
+    def tweetsource():
+        yield "\r\n"
+        yield single_tweet
+        yield delete_message
+        yield "\r\n"
+        yield single_tweet
+
+    with test_server(response=tweetsource) as server:
+        stream = cls(url=server.baseurl, *args, **kwargs)
+        with raises(ConnectionError):
+            for tweet in stream:
+                pass
+
+    metrics = stream.metrics
+    assert metrics.messages == 3
+    assert metrics.keepalives == 2
+    assert metrics.types == {'tweet': 2, 'delete': 1}
+    assert metrics.connects == 1 and metrics.reconnects == 0
+    assert metrics.bytes == 2 * len(single_tweet.encode('utf-8')) + \
+        len(delete_message) + 4
+    assert metrics.since_last_byte() >= 0
+    assert metrics.parse_latency.count >= 1
+
+    snapshot = metrics.snapshot()
+    assert snapshot['types'] == {'tweet': 2, 'delete': 1}
+    assert set(snapshot['message_rate']) == set(metrics.windows)
+    text = metrics.prometheus(labels={'stream': 'test'})
+    assert 'tweetstream_messages_total{stream="test",type="tweet"} 2.0\n' in text
+    assert 'tweetstream_parse_seconds_count{stream="test"}' in text
+
+
+def test_rate():
+    def tweetsource():
+        for n in range(4):
+            yield single_tweet
+            time.sleep(0.1)
+
+    with test_server(response=tweetsource) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl)
+        stream.rate_period = 0.05
+        with raises(ConnectionError):
+            for tweet in stream:
+                pass
+    assert 0 < stream.rate < 100
+
+
+def test_rate_window():
+    window = RateWindow(10)
+    for second in range(100, 105):
+        window.add(second - 100, second + 0.5)
+    assert window.rate(4, now=105) == (1 + 2 + 3 + 4) / 4.0
+    assert window.rate(2, now=106) == 4 / 2.0
+    assert window.rate(2, now=107) == 0
+    window.add(10, 120)
+    assert window.rate(5, now=121) == 2.0
+
+
+def stalling_source():
+    yield single_tweet
+    time.sleep(0.2)
+    yield "\r\n"
+    time.sleep(0.2)
+    yield single_tweet
+    time.sleep(2)
+    yield single_tweet
+
+
+@parameterized(streamtypes)
+def test_stall_watchdog(cls, args, kwargs):
+    """A stream is dropped once keep-alives stop arriving, well before the
+    socket timeout"""
+    with test_server(response=stalling_source) as server:
+        stream = cls(url=server.baseurl, keepalive_interval=0.3,
+                     missed_keepalives=1, *args, **kwargs)
+        assert stream.stall_timeout == pytest.approx(0.36)
+        tweets = []
+        start = time.time()
+        with raises(ReconnectImmediatelyError) as excinfo:
+            for tweet in stream:
+                tweets.append(tweet)
+    assert len(tweets) == 2
+    assert time.time() - start < 1.5
+    assert 'stalled' in excinfo.value.reason
+    assert stream.metrics.stalls == 1
+    assert not stream.connected
+
+
+def test_read_timeout():
+    """Without the watchdog, the read timeout still raises a tweetstream
+    error"""
+    with test_server(response=stalling_source) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl,
+                              timeout=0.5, missed_keepalives=None)
+        assert stream.stall_timeout is None
+        with raises(ReconnectImmediatelyError) as excinfo:
+            for tweet in stream:
+                pass
+    assert excinfo.value.reason == "Stream timed out."
+    assert stream.metrics.stalls == 0
+
+
+@parameterized(streamtypes)
+@pytest.mark.parametrize('compression', [False, True])
+def test_compression(cls, args, kwargs, compression):
+    """Compressed streams are decompressed incrementally, and only asked
+    for when compression is on"""
+    def tweetsource():
+        for n in range(20):
+            yield single_tweet
+            yield "\r\n"
+
+    with test_server(response=tweetsource, compress=True) as server:
+        stream = cls(url=server.baseurl, compression=compression,
+                     *args, **kwargs)
+        tweets = []
+        with raises(ConnectionError):
+            for tweet in stream:
+                tweets.append(tweet)
+    assert len(tweets) == 20
+    assert tweets[0]['id'] == 2190767504
+    metrics = stream.metrics
+    assert metrics.keepalives == 20
+    if compression:
+        assert metrics.wire_bytes * 2 < metrics.bytes
+    else:
+        assert metrics.wire_bytes == metrics.bytes
+
+
+def test_compression_latency():
+    """Each message is delivered as soon as its compressed bytes arrive"""
+    def tweetsource():
+        yield single_tweet
+        time.sleep(1)
+        yield single_tweet
+
+    with test_server(response=tweetsource, compress=True) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl,
+                              compression=True)
+        start = time.time()
+        next(stream)
+        assert time.time() - start < 0.5
+        stream.close()
+
+
+def test_bad_compressed_data():
+    with test_server(response=[single_tweet],
+                     headers=[('Content-Encoding', 'gzip')]) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl,
+                              compression=True)
+        with raises(ReconnectImmediatelyError) as excinfo:
+            next(stream)
+    assert excinfo.value.reason == "Got invalid data from twitter"
+
+
+@parameterized(streamtypes)
+def test_record_and_replay(cls, args, kwargs, tmpdir):
+    path = str(tmpdir.join('archive'))
+    with test_server(response=[single_tweet, "\r\n", delete_message,
+                               single_tweet]) as server:
+        stream = cls(url=server.baseurl, record=path, *args, **kwargs)
+        recorded = []
+        with raises(ConnectionError):
+            for tweet in stream:
+                recorded.append(tweet)
+        stream.close()
+
+    replay = ReplayStream(path)
+    assert list(replay) == recorded
+    assert replay.count == 2
+    assert replay.metrics.types == {'tweet': 2, 'delete': 1}
+    assert not replay.connected
+
+    raw = list(ReplayStream(path, parse_json=False, decode_unicode=False))
+    assert raw == [single_tweet.encode('utf-8')[:-2],
+                   delete_message.encode('utf-8')[:-2],
+                   single_tweet.encode('utf-8')[:-2]]
+    batches = list(ReplayStream(path, drop=['delete']).iter_batches(
+        max_items=10))
+    assert batches == [[recorded[0], recorded[2]]]
+
+
+def make_archive(path, segments=3, per_segment=5):
+    """Archive of segments ten seconds apart, one message per second"""
+    writer = ArchiveWriter(path, segment_seconds=10)
+    for n in range(segments * per_segment):
+        segment, offset = divmod(n, per_segment)
+        writer.write([('{"id":%d}' % n).encode('utf-8')],
+                     1000 + segment * 10 + offset)
+    writer.close()
+    return writer
+
+
+def test_archive_segments_and_seek(tmpdir):
+    path = str(tmpdir.join('archive'))
+    make_archive(path)
+    reader = ArchiveReader(path)
+    segments = reader.segments
+    assert [(s['start'], s['end'], s['count']) for s in segments] == [
+        (1000, 1004, 5), (1010, 1014, 5), (1020, 1024, 5)]
+
+    # Segments before the one seeked to are never opened
+    with open(os.path.join(path, segments[0]['segment']), 'wb') as f:
+        f.write(b'not gzip')
+    stream = ReplayStream(path, start=1012, end=1022)
+    assert [t['id'] for t in stream] == [7, 8, 9, 10, 11]
+
+    stream.seek(1020)
+    assert [t['id'] for t in stream] == [10, 11]
+
+    stream = ReplayStream(path, start=1013)
+    ids = []
+    for tweet in stream:
+        ids.append(tweet['id'])
+        if len(ids) == 7:
+            stream.seek(1023)
+    assert ids == [8, 9, 10, 11, 12, 13, 14, 13, 14]
+
+
+def test_archive_appends_and_reads_unfinished_segments(tmpdir):
+    path = str(tmpdir.join('archive'))
+    make_archive(path, segments=1)
+    writer = ArchiveWriter(path)
+    writer.write([b'{"id":5}', b'{"id":6}'], 2000)
+    writer.flush()
+    # The second segment isn't in the index yet, but is still read
+    assert [t['id'] for t in ReplayStream(path)] == list(range(7))
+    writer.close()
+    assert [s['segment'] for s in ArchiveReader(path).segments] == [
+        'segment-000001.gz', 'segment-000002.gz']
+
+
+def test_replay_speed(tmpdir):
+    path = str(tmpdir.join('archive'))
+    writer = ArchiveWriter(path)
+    for n in range(3):
+        writer.write([b'{"id":1}'], 1000 + n)
+    writer.close()
+
+    start = time.time()
+    assert len(list(ReplayStream(path, speed=10))) == 3
+    assert 0.18 < time.time() - start < 1
+    start = time.time()
+    assert len(list(ReplayStream(path))) == 3
+    assert time.time() - start < 0.1
+    with raises(ValueError):
+        ReplayStream(path, speed=0)
+
+
+@parameterized(streamtypes)
+@pytest.mark.parametrize('delimited', [None, 'length'])
+def test_split_chunks(cls, args, kwargs, delimited):
+    """Messages cut at arbitrary points, including between the \\r and \\n
+    of a delimiter, are reassembled"""
+    messages = [single_tweet.encode('utf-8')[:-2], delete_message.encode(
+        'utf-8')[:-2]]
+    with firehose_server(messages, count=50, keepalive_every=5,
+                         chunk_sizes=(7, 1000, 3, 2000), split_crlf=True,
+                         disconnect_after=40,
+                         delimited=delimited) as server:
+        stream = cls(url=server.baseurl, delimited=delimited,
+                     *args, **kwargs)
+        tweets = []
+        with raises(ConnectionError):
+            for tweet in stream:
+                tweets.append(tweet)
+    assert len(tweets) == 40
+    assert tweets[38]['id'] == 2190767504
+    assert tweets[39]['delete']['status']['id'] == 1234
+    assert stream.metrics.keepalives == 7
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_pipeline(ordered):
+    tweets = [single_tweet.replace('2190767504', str(n)) for n in range(300)]
+    source = tweets[:100] + [delete_message, "\r\n"] + tweets[100:]
+
+    with test_server(response=source) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl)
+        deletes = []
+        stream.on('delete', deletes.append)
+        received = []
+        with raises(ConnectionError) as excinfo:
+            with Pipeline(stream, workers=2, ordered=ordered,
+                          batch_size=16) as pipeline:
+                for tweet in pipeline:
+                    received.append(tweet['id'])
+    assert excinfo.value.reason == "Server disconnected."
+    if ordered:
+        assert received == list(range(300))
+    else:
+        assert sorted(received) == list(range(300))
+    assert len(deletes) == 1
+    assert stream.count == 300
+    assert stream.metrics.types == {'tweet': 300, 'delete': 1}
+    assert not stream.connected
+
+
+def test_pipeline_invalid_data():
+    source = [single_tweet] * 3 + ['{"text": "broken\r\n'] + [single_tweet]
+    with test_server(response=source) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl)
+        received = []
+        with raises(ReconnectImmediatelyError) as excinfo:
+            for tweet in Pipeline(stream, workers=1):
+                received.append(tweet)
+    assert excinfo.value.reason == "Got invalid data from twitter"
+    assert excinfo.value.details == b'{"text": "broken'
+    assert len(received) == 3
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_pipeline_filter_and_fields(lazy):
+    other = single_tweet.replace('amazing', 'boring').replace(
+        '2190767504', '1')
+    with test_server(response=[other, single_tweet, other]) as server:
+        stream = FilterStream(auth=BASIC_AUTH, url=server.baseurl,
+                              track=['amazing'], local_filter=True,
+                              fields=['id', 'user.screen_name'], lazy=lazy)
+        with raises(ConnectionError):
+            received = []
+            for tweet in Pipeline(stream, workers=1):
+                received.append(tweet)
+    assert len(received) == 1
+    assert received[0]['id'] == 2190767504
+    assert received[0].user_screen_name == 'eiriksnilsen'
+    assert stream.metrics.types == {'tweet': 3}
+
+
+def test_pipeline_ring():
+    ring = _Ring(100)
+    try:
+        assert ring.alloc(40) == 0
+        assert ring.alloc(40) == 40
+        ring.free(0)
+        # Doesn't fit at the end, so wraps around to the freed space
+        assert ring.alloc(30) == 0
+        ring.free(40)
+        assert ring.alloc(60) == 30
+        with raises(ValueError):
+            ring.alloc(101)
+        ring.stop()
+        assert ring.alloc(10) is None
+    finally:
+        ring.close()
+
+
+def hub_source(count=20):
+    def source():
+        for n in range(count):
+            yield single_tweet.replace('2190767504', str(n))
+            if n % 5 == 0:
+                yield delete_message
+                yield limit_message
+        time.sleep(2)
+    return source
+
+
+def test_hub_fanout():
+    with test_server(response=hub_source()) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl)
+        handled = []
+        stream.on('limit', handled.append)
+        hub = Hub(stream)
+        tweets = hub.subscribe()
+        even = hub.subscribe(lambda tweet: tweet['id'] % 2 == 0)
+        deletes = hub.subscribe(types=['delete'])
+        everything = hub.subscribe(types=['tweet', 'delete'])
+        with hub:
+            received = [tweets.get(timeout=5) for n in range(20)]
+            evens = [even.get(timeout=5) for n in range(10)]
+            assert len([deletes.get(timeout=5) for n in range(4)]) == 4
+            assert len([everything.get(timeout=5) for n in range(24)]) == 24
+            with raises(Empty):
+                tweets.get(timeout=0.1)
+
+            # Adding and removing subscriptions leaves the connection alone
+            late = hub.subscribe()
+            tweets.close()
+            assert list(tweets) == []
+            late.close()
+            assert stream.metrics.connects == 1
+            assert len(hub.subscriptions) == 3
+    assert [t['id'] for t in received] == list(range(20))
+    # Each message is parsed once and shared
+    assert evens == received[::2]
+    assert all(a is b for a, b in zip(evens, received[::2]))
+    assert stream.count == 20
+    assert list(even) == []
+    # Handlers get their messages even though no subscription wants them
+    assert handled == [{'limit': {'track': 1234}}] * 4
+
+
+def test_hub_slow_subscriber():
+    with test_server(response=hub_source(50)) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl)
+        hub = Hub(stream)
+        slow = hub.subscribe(maxsize=5)
+        newest = hub.subscribe(maxsize=5, policy='drop_newest')
+        fast = hub.subscribe()
+        failing = hub.subscribe(lambda tweet: tweet['id'] < 3 or 1 / 0)
+        with hub:
+            assert len([fast.get(timeout=5) for n in range(50)]) == 50
+            assert [failing.get()['id'] for n in range(3)] == [0, 1, 2]
+            with raises(ZeroDivisionError):
+                failing.get()
+            assert failing not in hub.subscriptions
+            assert [t['id'] for t in slow._queue] == [45, 46, 47, 48, 49]
+            assert [t['id'] for t in newest._queue] == [0, 1, 2, 3, 4]
+    assert slow.dropped == 45 and slow.delivered == 50
+    assert newest.dropped == 45 and newest.delivered == 5
+    with raises(ValueError):
+        hub.subscribe(policy='spill')
+
+
+def test_hub_error():
+    with test_server(status=401) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl)
+        hub = Hub(stream, max_failures=1)
+        subscription = hub.subscribe()
+        hub.start()
+        with raises(AuthenticationError):
+            subscription.get(timeout=5)
+        hub.close()
+    assert isinstance(hub.error, AuthenticationError)
+    with raises(AuthenticationError):
+        hub.subscribe().get()
+
+
+def relay_source(messages, ready):
+    import itertools
+    connections = itertools.count()
+
+    def source():
+        ready.wait(5)
+        if next(connections) == 0:
+            for n, message in enumerate(messages):
+                yield message
+                if n % 100 == 99:
+                    time.sleep(0.01)
+        time.sleep(2)
+    return source
+
+
+def collect(stream, count):
+    """Read ``count`` messages from ``stream`` in a thread"""
+    import threading
+    received = []
+
+    def run():
+        for message in stream:
+            received.append(message)
+            if len(received) == count:
+                break
+        stream.close()
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread, received
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_relay():
+    import threading
+    other_tweet = single_tweet.replace('amazing', 'boring')
+    messages = [single_tweet, other_tweet, delete_message, other_tweet,
+                single_tweet]
+    ready = threading.Event()
+    with test_server(response=relay_source(messages, ready)) as server:
+        upstream = SampleStream(auth=BASIC_AUTH, url=server.baseurl,
+                                parse_json=False, decode_unicode=False)
+        with Relay(upstream) as relay:
+            everything = collect(SampleStream(url=relay.url), 5)
+            amazing = collect(FilterStream(track=['amazing'], url=relay.url,
+                                           delimited='length'), 3)
+            raw = collect(SampleStream(url=relay.url, transport='socket',
+                                       parse_json=False,
+                                       decode_unicode=False), 5)
+            wait_for(lambda: len(relay.clients) == 3)
+            ready.set()
+            for thread, received in (everything, amazing, raw):
+                thread.join(5)
+    assert [t.get('id') for t in everything[1]] == [2190767504] * 2 + \
+        [None] + [2190767504] * 2
+    # Messages that aren't tweets aren't filtered
+    assert amazing[1] == [json.loads(m) for m in messages[::2]]
+    assert raw[1] == [m.rstrip('\r\n').encode('utf-8') for m in messages]
+    assert upstream.count == 4
+    assert upstream.metrics.connects == 1
+
+
+def test_relay_slow_client():
+    import socket
+    import threading
+    ready = threading.Event()
+    with test_server(response=relay_source([single_tweet] * 4000, ready)) \
+            as server:
+        upstream = SampleStream(auth=BASIC_AUTH, url=server.baseurl,
+                                parse_json=False, decode_unicode=False)
+        with Relay(upstream, max_buffer=1 << 20) as relay:
+            fast = collect(SampleStream(url=relay.url, parse_json=False,
+                                        decode_unicode=False), 4000)
+            slow = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            slow.connect(relay.address)
+            slow.sendall(b"GET / HTTP/1.1\r\nHost: relay\r\n\r\n")
+            wait_for(lambda: len(relay.clients) == 2)
+            ready.set()
+            fast[0].join(10)
+            assert len(fast[1]) == 4000
+            wait_for(lambda: relay.slow_disconnects == 1)
+            assert not [c for c in relay.clients if c.slow]
+            slow.close()
+
+
+def test_relay_unix_socket(tmpdir):
+    import socket
+    import threading
+    ready = threading.Event()
+    path = str(tmpdir.join('relay.sock'))
+    with test_server(response=relay_source([single_tweet], ready)) as server:
+        upstream = SampleStream(auth=BASIC_AUTH, url=server.baseurl)
+        with Relay(upstream, path) as relay:
+            assert relay.url is None
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            client.sendall(b"GET /?delimited=length HTTP/1.1\r\n\r\n")
+            wait_for(lambda: len(relay.clients) == 1)
+            ready.set()
+            data = b""
+            while single_tweet.encode('utf-8') not in data:
+                chunk = client.recv(65536)
+                assert chunk
+                data += chunk
+            client.close()
+    assert data.startswith(b"HTTP/1.1 200 OK\r\n")
+    message = single_tweet.encode('utf-8')
+    assert str(len(message)).encode('ascii') + b"\r\n" + message in data
+    assert not os.path.exists(path)
+
+
+def test_relay_token():
+    import threading
+    ready = threading.Event()
+    with test_server(response=relay_source([single_tweet], ready)) as server:
+        upstream = SampleStream(auth=BASIC_AUTH, url=server.baseurl,
+                                parse_json=False, decode_unicode=False)
+        with Relay(upstream, token='secret') as relay:
+            for auth in (None, ('relay', 'wrong')):
+                with raises(AuthenticationError):
+                    next(SampleStream(url=relay.url, auth=auth))
+            thread, received = collect(
+                SampleStream(url=relay.url, auth=('relay', 'secret')), 1)
+            wait_for(lambda: len(relay.clients) == 1)
+            ready.set()
+            thread.join(5)
+    assert received[0]['id'] == 2190767504
+
+
+def test_relay_error():
+    with test_server(status=401) as server:
+        upstream = SampleStream(auth=BASIC_AUTH, url=server.baseurl)
+        relay = Relay(upstream, max_failures=1)
+        with raises(AuthenticationError):
+            relay.serve_forever()
+    assert isinstance(relay.error, AuthenticationError)
+    with raises(ConnectionError):
+        next(SampleStream(url=relay.url))
+
+
+def numbered_tweet(n, timestamp=None):
+    tweet = json.loads(single_tweet)
+    tweet['id'] = n
+    if timestamp is not None:
+        tweet['timestamp_ms'] = str(int(timestamp * 1000))
+    return json.dumps(tweet) + '\r\n'
+
+
+def test_catchup_count():
+    stream = FilterStream(auth=BASIC_AUTH, track=['foo'], catchup=5)
+    assert stream._prepare_client()[1]['count'] == 5
+    stream = SampleStream(auth=BASIC_AUTH)
+    assert 'count' not in stream._prepare_client()[1]
+
+
+def test_checkpoint_rate(tmpdir):
+    checkpoint = Checkpoint(str(tmpdir.join('checkpoint.json')), interval=0)
+    assert checkpoint.backfill(time.time()) == 0
+    start = 1500000000.0
+    for n in range(20):
+        line = numbered_tweet(n, start + n * 0.1).encode('utf-8')
+        # Arrival times are bunched up, but the tweets' own times are used
+        checkpoint.seen(line, start + 100)
+    assert checkpoint.last_id == 19
+    assert abs(checkpoint.rate - 10) < 1e-3
+    assert checkpoint.backfill(start + 105) == 50
+    assert checkpoint.backfill(start + 105, margin=1.2) == 60
+
+    again = Checkpoint(checkpoint.path)
+    assert (again.last_id, again.last_time) == (19, start + 100)
+    assert abs(again.rate - 10) < 1e-3
+
+
+def test_checkpoint_catchup(tmpdir):
+    path = str(tmpdir.join('checkpoint.json'))
+    with open(path, 'w') as f:
+        json.dump(dict(last_id=5, last_time=time.time() - 10, rate=2), f)
+
+    def tweetsource():
+        for n in range(1, 9):
+            yield numbered_tweet(n)
+
+    with test_server(response=tweetsource) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl,
+                              checkpoint=path)
+        assert stream._catchup() in (24, 25)
+        ids = []
+        with raises(ConnectionError):
+            for tweet in stream:
+                ids.append(tweet['id'])
+        assert ids == [6, 7, 8]
+        # Only as many tweets as were asked for are checked
+        stream._overlap = [5, 3]
+        lines = [numbered_tweet(n).encode('utf-8').rstrip()
+                 for n in (4, 6, 5, 5)]
+        assert stream._raw_block(lines).count(b'\r\n') == 2
+        stream.close()
+    assert stream.count == 5
+    assert stream.checkpoint.duplicates == 7
+    with open(path) as f:
+        assert json.load(f)['last_id'] == 5
+    # catchup caps the count asked for
+    with open(path, 'w') as f:
+        json.dump(dict(last_id=5, last_time=time.time() - 10, rate=2), f)
+    assert SampleStream(checkpoint=path, catchup=10)._catchup() == 10
+
+
+def sink_source():
+    for n in range(1, 4):
+        yield numbered_tweet(n)
+    yield delete_message
+
+
+@pytest.mark.parametrize('fields', [None, ['id', 'user.screen_name']])
+def test_jsonl_sink(tmpdir, fields):
+    path = str(tmpdir.join('out'))
+    with test_server(response=sink_source) as server:
+        if fields:
+            stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl,
+                                  fields=fields)
+        else:
+            stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl,
+                                  parse_json=False, decode_unicode=False)
+        with JSONLinesSink(path, rotate_bytes=2000, max_items=2) as sink:
+            with raises(ConnectionError):
+                sink.consume(stream)
+            assert sink.written == 4
+            assert sink.syncs >= 1
+    names = sorted(os.listdir(path))
+    # Files are rotated between batches
+    assert len(names) == (1 if fields else 2)
+    data = b''.join(open(os.path.join(path, name), 'rb').read()
+                    for name in names)
+    if fields:
+        assert [json.loads(line) for line in data.decode('utf-8').splitlines()] \
+            == [{'id': n, 'user.screen_name': 'eiriksnilsen'}
+                for n in range(1, 4)] + \
+            [{'id': None, 'user.screen_name': None}]
+    else:
+        # Raw messages are written exactly as received
+        assert data == ''.join(list(sink_source())).replace(
+            '\r\n', '\n').encode('utf-8')
+
+    # A new sink carries on after the existing files
+    with JSONLinesSink(path, max_latency=0.05) as sink:
+        sink.write(b'{"id":4}')
+        time.sleep(0.3)
+        assert sink.batches == 1
+        assert open(sink.filename, 'rb').read() == b'{"id":4}\n'
+    assert sink.filename.endswith('tweets-%06d.jsonl' % (len(names) + 1))
+    with raises(ValueError):
+        sink.write(b'{}')
+
+
+@pytest.mark.parametrize('raw', [True, False])
+def test_sqlite_sink(tmpdir, raw):
+    import sqlite3
+    path = str(tmpdir.join('tweets.db'))
+    with test_server(response=sink_source) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl,
+                              parse_json=not raw, decode_unicode=not raw)
+        with SQLiteSink(path, max_items=2) as sink:
+            with raises(ConnectionError):
+                sink.consume(stream)
+            sink.write_many([{'id': 5, 'text': 'five'}, b'{"id":6}'])
+    assert sink.written == 6
+    db = sqlite3.connect(path)
+    assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    rows = db.execute('SELECT id, type, message FROM tweets').fetchall()
+    assert [(tweet_id, message_type) for tweet_id, message_type, _ in rows] \
+        == [(1, 'tweet'), (2, 'tweet'), (3, 'tweet'), (None, 'delete'),
+            (5, 'tweet'), (6, 'tweet')]
+    assert json.loads(rows[0][2]) == json.loads(numbered_tweet(1))
+    assert db.execute("SELECT typeof(message) FROM tweets").fetchall() == \
+        [('text',)] * 6
+
+
+def test_iter_batches_columns():
+    with test_server(response=sink_source) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl)
+        blocks = []
+        with raises(ConnectionError):
+            for block in stream.iter_batches(
+                    max_items=3, max_latency=5,
+                    columns=['id', 'created_at', 'user.screen_name',
+                             ('user.followers_count', 'float')]):
+                blocks.append(block)
+
+    assert [len(block) for block in blocks] == [3, 1]
+    first, second = blocks
+    assert first['id'].values.tolist() == [1, 2, 3]
+    assert first['id'].values.itemsize == 8
+    assert first['created_at'][0] == 1245148814000
+    assert first['user.followers_count'][1] == 206.0
+    names = first['user.screen_name']
+    assert names.offsets.tolist() == [0, 12, 24, 36]
+    assert names.data == b"eiriksnilsen" * 3
+    assert list(second.types) == [TYPE_CODES['delete']]
+    assert list(second.rows()) == [(None, None, None, None)]
+    assert stream.count == 3
+
+    with raises(ValueError):
+        next(SampleStream(auth=BASIC_AUTH, parse_json=False).iter_batches(
+            columns=['id']))
+
+
+def test_columns_block():
+    tweet = json.loads(single_tweet)
+    columns = Columns(['id', 'text', 'truncated', 'user.verified_profile',
+                       ('user.location', 'int')])
+    block = columns.block([tweet, {'limit': {'track': 3}}])
+    assert list(block.types) == [TYPE_CODES['tweet'], TYPE_CODES['limit']]
+    assert [column.kind for column in block.columns] == [
+        'int', 'text', 'bool', 'text', 'int']
+    assert next(block.rows()) == (2190767504, tweet['text'], False, 'False',
+                                  None)
+    assert list(block['id'].valid) == [1, 0]
+    assert parse_time('Tue Jun 16 12:40:14 +0200 2009') == 1245148814000
+    assert parse_time('1245148814000') == 1245148814000
+    with raises(ValueError):
+        Columns(['id', ('text', 'blob')])
+
+    numpy = pytest.importorskip('numpy')
+    arrays = block.to_numpy()
+    assert arrays['id'].dtype == numpy.int64
+    assert arrays['text'][1][-5:].tobytes() == tweet['text'][-5:].encode(
+        'utf-8')
+
+
+def test_user_cache():
+    cache = UserCache(maxsize=2)
+    first, second = json.loads(single_tweet), json.loads(single_tweet)
+    first['lang'] = 'en'
+    second['lang'] = ''.join(['e', 'n'])
+    assert cache(first)['user'] is first['user']
+    assert cache(second)['user'] is first['user']
+    assert second['lang'] is first['lang']
+    assert cache.hits == 1 and cache.misses == 1
+    assert cache.bytes_saved > 1000
+
+    # Users whose counts change are still shared, with the cached copy
+    # brought up to date. Retweets are shared too.
+    changed = json.loads(single_tweet)
+    changed['user']['statuses_count'] += 1
+    retweet = json.loads(single_tweet)
+    retweet['user']['id'] = 1
+    retweet['retweeted_status'] = json.loads(json.dumps(changed))
+    assert cache(changed)['user'] is first['user']
+    assert first['user']['statuses_count'] == 507
+    assert cache(retweet)['retweeted_status']['user'] is first['user']
+    assert (cache.hits, cache.misses, cache.updates) == (2, 2, 1)
+    assert cache.hit_rate == 0.6
+
+    # The least recently seen user is forgotten first
+    other = json.loads(single_tweet)
+    other['user']['id'] = 2
+    cache(other)
+    assert len(cache) == 2
+    assert cache(json.loads(json.dumps(changed)))['user'] is first['user']
+    cache({'user': {'id': 1}})
+    assert cache.misses == 4
+    assert cache({'limit': {'track': 3}}) == {'limit': {'track': 3}}
+
+
+def test_user_cache_lru():
+    """Users seen many times in a row keep their place, and the order
+    kept for eviction stays bounded"""
+    cache = UserCache(maxsize=3)
+    for user_id in [1, 2, 3] + [1, 2] * 10 + [4, 3, 2, 4]:
+        cache({'user': {'id': user_id}})
+    assert (cache.hits, cache.misses) == (22, 5)
+    assert len(cache) == 3
+    assert len(cache._order) <= 6
+
+
+def test_user_cache_stream():
+    with test_server(response=sink_source) as server:
+        stream = SampleStream(auth=BASIC_AUTH, url=server.baseurl,
+                              user_cache=True)
+        tweets = []
+        with raises(ConnectionError):
+            for tweet in stream:
+                tweets.append(tweet)
+
+    assert len(tweets) == 4
+    assert tweets[0]['user'] is tweets[2]['user']
+    snapshot = stream.metrics.snapshot()['users']
+    assert (snapshot['hits'], snapshot['misses'], snapshot['size']) == (2, 1, 1)
+    assert 'tweetstream_user_cache_lookups_total{result="hit"} 2.0\n' in \
+        stream.metrics.prometheus()
+    with raises(ValueError):
+        SampleStream(auth=BASIC_AUTH, lazy=True, user_cache=True)
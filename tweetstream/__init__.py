@@ -13,9 +13,22 @@ USER_AGENT = "TweetStream %s" % __version__
 
 
 from .streamclasses import SampleStream, FilterStream
+from .buffering import BackgroundReader
+from .resilient import ResilientStream
+from .sharding import ShardedFilterStream
+from .replay import ReplayStream
+from .pipeline import Pipeline
+from .hub import Hub
+from .relay import Relay
 from .exceptions import (
     TweetStreamError, ConnectionError, ReconnectError,
     ReconnectImmediatelyError, ReconnectLinearlyError,
     ReconnectExponentiallyError, AuthenticationError,
     EnhanceYourCalmError, FatalError,
 )
+
+try:
+    from .asyncstreams import AsyncSampleStream, AsyncFilterStream
+except (ImportError, SyntaxError):
+    # asyncio streams need Python 3.6 or later
+    pass
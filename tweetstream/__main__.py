@@ -0,0 +1,84 @@
+"""Command line tools: ``python -m tweetstream relay --help``"""
+
+import os
+import sys
+import argparse
+
+from . import SampleStream, FilterStream, Relay
+
+
+def relay(args):
+    auth = args.auth or os.environ.get('TWEETSTREAM_AUTH')
+    options = dict(auth=tuple(auth.split(':', 1)) if auth else None,
+                   url=args.url, compression=args.compression,
+                   parse_json=False, decode_unicode=False)
+    parameters = dict((key, getattr(args, key).split(','))
+                      for key in ('track', 'follow', 'locations')
+                      if getattr(args, key))
+    if parameters:
+        stream = FilterStream(**dict(options, **parameters))
+    else:
+        stream = SampleStream(**options)
+
+    if args.unix:
+        address = args.unix
+    else:
+        host, _, port = args.listen.rpartition(':')
+        address = (host or '127.0.0.1', int(port))
+    token = args.token or os.environ.get('TWEETSTREAM_RELAY_TOKEN')
+    if token is None and not args.unix and \
+            address[0] not in ('127.0.0.1', 'localhost', '::1'):
+        sys.stderr.write('Warning: relaying to %s without a token lets '
+                         'anybody who can connect read the stream\n'
+                         % address[0])
+    server = Relay(stream, address, max_buffer=args.max_buffer, token=token)
+    sys.stderr.write('Relaying %s on %s\n' % (stream.url,
+                                              server.url or address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m tweetstream')
+    commands = parser.add_subparsers(dest='command')
+
+    parser_relay = commands.add_parser(
+        'relay', help='relay one Twitter stream to many clients')
+    parser_relay.add_argument('--listen', default='127.0.0.1:8080',
+                              help='host:port to listen on '
+                                   '(default %(default)s)')
+    parser_relay.add_argument('--unix',
+                              help='listen on this Unix socket instead')
+    parser_relay.add_argument('--auth',
+                              help='username:password for the upstream '
+                                   'stream. Prefer setting $TWEETSTREAM_AUTH, '
+                                   'as arguments show up in ps and shell '
+                                   'history')
+    parser_relay.add_argument('--token',
+                              help='password clients must send. Prefer '
+                                   'setting $TWEETSTREAM_RELAY_TOKEN')
+    parser_relay.add_argument('--url', help='upstream stream URL')
+    parser_relay.add_argument('--track',
+                              help='comma separated phrases to track')
+    parser_relay.add_argument('--follow', help='comma separated user ids')
+    parser_relay.add_argument('--locations',
+                              help='comma separated bounding boxes')
+    parser_relay.add_argument('--compression', action='store_true',
+                              help='ask for a gzip compressed upstream '
+                                   'stream')
+    parser_relay.add_argument('--max-buffer', type=int, default=8 << 20,
+                              help='bytes a client may fall behind by')
+    parser_relay.set_defaults(run=relay)
+
+    args = parser.parse_args(argv)
+    if not getattr(args, 'run', None):
+        parser.print_help()
+        return 2
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
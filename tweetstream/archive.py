@@ -0,0 +1,214 @@
+"""Recording raw stream messages to disk.
+
+An archive is a directory of gzip compressed segment files plus an index.
+Each segment holds a run of records, every one the time a message was
+received followed by its raw bytes::
+
+    segment-000001.gz
+    segment-000002.gz
+    index.jsonl
+
+A new segment is started every :attr:`ArchiveWriter.segment_seconds`, once
+a segment holds :attr:`ArchiveWriter.segment_bytes` of messages, and when
+the writer is closed. ``index.jsonl`` has a line for every finished segment
+with the times of its first and last records, so a reader can go straight
+to the segment holding a given time without decompressing the earlier ones.
+
+Pass ``record=path`` (or an :class:`ArchiveWriter`) to a stream to record
+everything it receives, and replay it with
+:class:`~tweetstream.replay.ReplayStream`.
+"""
+
+import os
+import re
+import json
+import gzip
+import time
+import struct
+import threading
+
+_record = struct.Struct('>dI')
+_segment_name = re.compile(r'^segment-(\d+)\.gz$')
+
+INDEX = 'index.jsonl'
+
+
+def _segment_number(name):
+    match = _segment_name.match(name)
+    return int(match.group(1)) if match else None
+
+
+class ArchiveWriter(object):
+    """Write messages with their receive times to an archive directory.
+
+    :param path: The archive directory, created if needed. Recording into an
+      existing archive adds new segments after the ones already there.
+    :keyword segment_seconds: Start a new segment after this many seconds.
+    :keyword segment_bytes: Start a new segment once this many bytes of
+      messages (before compression) have been written to the current one.
+    :keyword compresslevel: gzip compression level, 1 (fastest) to 9.
+
+    Writing is thread safe. :meth:`close` finishes the current segment; if
+    more messages are written afterwards a new segment is started, so a
+    stream can close its writer on every disconnect.
+    """
+
+    def __init__(self, path, segment_seconds=300, segment_bytes=64 << 20,
+                 compresslevel=6):
+        self.path = path
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.compresslevel = compresslevel
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        numbers = [_segment_number(name) for name in os.listdir(path)]
+        self._next = max([n for n in numbers if n is not None] or [0]) + 1
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._name = None
+        self._start = None
+        self._end = None
+        self._count = 0
+        self._bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *params):
+        self.close()
+        return False
+
+    def _open(self, now):
+        self._name = 'segment-%06d.gz' % self._next
+        self._next += 1
+        self._file = gzip.open(os.path.join(self.path, self._name), 'wb',
+                               self.compresslevel)
+        self._start = now
+        self._count = 0
+        self._bytes = 0
+
+    def _finish(self):
+        """Close the current segment and add it to the index"""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if self._count:
+            entry = dict(segment=self._name, start=self._start,
+                         end=self._end, count=self._count, bytes=self._bytes)
+            with open(os.path.join(self.path, INDEX), 'a') as index:
+                index.write(json.dumps(entry, sort_keys=True) + '\n')
+        else:
+            os.remove(os.path.join(self.path, self._name))
+
+    def write(self, messages, received=None):
+        """Record ``messages`` (raw bytes), all received at time
+        ``received``, by default now"""
+        if received is None:
+            received = time.time()
+        with self._lock:
+            if self._file is not None and (
+                    received - self._start >= self.segment_seconds or
+                    self._bytes >= self.segment_bytes):
+                self._finish()
+            if self._file is None:
+                self._open(received)
+            pack = _record.pack
+            out = []
+            size = 0
+            for message in messages:
+                out.append(pack(received, len(message)))
+                out.append(message)
+                size += len(message)
+            self._file.write(b''.join(out))
+            self._count += len(messages)
+            self._bytes += size
+            self._end = received
+
+    def flush(self):
+        """Push buffered records to the operating system"""
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        """Finish the current segment"""
+        with self._lock:
+            self._finish()
+
+
+class ArchiveReader(object):
+    """Read the records of an archive directory in order.
+
+    Segments missing from the index, such as one still being written or one
+    left behind by a crash, are read too, up to the last complete record.
+    """
+
+    def __init__(self, path):
+        if not os.path.isdir(path):
+            raise ValueError('No archive at %r' % (path,))
+        self.path = path
+
+    @property
+    def segments(self):
+        """List of index entries, in order, for all the segments. Entries of
+        segments that aren't in the index only have ``segment`` set."""
+        entries = {}
+        index = os.path.join(self.path, INDEX)
+        if os.path.exists(index):
+            with open(index) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        entry = json.loads(line)
+                        entries[entry['segment']] = entry
+        for name in os.listdir(self.path):
+            if _segment_number(name) is not None and name not in entries:
+                entries[name] = dict(segment=name, start=None, end=None)
+        return sorted(entries.values(),
+                      key=lambda entry: _segment_number(entry['segment']))
+
+    @property
+    def start(self):
+        """Time of the first record, if known from the index"""
+        for entry in self.segments:
+            return entry['start']
+
+    def _read_segment(self, name):
+        f = gzip.open(os.path.join(self.path, name), 'rb')
+        try:
+            while True:
+                try:
+                    header = f.read(_record.size)
+                    if len(header) < _record.size:
+                        return
+                    received, size = _record.unpack(header)
+                    message = f.read(size)
+                except (EOFError, IOError, OSError, struct.error):
+                    return  # segment cut short
+                if len(message) < size:
+                    return
+                yield received, message
+        finally:
+            f.close()
+
+    def records(self, start=None, end=None):
+        """Yield ``(received, message)`` pairs, optionally only those
+        received from ``start`` up to but not including ``end``.
+
+        Indexed segments ending before ``start`` are skipped without being
+        opened."""
+        for entry in self.segments:
+            if start is not None and entry['end'] is not None \
+                    and entry['end'] < start:
+                continue
+            if end is not None and entry['start'] is not None \
+                    and entry['start'] >= end:
+                return
+            for received, message in self._read_segment(entry['segment']):
+                if start is not None and received < start:
+                    continue
+                if end is not None and received >= end:
+                    return
+                yield received, message
@@ -0,0 +1,205 @@
+"""asyncio versions of the stream classes.
+
+These share request setup, framing, decoding and error handling with
+:class:`~tweetstream.streamclasses.BaseStream`, but talk HTTP over
+:func:`asyncio.open_connection` so a single event loop can drive many
+streams without threads::
+
+    async with AsyncSampleStream(auth=auth) as stream:
+        async for tweet in stream:
+            ...
+"""
+
+import asyncio
+import ssl
+import time
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+from .exceptions import ReconnectImmediatelyError, ReconnectExponentiallyError
+from .streamclasses import BaseStream, SampleStream, FilterStream, _SKIP
+from .transport import serialize_request, parse_response_head, ChunkedDecoder
+
+
+class AsyncBaseStream(BaseStream):
+    """Asynchronous counterpart of :class:`BaseStream`.
+
+    Accepts the same arguments. Iterate with ``async for``, use as an
+    ``async with`` context and ``await stream.close()`` when done. A
+    ``requests.Session`` passed in (or created) is only used to build and
+    authenticate the request, never to send it.
+    """
+
+    _reader = None
+    _body = None
+    _content_encoding = None
+    _aiter = None
+
+    def __iter__(self):
+        raise TypeError("%s must be iterated with 'async for'"
+                        % self.__class__.__name__)
+
+    def __enter__(self):
+        raise TypeError("%s must be used with 'async with'"
+                        % self.__class__.__name__)
+
+    def _read_lines(self):
+        raise TypeError("%s can't be read by blocking consumers"
+                        % self.__class__.__name__)
+
+    def iter_batches(self, *args, **kwargs):
+        raise TypeError("%s doesn't support iter_batches"
+                        % self.__class__.__name__)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *params):
+        await self.close()
+        return False
+
+    async def _init_conn(self):
+        """Open the connection to the twitter server"""
+        request = self._prepare_request()
+        url = urlsplit(request.url)
+        https = url.scheme == 'https'
+        port = url.port or (443 if https else 80)
+        context = ssl.create_default_context() if https else None
+
+        # As with the blocking streams, any failure to connect becomes a
+        # ReconnectExponentiallyError so clients can back off.
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(url.hostname, port, ssl=context),
+                self._timeout)
+            self._conn = writer
+            writer.write(serialize_request(request))
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"),
+                                          self._timeout)
+            status, reason, headers = parse_response_head(head)
+        except (OSError, ValueError, asyncio.TimeoutError,
+                asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            self._disconnect()
+            raise ReconnectExponentiallyError(str(e) or e.__class__.__name__)
+
+        if status >= 400:
+            self._disconnect()
+            self._raise_for_status(status, "%s %s for url: %s"
+                                   % (status, reason, self.url))
+
+        self._reader = reader
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            self._body = ChunkedDecoder()
+        else:
+            self._body = None
+        self._content_encoding = headers.get('content-encoding')
+        self.connected = True
+        self.metrics.connects += 1
+        if not self.starttime:
+            self.starttime = time.time()
+
+    async def _iter_chunks(self):
+        reader = self._reader
+        decoder = self._body
+        decompressor = self._decompressor(self._content_encoding)
+        metrics = self.metrics
+        chunk_size = self.chunk_size
+        timeout = self._read_timeout()[0]
+        while True:
+            data = await asyncio.wait_for(reader.read(chunk_size), timeout)
+            if not data:
+                break
+            if decoder is None:
+                pieces = [data]
+            else:
+                try:
+                    pieces = decoder.feed(data)
+                except ValueError as e:
+                    self._disconnect()
+                    raise ReconnectImmediatelyError(str(e))
+            for piece in pieces:
+                metrics.wire_bytes += len(piece)
+                if decompressor is not None:
+                    piece = self._decompress(decompressor, piece)
+                if piece:
+                    yield piece
+            if decoder is not None and decoder.error is not None:
+                self._disconnect()
+                raise ReconnectImmediatelyError(str(decoder.error))
+            if decoder is not None and decoder.done:
+                break
+        if decompressor is not None:
+            rest = decompressor.flush()
+            if rest:
+                yield rest
+
+    async def __aiter__(self):
+        if not self.connected:
+            await self._init_conn()
+        framer = self._make_framer()
+        try:
+            async for chunk in self._iter_chunks():
+                for line in self._frame(framer, chunk):
+                    tweet = self._process_line(line)
+                    if tweet is not _SKIP:
+                        yield tweet
+                if framer.error is not None:
+                    self._invalid_data(framer.error)
+        except asyncio.TimeoutError:
+            self._timed_out()
+        except OSError as e:
+            self._disconnect()
+            raise ReconnectImmediatelyError(str(e))
+
+        self._disconnect()
+        raise ReconnectImmediatelyError("Server disconnected.")
+
+    async def __anext__(self):
+        """Return the next available tweet."""
+        if self._aiter is None:
+            self._aiter = self.__aiter__()
+        return await self._aiter.__anext__()
+
+    async def close(self):
+        """
+        Close the connection to the streaming server.
+        """
+        writer = self._conn
+        self._disconnect()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.checkpoint is not None:
+            self.checkpoint.save()
+        if writer is not None:
+            try:
+                await writer.wait_closed()
+            except (OSError, AttributeError):
+                pass
+
+    def _disconnect(self):
+        self.connected = False
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+
+class AsyncSampleStream(AsyncBaseStream):
+    url = SampleStream.url
+
+
+class AsyncFilterStream(AsyncBaseStream, FilterStream):
+    url = FilterStream.url
+
+    def update_filter(self, track=None, follow=None, locations=None):
+        """Change the filter parameters used for the next connection. The
+        handover of :meth:`FilterStream.update_filter` needs a blocking
+        reader, so changing them while connected raises TypeError; close
+        the stream and iterate again instead."""
+        if self.connected:
+            raise TypeError("%s can't update the filter while connected"
+                            % self.__class__.__name__)
+        FilterStream.update_filter(self, track=track, follow=follow,
+                                   locations=locations)
@@ -0,0 +1,204 @@
+"""Reading a stream in a background thread.
+
+If a consumer stops pulling tweets for a while, nothing reads from the
+socket and Twitter eventually disconnects the stream as a slow client.
+:class:`BackgroundReader` keeps a dedicated thread reading messages into a
+bounded in-memory queue, while the consumer iterates over the queue::
+
+    with BackgroundReader(SampleStream(auth=auth), policy='spill') as reader:
+        for tweet in reader:
+            slow_database_write(tweet)
+
+Only framing happens in the reader thread. Messages are decoded and parsed by
+the consumer as it takes them from the queue, exactly as when iterating over
+the stream itself.
+"""
+
+import struct
+import tempfile
+import threading
+from collections import deque
+
+from .streamclasses import _SKIP
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+SPILL = 'spill'
+
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, SPILL)
+
+_length = struct.Struct('>I')
+
+
+class BackgroundReader(object):
+    """Iterate over a stream while a background thread reads from it.
+
+    :param stream: The stream to read, e.g. a :class:`SampleStream`.
+    :keyword maxsize: Maximum number of messages held in memory.
+    :keyword policy: What the reader thread does when the queue is full:
+      ``'block'`` stops reading until there is room, ``'drop_oldest'``
+      discards the oldest queued message, ``'drop_newest'`` discards the
+      message just received and ``'spill'`` writes messages to a temporary
+      file until the consumer catches up. Message order is kept in all
+      cases.
+    :keyword spill_dir: Directory for the spill file. Defaults to the system
+      temporary directory.
+
+    Errors in the reader thread, including the exceptions for disconnects,
+    are raised in the consumer once it has taken every message received
+    before them.
+
+    .. attribute:: dropped
+
+        Number of messages discarded because the queue was full.
+
+    .. attribute:: spilled
+
+        Total number of messages written to the spill file.
+
+    .. attribute:: spill_size
+
+        Bytes currently in the spill file waiting to be read.
+    """
+
+    def __init__(self, stream, maxsize=10000, policy=BLOCK, spill_dir=None):
+        if policy not in POLICIES:
+            raise ValueError('policy must be one of %s' % ', '.join(POLICIES))
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        self.stream = stream
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.spilled = 0
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._error = None
+        self._stopped = False
+        self._thread = None
+
+        self._spill_dir = spill_dir
+        self._spill = None
+        self._spill_read = 0
+        self._spill_write = 0
+        self._spill_records = 0
+
+    @property
+    def depth(self):
+        """Number of messages waiting, in memory and in the spill file"""
+        with self._cond:
+            return len(self._queue) + self._spill_records
+
+    @property
+    def spill_size(self):
+        return self._spill_write - self._spill_read
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *params):
+        self.close()
+        return False
+
+    def start(self):
+        """Start the reader thread. Called on first iteration if needed."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        try:
+            for line in self.stream._read_lines():
+                if self._stopped:
+                    return
+                self._put(line)
+        except Exception as e:
+            with self._cond:
+                self._error = e
+                self._cond.notify_all()
+
+    def _put(self, line):
+        with self._cond:
+            queue = self._queue
+            if self._stopped:
+                return
+            if self._spill_records:
+                # Once spilling, everything goes to disk until the consumer
+                # has caught up, to keep messages in order.
+                self._spill_line(line)
+            elif len(queue) < self.maxsize:
+                queue.append(line)
+            elif self.policy == BLOCK:
+                while len(queue) >= self.maxsize and not self._stopped:
+                    self._cond.wait()
+                queue.append(line)
+            elif self.policy == DROP_OLDEST:
+                queue.popleft()
+                queue.append(line)
+                self.dropped += 1
+            elif self.policy == DROP_NEWEST:
+                self.dropped += 1
+                return
+            else:
+                self._spill_line(line)
+            self._cond.notify_all()
+
+    def _spill_line(self, line):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile(dir=self._spill_dir)
+        self._spill.seek(self._spill_write)
+        self._spill.write(_length.pack(len(line)))
+        self._spill.write(line)
+        self._spill_write = self._spill.tell()
+        self._spill_records += 1
+        self.spilled += 1
+
+    def _unspill_line(self):
+        spill = self._spill
+        spill.seek(self._spill_read)
+        size, = _length.unpack(spill.read(_length.size))
+        line = spill.read(size)
+        self._spill_read = spill.tell()
+        self._spill_records -= 1
+        if not self._spill_records:
+            spill.seek(0)
+            spill.truncate()
+            self._spill_read = self._spill_write = 0
+        return line
+
+    def _get(self):
+        with self._cond:
+            while True:
+                if self._queue:
+                    line = self._queue.popleft()
+                    self._cond.notify_all()
+                    return line
+                if self._spill_records:
+                    return self._unspill_line()
+                if self._error is not None:
+                    raise self._error
+                self._cond.wait()
+
+    def __iter__(self):
+        self.start()
+        stream = self.stream
+        while True:
+            tweet = stream._process_line(self._get())
+            if tweet is not _SKIP:
+                yield tweet
+
+    def close(self):
+        """Stop the reader thread and close the stream"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self.stream.close()
+        if self._thread is not None:
+            self._thread.join(1)
+        with self._cond:
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
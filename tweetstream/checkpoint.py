@@ -0,0 +1,151 @@
+"""Remembering where a stream got to, for catching up after gaps.
+
+Twitter can send recent tweets again when a stream connects, if asked for
+a ``count`` of them. A fixed count either loses tweets after long gaps or
+wastes bandwidth on short ones. A :class:`Checkpoint` keeps the id and
+arrival time of the last tweet received, and the stream's tweet rate, in a
+small JSON file, so that a stream given one can ask for just enough tweets
+to cover the time it was away, even across restarts::
+
+    stream = FilterStream(auth=auth, track=words, checkpoint='stream.json')
+
+The tweets sent again that had already been received before the gap are
+recognised by id and removed. See the ``checkpoint`` argument of
+:class:`~tweetstream.streamclasses.BaseStream`.
+"""
+
+import os
+import json
+import math
+import time
+
+from .decoders import get_decoder
+
+
+class Checkpoint(object):
+    """The position of a stream, saved to a file.
+
+    :param path: The file. It is read if it exists, and replaced
+      atomically on every save.
+    :keyword interval: Minimum number of seconds between saves.
+    :keyword decoder: JSON decoder for reading tweet ids, as for
+      :class:`~tweetstream.SampleStream`.
+
+    Only one tweet per save is parsed, so keeping a checkpoint costs next
+    to nothing even on streams that aren't otherwise parsed.
+
+    .. attribute:: last_id
+
+        Id of the last tweet received, as of the last save, or None.
+
+    .. attribute:: last_time
+
+        Time the last tweet was received, or None.
+
+    .. attribute:: rate
+
+        Smoothed number of tweets per second, or None until measured. Taken
+        from the tweets' ``timestamp_ms`` where they have one, so bursts of
+        tweets sent again don't distort it.
+
+    .. attribute:: duplicates
+
+        Number of tweets removed because they had been received before a
+        gap.
+    """
+
+    #: Weight of each new measurement in :attr:`rate`.
+    smoothing = 0.2
+
+    def __init__(self, path, interval=1.0, decoder=None):
+        self.path = path
+        self.interval = interval
+        self._decoder = get_decoder(decoder)
+        self.last_id = None
+        self.last_time = None
+        self.rate = None
+        self.duplicates = 0
+        self._line = None   # the last tweet, not yet read
+        self._seen = 0      # tweets since _mark
+        self._mark = None   # time of the tweet the rate is measured from
+        self._saved = 0
+        self.load()
+
+    def load(self):
+        """Read the file, if there is one"""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (IOError, OSError):
+            return
+        self.last_id = state.get('last_id')
+        self.last_time = state.get('last_time')
+        self.rate = state.get('rate')
+
+    def _read(self, line):
+        """The id and time of a raw tweet received at :attr:`last_time`"""
+        try:
+            tweet = self._decoder(line)
+            tweet_id = tweet.get('id')
+            timestamp = tweet.get('timestamp_ms')
+        except (ValueError, AttributeError):
+            return None, self.last_time
+        try:
+            return tweet_id, int(timestamp) / 1000.0
+        except (TypeError, ValueError):
+            return tweet_id, self.last_time
+
+    def tweet_id(self, line):
+        """The id of a raw tweet, or None"""
+        try:
+            return self._decoder(line).get('id')
+        except (ValueError, AttributeError):
+            return None
+
+    def seen(self, line, now):
+        """Note a tweet received at ``now``, saving if it's time to"""
+        self._line = line
+        self.last_time = now
+        self._seen += 1
+        if now - self._saved >= self.interval:
+            self.save(now)
+
+    def _update(self):
+        """Read the last tweet and fold the tweets since the previous one
+        read into :attr:`rate`"""
+        if self._line is None:
+            return
+        tweet_id, created = self._read(self._line)
+        self._line = None
+        if tweet_id is not None:
+            self.last_id = tweet_id
+        if self._mark is not None and created > self._mark:
+            sample = self._seen / (created - self._mark)
+            if self.rate is None:
+                self.rate = sample
+            else:
+                self.rate += self.smoothing * (sample - self.rate)
+        self._mark = created
+        self._seen = 0
+
+    def save(self, now=None):
+        """Write the checkpoint to its file"""
+        self._update()
+        self._saved = time.time() if now is None else now
+        state = dict(last_id=self.last_id, last_time=self.last_time,
+                     rate=self.rate)
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(state, f)
+        getattr(os, 'replace', os.rename)(temporary, self.path)
+
+    def backfill(self, now, margin=1.0):
+        """Number of tweets that arrived since the last one received, by
+        :attr:`rate`, times ``margin``. Called on connecting, and starts a
+        new rate measurement."""
+        self._update()
+        self._mark = None
+        if self.last_time is None or not self.rate:
+            return 0
+        return int(math.ceil(max(now - self.last_time, 0) * self.rate *
+                             margin))
@@ -0,0 +1,301 @@
+"""Batches of messages stored column by column.
+
+Analytics code usually wants a few fields of many tweets as arrays, not a
+dict per tweet. ``iter_batches(columns=...)`` returns each batch as a
+:class:`ColumnBlock` instead of a list, with one compact :mod:`array` per
+field::
+
+    for block in stream.iter_batches(columns=['id', 'created_at',
+                                              'user.screen_name']):
+        ids = block['id'].values                # 64 bit integer array
+        names = block['user.screen_name']       # offsets plus UTF-8 data
+        arrays = block.to_numpy()               # if numpy is installed
+
+A batch is parsed with a single decoder call and the projected values are
+copied straight into the columns, so no record or dict per tweet outlives
+the batch. Numeric columns hold 8 bytes a value, and text columns the
+UTF-8 bytes of the text plus an 8 byte offset, which is many times less
+than the parsed messages.
+
+Every message of the batch has a row, with its kind in
+:attr:`ColumnBlock.types`. Fields a message doesn't have are missing, as
+shown by the column's :attr:`~Column.valid` mask.
+"""
+
+import calendar
+from array import array
+
+from .messages import MESSAGE_TYPES, classify_object
+from .records import getter
+
+try:
+    text_type = unicode
+    string_types = basestring
+except NameError:  # Python 3
+    text_type = string_types = str
+
+
+def _int64_typecode():
+    """The :mod:`array` typecode of 64 bit integers, or None. ``'q'`` is
+    missing before Python 3.3, where ``'l'`` is 64 bits on most platforms."""
+    for typecode in ('q', 'l'):
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    return None
+
+
+INT64 = _int64_typecode()
+
+INT = 'int'
+FLOAT = 'float'
+BOOL = 'bool'
+TEXT = 'text'
+TIME = 'time'
+
+#: Column kinds, and the :mod:`array` typecode of each one's values.
+KINDS = {INT: INT64, FLOAT: 'd', BOOL: 'b', TEXT: None, TIME: INT64}
+
+# numpy dtypes of the typecodes
+_DTYPES = {INT64: 'i8', 'd': 'f8', 'b': 'i1'}
+
+#: Code in :attr:`ColumnBlock.types` of each message type.
+TYPE_CODES = dict((name, code) for code, name in enumerate(MESSAGE_TYPES))
+
+_BOOL_FIELDS = frozenset([
+    'truncated', 'favorited', 'retweeted', 'possibly_sensitive', 'verified',
+    'protected', 'is_quote_status', 'geo_enabled', 'default_profile',
+])
+
+_MONTHS = dict((name, n) for n, name in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct',
+     'Nov', 'Dec'], 1))
+
+
+def guess_kind(path):
+    """The kind of column for a field, going by Twitter's field names:
+    ids, counts and ``timestamp_ms`` are integers, ``created_at`` is a
+    time, the usual flags are booleans and anything else is text."""
+    name = path.rsplit('.', 1)[-1]
+    if name == 'created_at':
+        return TIME
+    if name in ('id', 'timestamp_ms') or name.endswith(('_id', '_count')):
+        return INT
+    if name in _BOOL_FIELDS:
+        return BOOL
+    return TEXT
+
+
+def parse_time(value):
+    """Milliseconds since the epoch of a Twitter ``created_at`` time such as
+    ``'Tue Jun 16 10:40:14 +0000 2009'``, or of a number of milliseconds"""
+    if not isinstance(value, string_types):
+        return int(value)
+    parts = value.split()
+    if len(parts) == 1:
+        return int(value)
+    hours, minutes, seconds = parts[3].split(':')
+    offset = int(parts[4])
+    offset = (offset // 100 * 60 + offset % 100 if offset >= 0 else
+              -((-offset) // 100 * 60 + (-offset) % 100))
+    timestamp = calendar.timegm((int(parts[5]), _MONTHS[parts[1]],
+                                 int(parts[2]), int(hours), int(minutes),
+                                 int(seconds), 0, 0, 0))
+    return (timestamp - offset * 60) * 1000
+
+
+class Column(object):
+    """Values of one field for every row of a :class:`ColumnBlock`.
+
+    .. attribute:: field
+
+        The dotted path of the field.
+
+    .. attribute:: kind
+
+        One of ``'int'``, ``'float'``, ``'bool'``, ``'time'`` (milliseconds
+        since the epoch) and ``'text'``.
+
+    .. attribute:: values
+
+        For all kinds but text, an :mod:`array` with a value per row, 0 where
+        the field is missing. Integers and times are 64 bit.
+
+    .. attribute:: valid
+
+        ``bytearray`` with 1 for the rows that have the field, 0 for the
+        others.
+    """
+
+    def __init__(self, field, kind, values, valid):
+        self.field = field
+        self.kind = kind
+        self.values = values
+        self.valid = valid
+
+    def __len__(self):
+        return len(self.valid)
+
+    def __getitem__(self, row):
+        if not self.valid[row]:
+            return None
+        value = self.values[row]
+        return bool(value) if self.kind == BOOL else value
+
+    def to_numpy(self):
+        """The values as a numpy array, sharing memory with :attr:`values`"""
+        import numpy
+        return numpy.frombuffer(self.values,
+                                dtype=_DTYPES[self.values.typecode])
+
+
+class TextColumn(Column):
+    """Text values of one field, stored as UTF-8 in one ``bytes`` object.
+
+    .. attribute:: offsets
+
+        :mod:`array` of 64 bit integers, one more offset than there are
+        rows. The text of
+        row ``n`` is ``data[offsets[n]:offsets[n + 1]]``.
+
+    .. attribute:: data
+
+        The UTF-8 encoded text of all the rows.
+    """
+
+    def __init__(self, field, offsets, data, valid):
+        Column.__init__(self, field, TEXT, None, valid)
+        self.offsets = offsets
+        self.data = data
+
+    def __getitem__(self, row):
+        if not self.valid[row]:
+            return None
+        return self.data[self.offsets[row]:self.offsets[row + 1]].decode(
+            'utf-8')
+
+    def to_numpy(self):
+        """The offsets and data as numpy arrays, sharing memory with
+        :attr:`offsets` and :attr:`data`"""
+        import numpy
+        return (numpy.frombuffer(self.offsets, dtype='i8'),
+                numpy.frombuffer(self.data, dtype='u1'))
+
+
+class ColumnBlock(object):
+    """A batch of messages stored column by column. Made by
+    :class:`Columns`.
+
+    Index it with a field path to get its :class:`Column`.
+
+    .. attribute:: types
+
+        ``array('b')`` with the message type code (see :data:`TYPE_CODES`)
+        of every row.
+
+    .. attribute:: columns
+
+        List of the :class:`Column` objects, in the order the fields were
+        given.
+    """
+
+    def __init__(self, types, columns):
+        self.types = types
+        self.columns = columns
+        self._by_field = dict((column.field, column) for column in columns)
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, field):
+        return self._by_field[field]
+
+    def rows(self):
+        """Iterate over the rows as tuples, for inspection and testing"""
+        for row in range(len(self)):
+            yield tuple(column[row] for column in self.columns)
+
+    def to_numpy(self):
+        """Dict of the columns as numpy arrays, sharing their memory. Text
+        columns are ``(offsets, data)`` pairs, and the type codes are under
+        ``'types'``. Needs numpy."""
+        import numpy
+        arrays = dict((column.field, column.to_numpy())
+                      for column in self.columns)
+        arrays['types'] = numpy.frombuffer(self.types, dtype='b')
+        return arrays
+
+
+class Columns(object):
+    """Builds :class:`ColumnBlock` objects from parsed messages.
+
+    :param fields: The fields to keep, each either a dotted path, whose kind
+      is guessed with :func:`guess_kind`, or a ``(path, kind)`` pair.
+    """
+
+    def __init__(self, fields):
+        if INT64 is None:
+            raise ValueError('Columns need 64 bit integer arrays, which this '
+                             'platform lacks.')
+        self.fields = []
+        self.kinds = []
+        for field in fields:
+            if isinstance(field, tuple):
+                path, kind = field
+            else:
+                path, kind = field, guess_kind(field)
+            if kind not in KINDS:
+                raise ValueError('Unknown column kind %r' % (kind,))
+            self.fields.append(path)
+            self.kinds.append(kind)
+        if not self.fields:
+            raise ValueError('At least one field is needed.')
+        if len(set(self.fields)) != len(self.fields):
+            raise ValueError('Duplicate fields in %r' % (self.fields,))
+        self._getters = [getter(path) for path in self.fields]
+
+    def block(self, messages, types=None):
+        """Make a block of parsed ``messages``, whose message types are
+        looked up unless given in ``types``"""
+        if types is None:
+            types = [classify_object(message) for message in messages]
+        codes = array('b', [TYPE_CODES[name] for name in types])
+        columns = []
+        for path, kind, get in zip(self.fields, self.kinds, self._getters):
+            values = [get(message) for message in messages]
+            valid = bytearray(value is not None for value in values)
+            if kind == TEXT:
+                offsets = array(INT64, [0])
+                parts = []
+                position = 0
+                for value in values:
+                    if value is not None:
+                        if not isinstance(value, bytes):
+                            value = text_type(value).encode('utf-8')
+                        parts.append(value)
+                        position += len(value)
+                    offsets.append(position)
+                columns.append(TextColumn(path, offsets, b"".join(parts),
+                                          valid))
+                continue
+            if kind == TIME:
+                convert = parse_time
+            elif kind == FLOAT:
+                convert = float
+            else:
+                convert = int
+            converted = []
+            for n, value in enumerate(values):
+                if value is None:
+                    converted.append(0)
+                    continue
+                try:
+                    converted.append(convert(value))
+                except (TypeError, ValueError, KeyError, IndexError):
+                    converted.append(0)
+                    valid[n] = 0
+            columns.append(Column(path, kind, array(KINDS[kind], converted),
+                                  valid))
+        return ColumnBlock(codes, columns)
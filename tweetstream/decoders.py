@@ -0,0 +1,69 @@
+"""JSON decoder backends for turning raw messages into Python objects.
+
+Every decoder is a callable taking the raw bytes of one message and returning
+the parsed object. Decoders signal invalid input by raising
+:class:`ValueError` (or its subclass :class:`UnicodeError` when the data isn't
+valid UTF-8).
+
+.. data:: decoders
+
+    List of ``(name, decoder)`` pairs for every backend that could be
+    imported, in order of preference.
+
+.. data:: default_decoder
+
+    The fastest available decoder, used unless a stream is given another.
+"""
+
+import json
+
+
+def json_loads(data):
+    """Decode with the standard library :mod:`json` module"""
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+decoders = []
+
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    decoders.append(('orjson', orjson.loads))
+
+try:
+    import simdjson
+except ImportError:
+    pass
+else:
+    decoders.append(('simdjson', simdjson.loads))
+
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    decoders.append(('ujson', ujson.loads))
+
+decoders.append(('json', json_loads))
+
+default_decoder = decoders[0][1]
+
+
+def get_decoder(decoder=None):
+    """Return a decoder callable.
+
+    :param decoder: None for :data:`default_decoder`, the name of one of the
+      :data:`decoders`, or any callable taking bytes.
+    """
+    if decoder is None:
+        return default_decoder
+    if callable(decoder):
+        return decoder
+    for name, loads in decoders:
+        if name == decoder:
+            return loads
+    raise ValueError('Unknown or unavailable JSON decoder %r' % (decoder,))
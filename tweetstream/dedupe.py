@@ -0,0 +1,31 @@
+"""Bounded memory duplicate detection"""
+
+from collections import deque
+
+
+class RecentIds(object):
+    """Set of the ``maxlen`` most recently added ids.
+
+    :meth:`add` returns True for ids that haven't been seen recently and
+    False for duplicates. When full, the oldest ids are forgotten first.
+    """
+
+    def __init__(self, maxlen=100000):
+        self.maxlen = maxlen
+        self._order = deque()
+        self._ids = set()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, item):
+        return item in self._ids
+
+    def add(self, item):
+        if item in self._ids:
+            return False
+        self._ids.add(item)
+        self._order.append(item)
+        if len(self._order) > self.maxlen:
+            self._ids.discard(self._order.popleft())
+        return True
@@ -0,0 +1,194 @@
+"""Splitting the raw byte stream from Twitter into individual messages"""
+
+try:
+    _view = memoryview
+    _tobytes = memoryview.tobytes
+except NameError:  # Python 2.6: slice the buffer itself, copying twice
+    def _view(data):
+        return data
+    _tobytes = bytes
+
+
+class LineFramer(object):
+    """Incrementally split a byte stream into ``\\r\\n`` delimited frames.
+
+    Chunks of any size are passed to :meth:`feed`, which returns the list of
+    complete frames they finished. Data is appended to a single reusable
+    ``bytearray`` and only the bytes that have not been searched before are
+    scanned for a delimiter, so the cost of framing is linear in the size of
+    the stream no matter how the data is chunked. Keep-alive lines (empty or
+    whitespace only) are dropped, and counted in :attr:`keepalives`.
+    """
+
+    delimiter = b"\r\n"
+
+    #: Never set, as any data can be split into lines. See
+    #: :attr:`LengthFramer.error`.
+    error = None
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._scan = 0
+        self.keepalives = 0
+
+    @property
+    def pending(self):
+        """Number of buffered bytes not yet part of a complete frame."""
+        return len(self._buf)
+
+    def feed(self, data):
+        """Add ``data`` to the buffer and return the completed frames."""
+        buf = self._buf
+        buf += data
+
+        end = buf.find(self.delimiter, self._scan)
+        if end < 0:
+            # A delimiter could straddle this chunk and the next one, so
+            # the final byte has to be searched again.
+            self._scan = max(len(buf) - 1, 0)
+            return []
+
+        frames = []
+        start = 0
+        view = _view(buf)
+        while end >= 0:
+            frame = _tobytes(view[start:end])
+            if frame and not frame.isspace():
+                frames.append(frame)
+            else:
+                self.keepalives += 1
+            start = end + 2
+            end = buf.find(self.delimiter, start)
+        del view
+
+        del buf[:start]
+        self._scan = max(len(buf) - 1, 0)
+        return frames
+
+    def reset(self):
+        """Throw away any partially received frame."""
+        del self._buf[:]
+        self._scan = 0
+
+
+class LengthFramer(object):
+    """Incrementally split a ``delimited=length`` byte stream into frames.
+
+    Each message is preceded by a line holding its length in bytes. Once the
+    length is known the message body is copied straight into a buffer of
+    exactly that size, so the body itself is never scanned for delimiters.
+    Messages contained entirely within one chunk are sliced out directly.
+    Blank keep-alive lines between messages are skipped and counted in
+    :attr:`keepalives`, and a length line that is not a plain decimal
+    number raises :class:`ValueError`.
+
+    .. attribute:: error
+
+        The :class:`ValueError` for invalid data found after complete
+        frames in the same chunk. The frames are returned, and the error
+        is raised by the next call to :meth:`feed`.
+    """
+
+    #: Length lines longer than this can't hold a sensible message size.
+    max_prefix = 16
+    #: Upper bound on a single message, guarding against garbage prefixes.
+    max_length = 16 * 1024 * 1024
+
+    def __init__(self):
+        self._prefix = bytearray()
+        self._frame = None
+        self._filled = 0
+        self.keepalives = 0
+        self.error = None
+
+    @property
+    def pending(self):
+        """Number of buffered bytes not yet part of a complete frame."""
+        return len(self._prefix) + self._filled
+
+    def _parse_length(self, line):
+        line = line.strip()
+        if not line:
+            return None
+        if not line.isdigit() or len(line) > self.max_prefix:
+            raise ValueError("Malformed length prefix %r" % bytes(line))
+        length = int(line)
+        if length > self.max_length:
+            raise ValueError("Length prefix %d too large" % length)
+        return length or None
+
+    @staticmethod
+    def _trim(frame, start, end):
+        if frame[end - 2:end] == b"\r\n":
+            end -= 2
+        return bytes(frame[start:end])
+
+    def feed(self, data):
+        """Add ``data`` to the buffer and return the completed frames."""
+        if self.error is not None:
+            raise self.error
+        if not isinstance(data, (bytes, bytearray)):
+            data = _tobytes(data)  # a memoryview, for find()
+        frames = []
+        try:
+            self._split(data, frames)
+        except ValueError as e:
+            if not frames:
+                raise
+            self.error = e
+        return frames
+
+    def _split(self, data, frames):
+        size = len(data)
+        pos = 0
+
+        while pos < size:
+            frame = self._frame
+            if frame is not None:
+                # Continue filling a message that started in an earlier chunk
+                take = min(len(frame) - self._filled, size - pos)
+                frame[self._filled:self._filled + take] = \
+                    _view(data)[pos:pos + take]
+                self._filled += take
+                pos += take
+                if self._filled == len(frame):
+                    body = self._trim(frame, 0, len(frame))
+                    if body and not body.isspace():
+                        frames.append(body)
+                    self._frame = None
+                    self._filled = 0
+                continue
+
+            end = data.find(b"\n", pos)
+            if end < 0:
+                self._prefix += data[pos:]
+                if len(self._prefix.strip()) > self.max_prefix:
+                    raise ValueError("Malformed length prefix %r"
+                                     % bytes(self._prefix))
+                break
+
+            if self._prefix:
+                self._prefix += data[pos:end]
+                length = self._parse_length(self._prefix)
+                del self._prefix[:]
+            else:
+                length = self._parse_length(data[pos:end])
+            pos = end + 1
+            if length is None:
+                self.keepalives += 1
+                continue
+
+            if size - pos >= length:
+                body = self._trim(data, pos, pos + length)
+                if body and not body.isspace():
+                    frames.append(body)
+                pos += length
+            else:
+                self._frame = bytearray(length)
+                self._filled = 0
+
+    def reset(self):
+        """Throw away any partially received frame."""
+        del self._prefix[:]
+        self._frame = None
+        self._filled = 0
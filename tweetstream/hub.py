@@ -0,0 +1,301 @@
+"""Sharing one stream between many consumers.
+
+Twitter limits the number of connections an account may have open, so
+several parts of a program that each want some of the same stream have to
+share one. :class:`Hub` reads a stream in a background thread and passes
+every message to the subscriptions that want it::
+
+    hub = Hub(SampleStream(auth=auth))
+    tweets = hub.subscribe()
+    english = hub.subscribe(lambda tweet: tweet.get('lang') == 'en')
+    deletes = hub.subscribe(types=['delete'], maxsize=100000)
+    hub.start()
+
+    for tweet in english:
+        ...
+
+Each message is decoded and parsed once, and the same object is given to
+every subscription it matches, so subscribers must not modify messages.
+Subscriptions can be added and removed at any time without affecting the
+connection, which is kept open, and reopened after errors following
+Twitter's backoff guidance, until the hub is closed.
+"""
+
+import time
+import threading
+from collections import deque
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from .streamclasses import _SKIP
+from .messages import TWEET
+from .buffering import BLOCK, DROP_OLDEST, DROP_NEWEST
+from .resilient import ResilientStream, DEFAULT_SCHEDULES
+
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+
+class Subscription(object):
+    """A hub subscriber's queue of messages. Made by :meth:`Hub.subscribe`.
+
+    Iterate over it to get messages, or call :meth:`get`. Iteration ends
+    once the subscription or hub is closed. If the hub gives up because of
+    an error, or the predicate raises an exception, it is raised after the
+    messages already queued.
+
+    .. attribute:: delivered
+
+        Number of messages queued for the subscriber.
+
+    .. attribute:: dropped
+
+        Number of messages discarded because the queue was full.
+    """
+
+    def __init__(self, hub, predicate, types, maxsize, policy):
+        self.hub = hub
+        self.predicate = predicate
+        self.types = types
+        self.maxsize = maxsize
+        self.policy = policy
+        self.delivered = 0
+        self.dropped = 0
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._error = None
+        self._closed = False
+
+    @property
+    def depth(self):
+        """Number of messages waiting to be taken"""
+        return len(self._queue)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def wants(self, message_type):
+        return self.types is None or message_type in self.types
+
+    def _offer(self, message):
+        """Queue ``message`` if it passes the predicate. Called by the hub
+        thread."""
+        if self.predicate is not None:
+            try:
+                if not self.predicate(message):
+                    return
+            except Exception as e:
+                self.hub._remove(self)
+                self._fail(e)
+                return
+        with self._cond:
+            queue = self._queue
+            if self._closed:
+                return
+            if len(queue) >= self.maxsize:
+                if self.policy == BLOCK:
+                    while len(queue) >= self.maxsize and not self._closed:
+                        self._cond.wait()
+                    if self._closed:
+                        return
+                elif self.policy == DROP_OLDEST:
+                    queue.popleft()
+                    self.dropped += 1
+                else:
+                    self.dropped += 1
+                    return
+            queue.append(message)
+            self.delivered += 1
+            self._cond.notify_all()
+
+    def _fail(self, error):
+        with self._cond:
+            if self._error is None:
+                self._error = error
+            self._cond.notify_all()
+
+    def _end(self):
+        with self._cond:
+            self._closed = True
+            self._queue.clear()
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """Return the next message, waiting up to ``timeout`` seconds, or
+        for ever if it's None. Raises :class:`queue.Empty` on timeout or if
+        the subscription is closed."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self._queue:
+                if self._error is not None:
+                    raise self._error
+                if self._closed:
+                    raise Empty()
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Empty()
+                    self._cond.wait(remaining)
+            message = self._queue.popleft()
+            self._cond.notify_all()
+            return message
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.get()
+            except Empty:
+                return
+
+    def close(self):
+        """Stop receiving messages"""
+        self.hub.unsubscribe(self)
+
+
+class Hub(object):
+    """Read one stream and fan its messages out to subscriptions.
+
+    :param stream: The stream to share, e.g. a :class:`SampleStream`. Its
+      ``drop`` list and local filter apply to all subscriptions, and its
+      handlers still take the messages they handle.
+    :keyword jitter, max_failures, schedules: Reconnection settings, see
+      :class:`~tweetstream.ResilientStream`. Errors the hub gives up on are
+      raised in every subscription.
+
+    Messages of types no subscription wants are not parsed.
+
+    .. attribute:: error
+
+        The error the hub gave up on, or None.
+    """
+
+    def __init__(self, stream, jitter=0.1, max_failures=None,
+                 schedules=DEFAULT_SCHEDULES):
+        self.stream = stream
+        self.supervisor = ResilientStream(stream, jitter=jitter,
+                                          max_failures=max_failures,
+                                          schedules=schedules)
+        self.error = None
+        self._subscriptions = ()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *params):
+        self.close()
+        return False
+
+    @property
+    def subscriptions(self):
+        return self._subscriptions
+
+    def subscribe(self, predicate=None, types=(TWEET,), maxsize=10000,
+                  policy=DROP_OLDEST):
+        """Add a subscription and return it.
+
+        :param predicate: Optional function taking a message and returning
+          True if the subscriber wants it. It is called in the hub's thread,
+          so should be quick.
+        :keyword types: Message types (see :mod:`tweetstream.messages`) to
+          receive, or None for all of them. The default is just tweets.
+        :keyword maxsize: Maximum number of messages waiting in the queue.
+        :keyword policy: What happens when the queue is full:
+          ``'drop_oldest'`` (the default) discards the oldest queued message,
+          ``'drop_newest'`` the new one. ``'block'`` waits for room, which
+          holds up every other subscription too.
+        """
+        if policy not in POLICIES:
+            raise ValueError('policy must be one of %s' % ', '.join(POLICIES))
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        if types is not None:
+            types = frozenset(types)
+            for message_type in types:
+                self.stream._check_message_type(message_type)
+        subscription = Subscription(self, predicate, types, maxsize, policy)
+        with self._lock:
+            if self.error is not None:
+                subscription._fail(self.error)
+            elif self._stopped:
+                subscription._end()
+            else:
+                self._subscriptions += (subscription,)
+        return subscription
+
+    def _remove(self, subscription):
+        with self._lock:
+            self._subscriptions = tuple(
+                s for s in self._subscriptions if s is not subscription)
+
+    def unsubscribe(self, subscription):
+        """Remove a subscription. Its iterators end."""
+        self._remove(subscription)
+        subscription._end()
+
+    def start(self):
+        """Start reading the stream. Subscriptions made before this receive
+        every message; later ones only those arriving after they are
+        made."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _messages(self, stream):
+        """Yield the subscriptions each message of one connection goes to,
+        and the message"""
+        for line in stream._read_lines():
+            message_type = stream._select(line)
+            if message_type is None:
+                continue
+            wanted = [s for s in self._subscriptions if s.wants(message_type)]
+            # Messages nobody wants are only parsed for the stream's handlers
+            if not wanted and not stream._handlers.get(message_type):
+                continue
+            parsed = None
+            if message_type == TWEET and stream.local_filter is not None:
+                parsed = stream._parse(line)
+                if not stream.local_filter.matches(parsed):
+                    continue
+            message = stream._deliver(message_type,
+                                      stream._convert(line, parsed))
+            if message is not _SKIP and wanted:
+                yield wanted, message
+
+    def _run(self):
+        try:
+            for wanted, message in self.supervisor._supervise(self._messages):
+                if self._stopped:
+                    return
+                for subscription in wanted:
+                    subscription._offer(message)
+        except Exception as e:
+            with self._lock:
+                self.error = e
+                subscriptions = self._subscriptions
+                self._subscriptions = ()
+            for subscription in subscriptions:
+                subscription._fail(e)
+
+    def close(self):
+        """Stop reading, close the stream and end every subscription"""
+        with self._lock:
+            self._stopped = True
+            subscriptions = self._subscriptions
+            self._subscriptions = ()
+        for subscription in subscriptions:
+            subscription._end()
+        self.supervisor.close()
+        if self._thread is not None and \
+                self._thread is not threading.current_thread():
+            self._thread.join(1)
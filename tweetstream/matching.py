@@ -0,0 +1,271 @@
+"""Local filtering of tweets on raw bytes, before they are parsed.
+
+:class:`LocalFilter` applies ``track``/``follow``/``locations`` criteria in
+two stages. :meth:`LocalFilter.candidate` runs on the raw message: all track
+terms and follow ids are compiled into one regular expression shaped like a
+trie, so a single pass over the bytes finds any of them, and point
+coordinates are pulled out with a regular expression and tested against the
+bounding boxes. Only candidates are parsed, and :meth:`LocalFilter.matches`
+then does an exact check on the parsed tweet to weed out false positives.
+
+Track phrases match, like Twitter's, when every space separated term of the
+phrase occurs in the tweet as a whole word, ignoring case: ``twitter``
+matches ``#Twitter`` and ``twitter.com`` but not ``TwitterTracker``. Terms
+are searched for in the text, hashtags, urls and mentioned screen names, of
+the tweet and of any tweet it retweets or quotes.
+"""
+from __future__ import unicode_literals
+
+import re
+import json
+
+#: Characters that lower case to a character (or two) without being its
+#: upper or title case
+_OTHER_CASES = {
+    '\u03b8': ('\u03f4',),  # theta
+    '\u00df': ('\u1e9e',),  # sharp s
+    '\u03c9': ('\u2126',),  # omega, from the ohm sign
+    'k': ('\u212a',),  # from the kelvin sign
+    '\u00e5': ('\u212b',),  # a with ring, from the angstrom sign
+    '\u03c2': ('\u03a3',),  # final sigma, from sigma at the end of a word
+    'i\u0307': ('\u0130',),  # from capital I with dot above
+}
+
+
+def _byte_keys(word):
+    return [re.escape(word[n:n + 1]) for n in range(len(word))]
+
+
+def _trie_pattern(words):
+    """Build a regex source matching any of ``words``, each a sequence of
+    regex sources (bytes) for one character, with common prefixes factored
+    out so the regex engine walks it like a trie."""
+    trie = {}
+    for word in words:
+        node = trie
+        for key in word:
+            node = node.setdefault(key, {})
+        node[None] = None
+
+    def pattern(node):
+        alternatives = [key + pattern(child)
+                        for key, child in sorted(
+                            (k, v) for k, v in node.items() if k is not None)]
+        if not alternatives:
+            return b''
+        optional = None in node
+        if len(alternatives) == 1 and not optional:
+            return alternatives[0]
+        group = b'(?:' + b'|'.join(alternatives) + b')'
+        return group + b'?' if optional else group
+
+    return pattern(trie)
+
+
+def _units(term):
+    """Split a term into the characters matched one at a time, keeping
+    surrogate pairs (on narrow Python 2 builds) and the two characters
+    :data:`_OTHER_CASES` has together"""
+    n = 0
+    while n < len(term):
+        unit = term[n:n + 2]
+        if not (unit in _OTHER_CASES or (
+                len(unit) == 2 and '\ud800' <= unit[0] <= '\udbff' and
+                '\udc00' <= unit[1] <= '\udfff')):
+            unit = term[n]
+        n += len(unit)
+        yield unit
+
+
+def _unit_pattern(unit):
+    """Regex source for a (lower case) character as it can appear in raw
+    JSON, in any case, as UTF-8 or as a \\u escape. ASCII letters are left
+    to re.IGNORECASE, which the raw bytes can't be lower cased with
+    otherwise."""
+    casings = set(casing for casing in (unit, unit.upper(), unit.title())
+                  if casing.lower() == unit)
+    casings.update(_OTHER_CASES.get(unit, ()))
+    forms = set()
+    for casing in casings:
+        forms.add(casing.encode('utf-8').lower())
+        forms.add(json.dumps(casing)[1:-1].encode('ascii').lower())
+        if casing == '/':
+            forms.add(b'\\/')
+    forms = sorted(re.escape(form) for form in forms)
+    if len(forms) == 1:
+        return forms[0]
+    return b'(?:' + b'|'.join(forms) + b')'
+
+
+_word = re.compile(r'\w+', re.UNICODE)
+
+
+def _word_search(term):
+    """Search function finding a (lower case) term as a whole word"""
+    return re.compile(r'(?<!\w)' + re.escape(term) + r'(?!\w)',
+                      re.UNICODE).search
+
+
+def _parse_boxes(locations):
+    values = []
+    for location in locations:
+        values.extend(float(v) for v in str(location).split(','))
+    if len(values) % 4:
+        raise ValueError('locations must be groups of four coordinates '
+                         '(south west longitude, latitude, north east '
+                         'longitude, latitude)')
+    return [tuple(values[n:n + 4]) for n in range(0, len(values), 4)]
+
+
+_point = re.compile(br'"coordinates"\s*:\s*\{\s*"type"\s*:\s*"Point"\s*,\s*'
+                    br'"coordinates"\s*:\s*\[\s*([-+0-9.eE]+)\s*,\s*'
+                    br'([-+0-9.eE]+)\s*\]')
+_place = re.compile(br'"bounding_box"\s*:\s*\{')
+
+
+def _in_box(lon, lat, box):
+    return box[0] <= lon <= box[2] and box[1] <= lat <= box[3]
+
+
+def _overlaps(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class LocalFilter(object):
+    """Filter tweets by track phrases, followed user ids and location
+    bounding boxes. A tweet passes if it satisfies any of the criteria.
+
+    :keyword track: Iterable of phrases.
+    :keyword follow: Iterable of user ids.
+    :keyword locations: Iterable of comma separated coordinates, in groups of
+      four making up bounding boxes, as for :class:`FilterStream`.
+
+    .. attribute:: checked
+
+        Number of raw messages checked by :meth:`candidate`.
+
+    .. attribute:: candidates
+
+        Number of those that were candidates and had to be parsed.
+
+    .. attribute:: matched
+
+        Number of candidates that passed the exact check.
+    """
+
+    def __init__(self, track=None, follow=None, locations=None):
+        self.phrases = [phrase.lower().split()
+                        for phrase in (track or ()) if phrase.strip()]
+        terms = set(term for phrase in self.phrases for term in phrase)
+        # Terms that are a single word are looked up among the words of the
+        # tweet, the others (with punctuation) searched for
+        self._searches = dict((term, _word_search(term)) for term in terms
+                              if _word.findall(term) != [term])
+        self.follow = frozenset(int(user_id) for user_id in (follow or ()))
+        self.boxes = _parse_boxes(locations or ())
+
+        self.checked = 0
+        self.candidates = 0
+        self.matched = 0
+
+        alternatives = []
+        if terms:
+            alternatives.append(_trie_pattern(
+                [_unit_pattern(unit) for unit in _units(term)]
+                for term in terms))
+        if self.follow:
+            ids = [_byte_keys(str(user_id).encode('ascii'))
+                   for user_id in self.follow]
+            alternatives.append(br'(?<![0-9])' + _trie_pattern(ids) +
+                                br'(?![0-9])')
+        if alternatives:
+            self._search = re.compile(b'|'.join(alternatives),
+                                      re.IGNORECASE).search
+        else:
+            self._search = None
+
+    def candidate(self, data):
+        """Cheap check on raw message bytes. False means the tweet certainly
+        doesn't match; True means it has to be parsed to find out."""
+        self.checked += 1
+        if self._search is not None and self._search(data) is not None:
+            self.candidates += 1
+            return True
+        if self.boxes:
+            point = _point.search(data)
+            if point is not None:
+                try:
+                    lon, lat = float(point.group(1)), float(point.group(2))
+                except ValueError:
+                    pass
+                else:
+                    if any(_in_box(lon, lat, box) for box in self.boxes):
+                        self.candidates += 1
+                        return True
+            if _place.search(data) is not None:
+                self.candidates += 1
+                return True
+        return False
+
+    def matches(self, tweet):
+        """Exact check on a parsed tweet"""
+        if not isinstance(tweet, dict):
+            return False
+        if ((self.phrases and self._matches_track(tweet)) or
+                (self.follow and self._matches_follow(tweet)) or
+                (self.boxes and self._matches_location(tweet))):
+            self.matched += 1
+            return True
+        return False
+
+    def _track_parts(self, tweet, parts):
+        """Add the text and entities track phrases are matched against, of
+        the tweet and the tweets it retweets or quotes, to ``parts``"""
+        extended = tweet.get('extended_tweet') or {}
+        parts.append(extended.get('full_text') or tweet.get('text') or '')
+        entities = extended.get('entities') or tweet.get('entities') or {}
+        parts.extend(h.get('text', '') for h in entities.get('hashtags', ()))
+        for url in entities.get('urls', ()):
+            parts.append(url.get('expanded_url') or '')
+            parts.append(url.get('display_url') or '')
+        parts.extend(m.get('screen_name', '')
+                     for m in entities.get('user_mentions', ()))
+        for key in ('retweeted_status', 'quoted_status'):
+            nested = tweet.get(key)
+            if isinstance(nested, dict):
+                self._track_parts(nested, parts)
+
+    def _matches_track(self, tweet):
+        parts = []
+        self._track_parts(tweet, parts)
+        haystack = ' '.join(p for p in parts if p).lower()
+        words = set(_word.findall(haystack))
+        searches = self._searches
+        return any(all(term in words or (term in searches and
+                                         searches[term](haystack) is not None)
+                       for term in phrase)
+                   for phrase in self.phrases)
+
+    def _matches_follow(self, tweet):
+        user_ids = [(tweet.get('user') or {}).get('id'),
+                    tweet.get('in_reply_to_user_id')]
+        retweeted = tweet.get('retweeted_status')
+        if retweeted:
+            user_ids.append((retweeted.get('user') or {}).get('id'))
+        return any(user_id in self.follow for user_id in user_ids
+                   if user_id is not None)
+
+    def _matches_location(self, tweet):
+        point = (tweet.get('coordinates') or {}).get('coordinates')
+        if point:
+            lon, lat = point[0], point[1]
+            return any(_in_box(lon, lat, box) for box in self.boxes)
+        bounding_box = ((tweet.get('place') or {}).get('bounding_box')
+                        or {}).get('coordinates')
+        if bounding_box:
+            corners = [c for polygon in bounding_box for c in polygon]
+            lons = [c[0] for c in corners]
+            lats = [c[1] for c in corners]
+            place = (min(lons), min(lats), max(lons), max(lats))
+            return any(_overlaps(place, box) for box in self.boxes)
+        return False
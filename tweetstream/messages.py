@@ -0,0 +1,59 @@
+"""Classifying streaming API messages without parsing them.
+
+Besides tweets, the streaming API sends a handful of control messages such
+as deletion notices and rate limit warnings. Each of them is a JSON object
+with a single top level key naming the kind of message, e.g.
+``{"delete":{"status":{...}}}``. :func:`classify` looks at the first key of
+the raw bytes to tell them apart, which is far cheaper than parsing.
+
+.. data:: MESSAGE_TYPES
+
+    All the message type names :func:`classify` can return.
+"""
+
+import re
+
+TWEET = 'tweet'
+DELETE = 'delete'
+SCRUB_GEO = 'scrub_geo'
+LIMIT = 'limit'
+STATUS_WITHHELD = 'status_withheld'
+USER_WITHHELD = 'user_withheld'
+DISCONNECT = 'disconnect'
+WARNING = 'warning'
+FRIENDS = 'friends'
+EVENT = 'event'
+UNKNOWN = 'unknown'
+
+_control_types = (DELETE, SCRUB_GEO, LIMIT, STATUS_WITHHELD, USER_WITHHELD,
+                  DISCONNECT, WARNING, FRIENDS, EVENT)
+
+MESSAGE_TYPES = (TWEET,) + _control_types + (UNKNOWN,)
+
+_by_key = dict((t.encode('ascii'), t) for t in _control_types)
+_by_text_key = dict((t, t) for t in _control_types)
+
+_first_key = re.compile(br'\s*\{\s*"([^"\\]{1,32})"')
+
+
+def classify(data):
+    """Return the message type of a raw message (bytes).
+
+    Objects whose first key isn't one of the control message keys are taken
+    to be tweets. Anything that doesn't look like a JSON object is
+    :data:`UNKNOWN`."""
+    match = _first_key.match(data)
+    if match is None:
+        return UNKNOWN
+    return _by_key.get(match.group(1), TWEET)
+
+
+def classify_object(message):
+    """Return the message type of an already parsed message"""
+    if not isinstance(message, dict):
+        return UNKNOWN
+    if 'text' in message:
+        return TWEET
+    for key in message:
+        return _by_text_key.get(key, TWEET)
+    return UNKNOWN
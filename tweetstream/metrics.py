@@ -0,0 +1,319 @@
+"""Throughput and latency metrics for streams.
+
+Every stream has a :class:`StreamMetrics` object as its ``metrics``
+attribute. Byte, message and keep-alive counts are updated once per chunk
+read from the socket rather than once per message, and parse and decode
+times are only measured for the first message of each chunk, so keeping
+the metrics costs next to nothing::
+
+    stream = SampleStream(auth=auth)
+    for tweet in stream:
+        ...
+        print(stream.metrics.snapshot())
+
+:meth:`StreamMetrics.prometheus` formats the metrics in the Prometheus text
+exposition format, for serving from a ``/metrics`` endpoint.
+"""
+
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
+
+class Histogram(object):
+    """Counts of observed durations in exponentially growing buckets.
+
+    :keyword bounds: Upper bounds of the buckets in seconds, in increasing
+      order. The default runs from one microsecond to about one second,
+      doubling each time. Larger values go into an implicit ``+Inf`` bucket.
+    """
+
+    default_bounds = tuple(1e-6 * 2 ** n for n in range(21))
+
+    def __init__(self, bounds=None):
+        self.bounds = tuple(bounds or self.default_bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value, count=1):
+        """Record ``count`` observations of ``value`` seconds"""
+        self.counts[bisect_left(self.bounds, value)] += count
+        self.count += count
+        self.sum += value * count
+
+    def quantile(self, q):
+        """Estimate the ``q`` quantile (0 to 1) as the upper bound of the
+        bucket it falls in, or None if nothing has been observed"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        return dict(
+            count=self.count,
+            sum=self.sum,
+            mean=self.sum / self.count if self.count else None,
+            p50=self.quantile(0.5),
+            p99=self.quantile(0.99),
+        )
+
+
+class RateWindow(object):
+    """Per second totals over the last ``size`` seconds"""
+
+    def __init__(self, size=300):
+        self.size = size
+        self._buckets = [0] * size
+        self._second = None
+
+    def add(self, amount, now):
+        second = int(now)
+        if second != self._second:
+            self._advance(second)
+        self._buckets[second % self.size] += amount
+
+    def _advance(self, second):
+        buckets = self._buckets
+        if self._second is None or second - self._second >= self.size:
+            buckets[:] = [0] * self.size
+        else:
+            for s in range(self._second + 1, second + 1):
+                buckets[s % self.size] = 0
+        self._second = second
+
+    def rate(self, window, now=None):
+        """Average per second over the last ``window`` complete seconds"""
+        window = min(window, self.size - 1)
+        second = int(time.time() if now is None else now)
+        latest = self._second
+        if latest is None or window < 1:
+            return 0.0
+        total = 0
+        for s in range(second - window, second):
+            if latest - self.size < s <= latest:
+                total += self._buckets[s % self.size]
+        return total / float(window)
+
+
+class StreamMetrics(object):
+    """Counters for one stream.
+
+    .. attribute:: bytes
+
+        Number of body bytes received, including keep-alives and framing.
+
+    .. attribute:: wire_bytes
+
+        Number of body bytes read from the connection. Less than
+        :attr:`bytes` for compressed streams.
+
+    .. attribute:: messages
+
+        Number of messages received, of any type, before anything is
+        dropped or filtered.
+
+    .. attribute:: types
+
+        Mapping of message type (see :mod:`tweetstream.messages`) to the
+        number of messages of that type processed.
+
+    .. attribute:: keepalives
+
+        Number of keep-alive lines received.
+
+    .. attribute:: connects
+
+        Number of connections opened.
+
+    .. attribute:: stalls
+
+        Number of connections given up on because nothing, not even a
+        keep-alive, was received for :attr:`~tweetstream.streamclasses.BaseStream.stall_timeout`.
+
+    .. attribute:: last_byte
+
+        Time data was last received, or None.
+
+    .. attribute:: parse_latency
+
+        :class:`Histogram` of the time taken to parse a message, measured
+        for one message per chunk and for every batch in
+        :meth:`~tweetstream.SampleStream.iter_batches`.
+
+    .. attribute:: decode_latency
+
+        :class:`Histogram` of the time taken to decode a message from UTF-8,
+        when it isn't parsed, measured for one message per chunk.
+
+    .. attribute:: users
+
+        The stream's :class:`~tweetstream.users.UserCache`, with its hit rate
+        and the memory it saved, or None.
+    """
+
+    #: Lengths in seconds of the windows rates are reported over.
+    windows = (10, 60, 300)
+
+    def __init__(self):
+        self.bytes = 0
+        self.wire_bytes = 0
+        self.messages = 0
+        self.keepalives = 0
+        self.connects = 0
+        self.stalls = 0
+        self.types = defaultdict(int)
+        self.last_byte = None
+        self.parse_latency = Histogram()
+        self.decode_latency = Histogram()
+        self.users = None
+        self._bytes_window = RateWindow(max(self.windows) + 1)
+        self._messages_window = RateWindow(max(self.windows) + 1)
+        # Set for each chunk received, so that one message per chunk is
+        # timed. Checking a flag is much cheaper than keeping a count.
+        self._timing = False
+
+    @property
+    def reconnects(self):
+        return max(self.connects - 1, 0)
+
+    def _received(self, size, messages, keepalives, now):
+        """Record a chunk of ``size`` bytes holding ``messages`` messages"""
+        self.bytes += size
+        self.messages += messages
+        self.keepalives += keepalives
+        self.last_byte = now
+        self._timing = True
+        self._bytes_window.add(size, now)
+        if messages:
+            self._messages_window.add(messages, now)
+
+    def since_last_byte(self, now=None):
+        """Seconds since data was last received, or None"""
+        if self.last_byte is None:
+            return None
+        return (time.time() if now is None else now) - self.last_byte
+
+    def message_rate(self, window=60):
+        """Messages per second over the last ``window`` seconds"""
+        return self._messages_window.rate(window)
+
+    def byte_rate(self, window=60):
+        """Bytes per second over the last ``window`` seconds"""
+        return self._bytes_window.rate(window)
+
+    def snapshot(self):
+        """Return the current metrics as a dict of plain values"""
+        now = time.time()
+        return dict(
+            bytes=self.bytes,
+            wire_bytes=self.wire_bytes,
+            messages=self.messages,
+            keepalives=self.keepalives,
+            connects=self.connects,
+            reconnects=self.reconnects,
+            stalls=self.stalls,
+            types=dict(self.types),
+            since_last_byte=self.since_last_byte(now),
+            message_rate=dict((w, self._messages_window.rate(w, now))
+                              for w in self.windows),
+            byte_rate=dict((w, self._bytes_window.rate(w, now))
+                           for w in self.windows),
+            parse_latency=self.parse_latency.snapshot(),
+            decode_latency=self.decode_latency.snapshot(),
+            users=self.users.snapshot() if self.users is not None else None,
+        )
+
+    def prometheus(self, prefix='tweetstream', labels=None):
+        """Return the metrics in the Prometheus text exposition format.
+
+        :keyword prefix: Prefix of the metric names.
+        :keyword labels: Dict of labels added to every sample, e.g. to tell
+          several streams apart.
+        """
+        labels = dict(labels or {})
+        lines = []
+
+        def label_text(extra=None):
+            items = sorted(labels.items()) + sorted((extra or {}).items())
+            if not items:
+                return ''
+            return '{%s}' % ','.join(
+                '%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                             .replace('"', '\\"').replace('\n', '\\n'))
+                for k, v in items)
+
+        def metric(name, kind, help, samples):
+            name = '%s_%s' % (prefix, name)
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for suffix, extra, value in samples:
+                lines.append('%s%s%s %r' % (name, suffix, label_text(extra),
+                                            float(value)))
+
+        now = time.time()
+        metric('received_bytes_total', 'counter', 'Body bytes received.',
+               [('', None, self.bytes)])
+        metric('wire_bytes_total', 'counter',
+               'Body bytes read from the connection, before decompression.',
+               [('', None, self.wire_bytes)])
+        metric('received_messages_total', 'counter',
+               'Messages received, of any type.',
+               [('', None, self.messages)])
+        metric('messages_total', 'counter',
+               'Messages processed, by message type.',
+               [('', {'type': t}, n) for t, n in sorted(self.types.items())])
+        metric('keepalives_total', 'counter', 'Keep-alive lines received.',
+               [('', None, self.keepalives)])
+        metric('reconnects_total', 'counter', 'Reconnections made.',
+               [('', None, self.reconnects)])
+        metric('stalls_total', 'counter',
+               'Connections dropped for receiving nothing, not even '
+               'keep-alives.', [('', None, self.stalls)])
+        since = self.since_last_byte(now)
+        if since is not None:
+            metric('seconds_since_last_byte', 'gauge',
+                   'Seconds since data was last received.',
+                   [('', None, since)])
+        metric('message_rate', 'gauge',
+               'Messages received per second, by window in seconds.',
+               [('', {'window': w}, self._messages_window.rate(w, now))
+                for w in self.windows])
+        metric('byte_rate', 'gauge',
+               'Bytes received per second, by window in seconds.',
+               [('', {'window': w}, self._bytes_window.rate(w, now))
+                for w in self.windows])
+        for name, histogram in (('parse_seconds', self.parse_latency),
+                                ('decode_seconds', self.decode_latency)):
+            samples = []
+            total = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                total += count
+                samples.append(('_bucket', {'le': '%g' % bound}, total))
+            samples.append(('_bucket', {'le': '+Inf'}, histogram.count))
+            samples.append(('_sum', None, histogram.sum))
+            samples.append(('_count', None, histogram.count))
+            metric(name, 'histogram', 'Sampled time taken per message.',
+                   samples)
+        users = self.users
+        if users is not None:
+            metric('user_cache_lookups_total', 'counter',
+                   'Users looked up in the user cache, by result.',
+                   [('', {'result': 'hit'}, users.hits),
+                    ('', {'result': 'miss'}, users.misses),
+                    ('', {'result': 'update'}, users.updates)])
+            metric('user_cache_saved_bytes_total', 'counter',
+                   'Estimated bytes freed by sharing users and strings.',
+                   [('', None, users.bytes_saved)])
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,407 @@
+"""Decoding and parsing messages in worker processes.
+
+A single process parsing JSON is limited to one core. :class:`Pipeline`
+keeps reading and framing in the calling process, and hands batches of raw
+messages to a pool of worker processes that decode, parse, filter and
+project them::
+
+    with Pipeline(FilterStream(auth=auth, track=words, local_filter=True),
+                  workers=4) as pipeline:
+        for tweet in pipeline:
+            ...
+
+Batches travel to the workers through a ring buffer in shared memory, so
+only a few numbers per batch are pickled on the way there. Parsed messages
+are pickled on the way back, so the gain is largest when most messages are
+dropped or filtered out in the workers, or reduced to a few ``fields``.
+Needs Python 3.8 or later.
+"""
+
+import os
+import signal
+import struct
+import threading
+import multiprocessing
+from array import array
+from collections import deque
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+from .streamclasses import BaseStream, _SKIP
+from .messages import TWEET
+from .records import Projection
+from .exceptions import FatalError, TweetStreamError
+
+_count = struct.Struct('=I')
+
+
+class _Ring(object):
+    """Space for batches in a shared memory buffer, handed out and given
+    back in roughly first in, first out order"""
+
+    def __init__(self, size):
+        self.memory = shared_memory.SharedMemory(create=True, size=size)
+        self.size = size
+        self.closed = False
+        self._head = 0
+        self._regions = deque()  # [offset, freed] in allocation order
+        self._index = {}
+        self._cond = threading.Condition()
+
+    def _fit(self, size):
+        if not self._regions:
+            self._head = 0
+            return 0
+        tail = self._regions[0][0]
+        head = self._head
+        if head >= tail:
+            if head + size <= self.size:
+                return head
+            if size < tail:
+                return 0
+        elif head + size < tail:
+            return head
+        return None
+
+    def alloc(self, size):
+        """Return the offset of ``size`` free bytes, waiting for space if
+        needed, or None once closed"""
+        if size > self.size:
+            raise ValueError('Batch of %d bytes is larger than the buffer'
+                             % size)
+        with self._cond:
+            while True:
+                if self.closed:
+                    return None
+                offset = self._fit(size)
+                if offset is not None:
+                    break
+                self._cond.wait()
+            region = [offset, False]
+            self._regions.append(region)
+            self._index[offset] = region
+            self._head = offset + size
+            return offset
+
+    def free(self, offset):
+        with self._cond:
+            self._index.pop(offset)[1] = True
+            regions = self._regions
+            while regions and regions[0][1]:
+                regions.popleft()
+            self._cond.notify_all()
+
+    def stop(self):
+        """Wake up and refuse anyone waiting for space"""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def close(self):
+        self.stop()
+        self.memory.close()
+        self.memory.unlink()
+
+
+def _process(processor, projection, lazy, lines):
+    """Select and convert lines like BaseStream._process_line, without
+    delivering them. Returns the ``(message type, value)`` pairs, the count
+    of each message type seen and the error to raise after them, if any."""
+    items = []
+    error = None
+    local_filter = processor.local_filter
+    for line in lines:
+        message_type = processor._select(line)
+        if message_type is None:
+            continue
+        try:
+            parsed = None
+            if message_type == TWEET and local_filter is not None:
+                parsed = processor._parse(line)
+                if not local_filter.matches(parsed):
+                    continue
+            if lazy:
+                value = line
+            else:
+                value = processor._convert(line, parsed)
+                if projection is not None:
+                    value = projection.values(value)
+            items.append((message_type, value))
+        except TweetStreamError as e:
+            # Exceptions lose their reason when pickled, so send the parts
+            error = (e.__class__, e.reason, e.details)
+            break
+    types = dict(processor.metrics.types)
+    processor.metrics.types.clear()
+    return items, types, error
+
+
+def _work(options, fields, lazy, local_filter, name, tasks, results):
+    """Worker process main loop"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    memory = shared_memory.SharedMemory(name=name)
+    processor = BaseStream(**options)
+    processor.local_filter = local_filter
+    projection = Projection(fields) if fields else None
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            seq, offset, size = task
+            view = memory.buf[offset:offset + size]
+            count, = _count.unpack_from(view)
+            lengths = array('I')
+            lengths.frombytes(view[4:4 + 4 * count])
+            data = view[4 + 4 * count:].tobytes()
+            view.release()
+            lines = []
+            position = 0
+            for length in lengths:
+                lines.append(data[position:position + length])
+                position += length
+            results.put((seq,) + _process(processor, projection, lazy, lines))
+    finally:
+        memory.close()
+
+
+class Pipeline(object):
+    """Iterate over a stream, decoding and parsing in worker processes.
+
+    :param stream: The stream to read, e.g. a :class:`FilterStream`. Its
+      ``parse_json``, ``decode_unicode``, ``decoder``, ``drop``, ``fields``,
+      ``lazy`` and ``local_filter`` options are applied in the workers, and
+      its ``user_cache``, handlers, :attr:`count` and metrics in this
+      process.
+    :keyword workers: Number of worker processes. Defaults to one less than
+      the number of CPUs, and at least one.
+    :keyword ordered: If True (the default) messages are returned in the
+      order they were received. If False they are returned as soon as a
+      worker is done with them, which keeps all the workers busy even when
+      one batch is slow.
+    :keyword batch_size: Maximum number of messages sent to a worker in one
+      go. Smaller batches are sent whenever the stream has no more data
+      waiting, so quiet streams aren't held up.
+    :keyword buffer_size: Size in bytes of the shared memory ring buffer.
+      Reading stops while it is full of batches the workers haven't done.
+    :keyword context: :mod:`multiprocessing` context or start method name.
+
+    Errors are raised just as when iterating over the stream itself, after
+    every message received before them, including
+    :class:`~tweetstream.ReconnectImmediatelyError` for invalid data.
+    The stream is disconnected after any error. The local filter's counters
+    are kept in the workers and are not updated.
+    """
+
+    def __init__(self, stream, workers=None, ordered=True, batch_size=256,
+                 buffer_size=32 << 20, context=None):
+        if shared_memory is None:
+            raise RuntimeError('Pipeline needs Python 3.8 or later')
+        if workers is None:
+            workers = max((os.cpu_count() or 1) - 1, 1)
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1')
+        self.stream = stream
+        self.workers = workers
+        self.ordered = ordered
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        if context is None or isinstance(context, str):
+            context = multiprocessing.get_context(context)
+        self._context = context
+
+        self._ring = None
+        self._processes = []
+        self._tasks = None
+        self._results = None
+        self._thread = None
+        self._error = None
+        self._stopped = False
+        self._next_seq = 0
+        self._offsets = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *params):
+        self.close()
+        return False
+
+    def start(self):
+        """Start the workers and the reader thread. Called on first
+        iteration if needed."""
+        if self._thread is not None:
+            return
+        stream = self.stream
+        lazy = stream._lazy_class is not None
+        options = dict(parse_json=stream._parse_json and not lazy,
+                       decode_unicode=stream._decode_unicode and not lazy,
+                       decoder=stream._decoder, drop=stream._drop)
+        fields = stream._projection.fields if stream._projection else None
+
+        self._ring = _Ring(self.buffer_size)
+        self._tasks = self._context.Queue()
+        self._results = self._context.Queue()
+        # Workers are started before the reader thread, as forking a process
+        # with threads running is best avoided
+        for n in range(self.workers):
+            process = self._context.Process(
+                target=_work, args=(options, fields, lazy,
+                                    stream.local_filter,
+                                    self._ring.memory.name, self._tasks,
+                                    self._results))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        stream = self.stream
+        pending = []
+        pending_size = 0
+        # Keep batches small enough for several to fit in the buffer
+        max_size = self.buffer_size // 4
+        try:
+            # Messages framed from chunks received so far. Once they have
+            # all been taken, the batch is sent off unless the socket has
+            # more data waiting.
+            framed = stream.metrics.messages
+            taken = 0
+            for line in stream._read_lines():
+                if self._stopped:
+                    return
+                pending.append(line)
+                pending_size += len(line)
+                taken += 1
+                if len(pending) >= self.batch_size or \
+                        pending_size >= max_size or (
+                            taken >= stream.metrics.messages - framed and
+                            not stream._wait_readable(0)):
+                    self._dispatch(pending)
+                    pending = []
+                    pending_size = 0
+        except Exception as e:
+            if pending:
+                self._dispatch(pending)
+            self._error = e
+        finally:
+            # Marks where the stream ended
+            self._results.put((self._next_seq, None, None, None))
+
+    def _dispatch(self, lines):
+        """Copy a batch into the ring buffer and queue it for the workers"""
+        data = b"".join(lines)
+        header = _count.pack(len(lines)) + \
+            array('I', [len(line) for line in lines]).tobytes()
+        size = len(header) + len(data)
+        offset = self._ring.alloc(size)
+        if offset is None:
+            return
+        buf = self._ring.memory.buf
+        buf[offset:offset + len(header)] = header
+        buf[offset + len(header):offset + size] = data
+        self._offsets[self._next_seq] = offset
+        self._tasks.put((self._next_seq, offset, size))
+        self._next_seq += 1
+
+    def _receive(self):
+        """Wait for the next result, checking that the workers are alive"""
+        while True:
+            try:
+                return self._results.get(timeout=0.5)
+            except Empty:
+                for process in self._processes:
+                    if not process.is_alive():
+                        self.close()
+                        raise FatalError('Pipeline worker died with exit '
+                                         'code %s' % process.exitcode)
+
+    def _results_in_order(self):
+        """Yield results, in order if :attr:`ordered`, up to the end of the
+        stream"""
+        waiting = {}
+        expect = 0
+        end = None
+        done = 0
+        while True:
+            if self.ordered:
+                while expect in waiting:
+                    result = waiting.pop(expect)
+                    expect += 1
+                    yield result
+                if expect == end:
+                    return
+            elif done == end:
+                return
+            result = self._receive()
+            seq = result[0]
+            if result[1] is None:
+                end = seq
+                continue
+            self._ring.free(self._offsets.pop(seq))
+            done += 1
+            if self.ordered:
+                waiting[seq] = result
+            else:
+                yield result
+
+    def __iter__(self):
+        self.start()
+        stream = self.stream
+        types = stream.metrics.types
+        projection = stream._projection
+        lazy_class = stream._lazy_class
+        user_cache = stream.user_cache
+        for seq, items, counts, error in self._results_in_order():
+            for message_type, count in counts.items():
+                types[message_type] += count
+            for message_type, value in items:
+                if lazy_class is not None:
+                    value = lazy_class(value)
+                elif projection is not None:
+                    value = projection.record_class(*value)
+                elif user_cache is not None:
+                    value = user_cache(value)
+                tweet = stream._deliver(message_type, value)
+                if tweet is not _SKIP:
+                    yield tweet
+            if error is not None:
+                cls, reason, details = error
+                self.close()
+                raise cls(reason, details=details)
+        error = self._error
+        self.close()
+        if error is not None:
+            raise error
+
+    def close(self):
+        """Stop reading, close the stream and shut down the workers"""
+        self._stopped = True
+        if self._ring is not None:
+            self._ring.stop()
+        self.stream.close()
+        if self._thread is not None and \
+                self._thread is not threading.current_thread():
+            self._thread.join(1)
+        for process in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
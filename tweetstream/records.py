@@ -0,0 +1,180 @@
+"""Compact tweet records holding only selected fields.
+
+Fields are given as dotted paths into the tweet, such as
+``'user.screen_name'``. Record attributes use the path with dots replaced by
+underscores (``record.user_screen_name``), and records can also be indexed
+by the path itself (``record['user.screen_name']``). Missing fields are None.
+
+:class:`Projection` builds fixed size ``__slots__`` records from parsed
+tweets. :func:`lazy_record_class` builds records that keep only the raw
+bytes of the message and parse it the first time a field is accessed.
+"""
+
+import re
+
+_identifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def attribute_name(path):
+    """Return the record attribute name for a dotted field path"""
+    name = path.replace('.', '_')
+    if not _identifier.match(name):
+        raise ValueError('Invalid field %r' % (path,))
+    return name
+
+
+def getter(path):
+    """Return a function looking up a dotted path in a parsed tweet"""
+    keys = [int(key) if key.isdigit() else key for key in path.split('.')]
+
+    def get(obj):
+        for key in keys:
+            try:
+                obj = obj[key]
+            except (KeyError, IndexError, TypeError):
+                return None
+        return obj
+    return get
+
+
+class Record(object):
+    """Base class of the records made by :class:`Projection`"""
+
+    __slots__ = ()
+    fields = ()
+    _names = {}
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, self._names[field])
+        except KeyError:
+            raise KeyError(field)
+
+    def get(self, field, default=None):
+        value = self[field] if field in self._names else None
+        return default if value is None else value
+
+    def _asdict(self):
+        return dict((field, self[field]) for field in self.fields)
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                self._asdict() == other._asdict())
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, ' '.join(
+            '%s=%r' % (name, getattr(self, name)) for name in self.__slots__))
+
+
+def _record_class(fields, name='Record'):
+    names = [attribute_name(field) for field in fields]
+    if len(set(names)) != len(names):
+        raise ValueError('Duplicate fields in %r' % (fields,))
+    return type(str(name), (Record,), {
+        '__slots__': tuple(names),
+        'fields': tuple(fields),
+        '_names': dict(zip(fields, names)),
+    })
+
+
+class Projection(object):
+    """Callable turning parsed tweets into compact records of ``fields``"""
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        if not self.fields:
+            raise ValueError('At least one field is needed.')
+        self.index = dict((field, n) for n, field in enumerate(self.fields))
+        self._getters = [getter(field) for field in self.fields]
+        self.record_class = _record_class(self.fields)
+
+    def values(self, tweet):
+        return [get(tweet) for get in self._getters]
+
+    def __call__(self, tweet):
+        return self.record_class(*self.values(tweet))
+
+
+class LazyRecord(object):
+    """A message kept as raw bytes, parsed when a field is first accessed.
+
+    Fields are looked up by dotted path (``record['user.screen_name']``) and,
+    for records of a projection, as attributes. The message is parsed once,
+    on first access. With a projection all its fields are extracted then and
+    the parsed message is thrown away; without one the whole parsed message
+    is kept, so give ``fields`` to keep records small once they are read.
+    Invalid JSON raises :class:`ValueError` on first access.
+
+    .. attribute:: raw
+
+        The raw bytes of the message.
+    """
+
+    __slots__ = ('raw', '_values')
+
+    _decoder = None
+    _projection = None
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._values = None
+
+    def _load(self):
+        tweet = self._decoder(self.raw)
+        if self._projection is not None:
+            self._values = self._projection.values(tweet)
+        else:
+            self._values = tweet
+
+    def __getitem__(self, field):
+        if self._values is None:
+            self._load()
+        projection = self._projection
+        if projection is not None:
+            return self._values[projection.index[field]]
+        return getter(field)(self._values)
+
+    def get(self, field, default=None):
+        try:
+            value = self[field]
+        except KeyError:
+            return default
+        return default if value is None else value
+
+    def __getattr__(self, name):
+        projection = self._projection
+        if projection is not None:
+            for field in projection.fields:
+                if attribute_name(field) == name:
+                    return self[field]
+        raise AttributeError(name)
+
+    def _asdict(self):
+        if self._projection is not None:
+            return dict((field, self[field])
+                        for field in self._projection.fields)
+        if self._values is None:
+            self._load()
+        return self._values
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.raw[:60])
+
+
+def lazy_record_class(decoder, fields=None):
+    """Make a :class:`LazyRecord` subclass parsing with ``decoder`` and, if
+    ``fields`` is given, projecting onto those fields."""
+    return type(str('LazyRecord'), (LazyRecord,), {
+        '__slots__': (),
+        '_decoder': staticmethod(decoder),
+        '_projection': Projection(fields) if fields else None,
+    })
@@ -0,0 +1,424 @@
+"""Re-serving one stream to many clients.
+
+Twitter allows an account very few connections, so processes and hosts that
+all need the same stream can't each open their own. :class:`Relay` holds
+one upstream connection and serves its messages over HTTP, on a TCP port or
+a Unix socket, to any number of clients::
+
+    relay = Relay(SampleStream(auth=auth), ('127.0.0.1', 8080))
+    relay.serve_forever()
+
+Clients are ordinary streams with their ``url`` pointed at the relay::
+
+    for tweet in SampleStream(url='http://127.0.0.1:8080/'):
+        ...
+
+    for tweet in FilterStream(track=['python'], url='http://127.0.0.1:8080/'):
+        ...
+
+The relay passes on the stream of the account it connects with. Before
+listening on an address other hosts can reach, give it a ``token``, which
+clients send as the password of their ``auth``, e.g.
+``SampleStream(url=..., auth=('relay', token))``, and keep in mind that it
+is sent in the clear over plain HTTP.
+
+A client's ``track``, ``follow`` and ``locations`` are applied by the relay
+as a :class:`~tweetstream.matching.LocalFilter`, and ``delimited=length``
+is honoured, so each client gets the part of the stream it asked for in the
+framing it expects. Messages are forwarded as the raw bytes received from
+upstream; only tweets that have to be checked against a client's filter are
+parsed, once however many clients check them. Each client has a bounded
+buffer, and clients that fall so far behind that it fills up are
+disconnected rather than holding up the others.
+
+The relay can also be run from the command line, see ``python -m
+tweetstream relay --help``.
+"""
+
+import os
+import base64
+import socket
+import threading
+
+try:
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:
+    from urlparse import urlsplit, parse_qs
+
+from .messages import TWEET
+from .matching import LocalFilter
+from .resilient import ResilientStream, DEFAULT_SCHEDULES
+
+try:
+    from hmac import compare_digest
+except ImportError:  # Python before 2.7.7 and 3.3
+    def compare_digest(a, b):
+        return len(a) == len(b) and not sum(ord(x) ^ ord(y)
+                                            for x, y in zip(a, b))
+
+# Parsing a tweet that some client's filter needs, not yet attempted
+_UNPARSED = object()
+
+
+def _frame(line, delimited):
+    """The bytes sending ``line`` in the given framing"""
+    if delimited:
+        return str(len(line) + 2).encode('ascii') + b"\r\n" + line + b"\r\n"
+    return line + b"\r\n"
+
+
+def _chunk(data):
+    return ("%x\r\n" % len(data)).encode('ascii') + data + b"\r\n"
+
+
+class _Client(object):
+    """A connected client, with the frames waiting to be sent to it"""
+
+    def __init__(self, relay, conn, local_filter, delimited):
+        self.relay = relay
+        self.conn = conn
+        self.local_filter = local_filter
+        self.delimited = delimited
+        self.sent = 0
+        self.slow = False
+        self._pending = []
+        self._pending_size = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def offer(self, line):
+        """Queue a message, disconnecting the client if its buffer is full.
+        Called by the relay's upstream thread, which it never holds up."""
+        frame = _frame(line, self.delimited)
+        with self._cond:
+            if self._closed:
+                return
+            if self._pending_size + len(frame) > self.relay.max_buffer:
+                self.slow = True
+                self._close()
+                return
+            self._pending.append(frame)
+            self._pending_size += len(frame)
+            self._cond.notify()
+
+    def _close(self):
+        self._closed = True
+        self._pending = []
+        self._pending_size = 0
+        self._cond.notify()
+        try:
+            # Interrupts a send in progress in the client's thread
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def close(self):
+        with self._cond:
+            self._close()
+
+    def run(self):
+        """Send queued messages, and keep-alives when there are none, until
+        the client or relay goes away"""
+        interval = self.relay.keepalive_interval
+        try:
+            while True:
+                with self._cond:
+                    if not self._pending and not self._closed:
+                        self._cond.wait(interval)
+                    if self._closed:
+                        break
+                    frames = self._pending
+                    self._pending = []
+                    self._pending_size = 0
+                if frames:
+                    self.conn.sendall(_chunk(b"".join(frames)))
+                    self.sent += len(frames)
+                else:
+                    self.conn.sendall(_chunk(b"\r\n"))
+        except socket.error:
+            pass
+        finally:
+            self.relay._remove(self)
+            self.conn.close()
+
+
+class Relay(object):
+    """Serve the messages of one stream to many clients over HTTP.
+
+    :param stream: The upstream stream, e.g. a :class:`SampleStream` or
+      :class:`FilterStream`. Its ``drop`` list and local filter apply to
+      every client.
+    :param address: A ``(host, port)`` pair to listen on, or the path of a
+      Unix socket. Port 0 picks a free port; see :attr:`address`.
+    :keyword max_buffer: Maximum number of bytes waiting to be sent to a
+      client. A client that falls this far behind is disconnected.
+    :keyword keepalive_interval: Seconds between the keep-alive lines sent
+      to idle clients. Twitter's 30 seconds suits the streams' own stall
+      detection.
+    :keyword jitter, max_failures, schedules: Reconnection settings for the
+      upstream stream, see :class:`~tweetstream.ResilientStream`. Once the
+      relay gives up, clients are disconnected and new ones refused.
+    :keyword token: If given, clients must send it as the password of HTTP
+      basic authentication, or as a bearer token, and are refused with 401
+      otherwise. Without one anybody who can connect gets the stream.
+
+    .. attribute:: address
+
+        The address listened on, with the port filled in.
+
+    .. attribute:: clients
+
+        The connected clients.
+
+    .. attribute:: slow_disconnects
+
+        Number of clients disconnected for falling behind.
+
+    .. attribute:: error
+
+        The upstream error the relay gave up on, or None.
+    """
+
+    def __init__(self, stream, address=('127.0.0.1', 0), max_buffer=8 << 20,
+                 keepalive_interval=30, jitter=0.1, max_failures=None,
+                 schedules=DEFAULT_SCHEDULES, token=None):
+        self.stream = stream
+        self.token = token
+        self.supervisor = ResilientStream(stream, jitter=jitter,
+                                          max_failures=max_failures,
+                                          schedules=schedules)
+        self.max_buffer = max_buffer
+        self.keepalive_interval = keepalive_interval
+        self.slow_disconnects = 0
+        self.error = None
+        self._clients = ()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+
+        if isinstance(address, tuple):
+            self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(address)
+        self._listener.listen(64)
+        self._listener.settimeout(0.1)
+        self.address = self._listener.getsockname()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *params):
+        self.close()
+        return False
+
+    @property
+    def url(self):
+        """URL for clients to connect to, if listening on TCP"""
+        if not isinstance(self.address, tuple):
+            return None
+        host, port = self.address[:2]
+        if host in ('0.0.0.0', ''):
+            host = '127.0.0.1'
+        return "http://%s:%s/" % (host, port)
+
+    @property
+    def clients(self):
+        return self._clients
+
+    def start(self):
+        """Connect upstream and start accepting clients, in background
+        threads"""
+        if self._threads:
+            return
+        for target in (self._upstream, self._accept):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def serve_forever(self):
+        """Start, and wait until the relay is closed or gives up"""
+        self.start()
+        try:
+            while not self._stopped.wait(1):
+                pass
+        finally:
+            self.close()
+        if self.error is not None:
+            raise self.error
+
+    def _remove(self, client):
+        with self._lock:
+            self._clients = tuple(c for c in self._clients if c is not client)
+            if client.slow:
+                self.slow_disconnects += 1
+
+    def _lines(self, stream):
+        """Yield the raw lines of one upstream connection that pass the
+        stream's own drop list and filter, with their message type"""
+        local_filter = stream.local_filter
+        for line in stream._read_lines():
+            message_type = stream._select(line)
+            if message_type is None:
+                continue
+            if message_type == TWEET:
+                if local_filter is not None and \
+                        not local_filter.matches(stream._parse(line)):
+                    continue
+                stream.count += 1
+            yield message_type, line
+
+    def _upstream(self):
+        stream = self.stream
+        decoder = stream._decoder
+        try:
+            for message_type, line in self.supervisor._supervise(self._lines):
+                parsed = _UNPARSED
+                for client in self._clients:
+                    local_filter = client.local_filter
+                    if local_filter is not None and message_type == TWEET:
+                        if not local_filter.candidate(line):
+                            continue
+                        if parsed is _UNPARSED:
+                            try:
+                                parsed = decoder(line)
+                            except ValueError:
+                                # Unfiltered clients still get it, and deal
+                                # with it as they would coming from Twitter
+                                parsed = None
+                        if not local_filter.matches(parsed):
+                            continue
+                    client.offer(line)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._stopped.set()
+            with self._lock:
+                clients = self._clients
+            for client in clients:
+                client.close()
+
+    def _accept(self):
+        while not self._stopped.is_set():
+            try:
+                conn, _ = self._listener.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            conn.settimeout(None)
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+        self._listener.close()
+
+    def _read_request(self, conn):
+        """Read a request, returning its target, headers (with lower case
+        names) and form data"""
+        request = b""
+        while b"\r\n\r\n" not in request:
+            data = conn.recv(65536)
+            if not data or len(request) > 65536:
+                return None, None, None
+            request += data
+        head, body = request.split(b"\r\n\r\n", 1)
+        lines = head.decode('latin-1').split("\r\n")
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        while len(body) < length:
+            data = conn.recv(65536)
+            if not data:
+                return None, None, None
+            body += data
+        parts = lines[0].split()
+        target = parts[1] if len(parts) > 1 else "/"
+        return target, headers, body.decode('utf-8')
+
+    def _authorized(self, headers):
+        """Check the client's credentials against :attr:`token`"""
+        if self.token is None:
+            return True
+        scheme, _, credentials = headers.get("authorization", "").partition(" ")
+        scheme = scheme.lower()
+        if scheme == "basic":
+            try:
+                credentials = base64.b64decode(credentials.encode('ascii'))
+                credentials = credentials.decode('utf-8').partition(":")[2]
+            except (ValueError, TypeError, UnicodeError):
+                return False
+        elif scheme != "bearer":
+            return False
+        return compare_digest(credentials.encode('utf-8'),
+                              self.token.encode('utf-8'))
+
+    @staticmethod
+    def _respond(conn, status, body=b""):
+        conn.sendall(("HTTP/1.1 %s\r\nContent-Type: text/plain\r\n"
+                      "Content-Length: %d\r\nConnection: close\r\n\r\n"
+                      % (status, len(body))).encode('ascii') + body)
+
+    def _serve(self, conn):
+        try:
+            target, headers, body = self._read_request(conn)
+            if target is None:
+                conn.close()
+                return
+            if not self._authorized(headers):
+                self._respond(conn, "401 Unauthorized")
+                conn.close()
+                return
+            query = parse_qs(urlsplit(target).query)
+            form = parse_qs(body)
+            delimited = query.get('delimited', [None])[-1]
+            parameters = dict((key, form[key][-1].split(','))
+                              for key in ('track', 'follow', 'locations')
+                              if key in form)
+            try:
+                if delimited not in (None, 'length'):
+                    raise ValueError('delimited must be "length"')
+                local_filter = LocalFilter(**parameters) if parameters else None
+            except ValueError as e:
+                self._respond(conn, "406 Not Acceptable", str(e).encode('utf-8'))
+                conn.close()
+                return
+            if self._stopped.is_set():
+                self._respond(conn, "503 Service Unavailable")
+                conn.close()
+                return
+            if conn.family == socket.AF_INET:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn.sendall(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: application/json\r\n"
+                         b"Transfer-Encoding: chunked\r\n\r\n")
+        except socket.error:
+            conn.close()
+            return
+        client = _Client(self, conn, local_filter, delimited)
+        with self._lock:
+            self._clients += (client,)
+        client.run()
+
+    def close(self):
+        """Stop accepting clients, disconnect them and close the upstream
+        stream"""
+        self._stopped.set()
+        self.supervisor.close()
+        with self._lock:
+            clients = self._clients
+        for client in clients:
+            client.close()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(1)
+        if not isinstance(self.address, tuple):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
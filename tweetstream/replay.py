@@ -0,0 +1,138 @@
+"""Replaying recorded streams"""
+
+import time
+from itertools import groupby
+from operator import itemgetter
+
+from .streamclasses import BaseStream, _SKIP
+from .archive import ArchiveReader
+
+
+class ReplayStream(BaseStream):
+    """Play back messages recorded with a stream's ``record`` option.
+
+    Iterate over it, or use :meth:`iter_batches`, exactly as over the stream
+    that recorded it, and the same messages come out in the same order,
+    which makes it useful for testing and for benchmarking offline without
+    the network getting in the way. Iteration ends at the end of the
+    archive.
+
+    :param path: The archive directory.
+    :keyword speed: None (the default) to replay as fast as possible, or a
+      factor of the recorded rate: 1 plays messages at the pace they were
+      received, 10 ten times faster.
+    :keyword start: Only replay messages received at or after this time, in
+      seconds since the epoch. See :meth:`seek`.
+    :keyword end: Stop at messages received at or after this time.
+
+    ``parse_json``, ``decode_unicode``, ``decoder``, ``drop``, ``fields``,
+    ``lazy`` and ``user_cache`` work as for :class:`~tweetstream.SampleStream`, and
+    :attr:`count`, :attr:`rate`, :attr:`metrics` and handlers registered
+    with :meth:`on` are updated as if the messages were arriving now.
+
+    .. attribute:: archive
+
+        The :class:`~tweetstream.archive.ArchiveReader` messages are read
+        from.
+    """
+
+    url = None
+
+    def __init__(self, path, parse_json=True, decode_unicode=True,
+                 speed=None, start=None, end=None, decoder=None, drop=(),
+                 fields=None, lazy=False, user_cache=None):
+        if speed is not None and speed <= 0:
+            raise ValueError('speed must be positive or None.')
+        BaseStream.__init__(self, parse_json=parse_json,
+                            decode_unicode=decode_unicode, decoder=decoder,
+                            drop=drop, fields=fields, lazy=lazy,
+                            user_cache=user_cache)
+        self.archive = ArchiveReader(path)
+        self.speed = speed
+        self._start = start
+        self._end = end
+        self._records = None
+        self._clock = None
+
+    def seek(self, timestamp):
+        """Continue from the first message received at or after
+        ``timestamp``. Segments before it are skipped using the archive's
+        index, without being decompressed."""
+        self._start = timestamp
+        self.connected = False
+
+    def _init_conn(self):
+        self._records = groupby(self.archive.records(self._start, self._end),
+                                key=itemgetter(0))
+        self._clock = None
+        self.connected = True
+        self.starttime = time.time()
+        self.metrics.connects += 1
+
+    def _pace(self, received):
+        """Sleep until ``received`` is due, scaled by :attr:`speed`"""
+        if self._clock is None:
+            self._clock = (received, time.time())
+            return
+        first, started = self._clock
+        delay = started + (received - first) / self.speed - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _read_lines(self):
+        """Yield the recorded messages, one group received together at a
+        time, as if they had just been read from the connection"""
+        while True:
+            if not self.connected:
+                self._init_conn()
+            records = self._records
+            for received, group in records:
+                if self.speed is not None:
+                    self._pace(received)
+                lines = [line for _, line in group]
+                now = time.time()
+                self.metrics._received(sum(len(line) + 2 for line in lines),
+                                       len(lines), 0, now)
+                self._update_rate(now)
+                for line in lines:
+                    yield line
+                    if records is not self._records or not self.connected:
+                        break
+                if records is not self._records or not self.connected:
+                    break
+            else:
+                self._disconnect()
+                return
+
+    def _wait_readable(self, timeout):
+        """More messages are always ready at full speed"""
+        return self.speed is None
+
+    def __iter__(self):
+        for line in self._read_lines():
+            tweet = self._process_line(line)
+            if tweet is not _SKIP:
+                yield tweet
+
+    def iter_batches(self, max_items=100, max_latency=1.0, raw=False,
+                     columns=None):
+        """Iterate over lists of tweets instead of single tweets, as
+        :meth:`~tweetstream.SampleStream.iter_batches`. ``max_latency`` only
+        matters when replaying at a limited :attr:`speed`."""
+        columns = self._columns(raw, columns)
+        pending = []
+        deadline = None
+        for line in self._read_lines():
+            if not pending:
+                deadline = time.time() + max_latency
+            pending.append(line)
+            if len(pending) >= max_items or time.time() >= deadline:
+                for batch in self._batch(pending, raw, columns):
+                    yield batch
+                pending = []
+        for batch in self._batch(pending, raw, columns):
+            yield batch
+
+    def _disconnect(self):
+        self.connected = False
+        self._records = None
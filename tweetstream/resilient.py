@@ -0,0 +1,190 @@
+"""Automatic reconnection following Twitter's backoff guidance.
+
+:class:`ResilientStream` iterates over a stream and reconnects whenever it
+raises one of the :class:`~tweetstream.ReconnectError` exceptions, waiting
+as long as the exception's class calls for (see :mod:`tweetstream.exceptions`)::
+
+    for tweet in ResilientStream(SampleStream, auth=auth):
+        print(tweet)
+"""
+
+import random
+import threading
+from collections import defaultdict
+
+from .exceptions import (
+    ReconnectError, ReconnectImmediatelyError, ReconnectLinearlyError,
+    ReconnectExponentiallyError, EnhanceYourCalmError,
+)
+
+
+class LinearBackoff(object):
+    """Wait ``start`` seconds, adding ``step`` for each further attempt, up
+    to ``cap``."""
+
+    def __init__(self, start, step, cap):
+        self.start = start
+        self.step = step
+        self.cap = cap
+
+    def delay(self, attempt):
+        return min(self.start + self.step * (attempt - 1), self.cap)
+
+
+class ExponentialBackoff(object):
+    """Wait ``start`` seconds, doubling for each further attempt, up to
+    ``cap``."""
+
+    def __init__(self, start, cap, factor=2):
+        self.start = start
+        self.cap = cap
+        self.factor = factor
+
+    def delay(self, attempt):
+        return min(self.start * self.factor ** (attempt - 1), self.cap)
+
+
+class ImmediateBackoff(LinearBackoff):
+    """Reconnect straight away the first time. If the new connection fails
+    the same way without delivering anything, back off linearly."""
+
+    def __init__(self, step=0.25, cap=16):
+        LinearBackoff.__init__(self, 0, step, cap)
+
+
+#: Backoff schedules per exception class, most specific first.
+DEFAULT_SCHEDULES = (
+    (EnhanceYourCalmError, ExponentialBackoff(60, 960)),
+    (ReconnectExponentiallyError, ExponentialBackoff(10, 240)),
+    (ReconnectLinearlyError, LinearBackoff(0.25, 0.25, 16)),
+    (ReconnectImmediatelyError, ImmediateBackoff()),
+)
+
+
+class ResilientStream(object):
+    """Iterate over a stream, reconnecting transparently after errors.
+
+    :param stream: A stream object, or a stream class to instantiate with the
+      remaining positional and keyword arguments. The same stream object,
+      and so the same ``requests.Session``, is used for every connection.
+    :keyword jitter: Delays are randomly varied by up to this fraction, so
+      clients don't reconnect in lockstep. Waits after
+      :class:`~tweetstream.EnhanceYourCalmError` are only ever lengthened,
+      as Twitter asks for at least a minute.
+    :keyword max_failures: Give up and raise the last error after this many
+      failures in a row. By default never give up.
+    :keyword schedules: Sequence of ``(exception class, backoff)`` pairs
+      replacing :data:`DEFAULT_SCHEDULES`.
+
+    :class:`~tweetstream.FatalError` and errors that aren't tweetstream
+    errors are raised immediately. The backoff state is reset once a
+    connection delivers a message.
+
+    .. attribute:: reconnects
+
+        Total number of reconnections made.
+
+    .. attribute:: failures
+
+        Number of errors in a row since a message was last received.
+
+    .. attribute:: errors
+
+        Mapping of exception class name to the number of times it occurred.
+
+    .. attribute:: last_error
+
+        The most recent exception, or None.
+
+    .. attribute:: delay
+
+        Length in seconds of the most recent (or current) wait.
+    """
+
+    def __init__(self, stream, *args, **kwargs):
+        self.jitter = kwargs.pop('jitter', 0.1)
+        self.max_failures = kwargs.pop('max_failures', None)
+        self.schedules = tuple(kwargs.pop('schedules', DEFAULT_SCHEDULES))
+        if isinstance(stream, type):
+            stream = stream(*args, **kwargs)
+        elif args or kwargs:
+            raise TypeError('Arguments can only be given with a stream class')
+        self.stream = stream
+
+        self.reconnects = 0
+        self.failures = 0
+        self.errors = defaultdict(int)
+        self.last_error = None
+        self.delay = 0
+        self._attempts = defaultdict(int)
+        self._closed = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *params):
+        self.close()
+        return False
+
+    def _schedule(self, error):
+        for cls, backoff in self.schedules:
+            if isinstance(error, cls):
+                return cls, backoff
+        return None, None
+
+    def _backoff(self, error):
+        """Record a failure and return how long to wait before reconnecting"""
+        cls, backoff = self._schedule(error)
+        if backoff is None:
+            raise error
+        self.failures += 1
+        self.errors[error.__class__.__name__] += 1
+        self.last_error = error
+        if self.max_failures is not None and self.failures >= self.max_failures:
+            raise error
+
+        self._attempts[cls] += 1
+        delay = backoff.delay(self._attempts[cls])
+        if delay and self.jitter:
+            low = 0 if issubclass(cls, EnhanceYourCalmError) else -self.jitter
+            delay *= 1 + random.uniform(low, self.jitter)
+            delay = min(delay, backoff.cap)
+        self.delay = delay
+        return delay
+
+    def _reset(self):
+        self.failures = 0
+        self.delay = 0
+        self._attempts.clear()
+
+    def _supervise(self, connection_items):
+        """Yield from ``connection_items(stream)`` for one connection after
+        another, backing off between them"""
+        stream = self.stream
+        while not self._closed.is_set():
+            try:
+                for item in connection_items(stream):
+                    if self.failures:
+                        self._reset()
+                    yield item
+            except ReconnectError as e:
+                stream.close()
+                if self._closed.is_set():
+                    return
+                self._closed.wait(self._backoff(e))
+                if self._closed.is_set():
+                    return
+                self.reconnects += 1
+
+    def __iter__(self):
+        return self._supervise(iter)
+
+    def iter_lines(self):
+        """Like iterating, but yields the raw framed messages without
+        decoding, dropping or counting them."""
+        return self._supervise(lambda stream: stream._read_lines())
+
+    def close(self):
+        """Stop reconnecting, interrupting any wait, and close the stream"""
+        self._closed.set()
+        self.stream.close()
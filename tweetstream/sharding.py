@@ -0,0 +1,509 @@
+"""Filtering on more terms than one connection allows.
+
+Twitter limits a filter connection to 400 track phrases, 5000 followed users
+and 25 location boxes. :class:`ShardedFilterStream` splits larger lists over
+as many :class:`~tweetstream.FilterStream` connections ("shards") as needed,
+reads them all in background threads and merges them into one stream::
+
+    stream = ShardedFilterStream(auth=auth, track=thousands_of_terms)
+    for tweet in stream:
+        print(tweet)
+
+Terms are placed by rendezvous hashing (see :func:`assign`), so a term stays
+on the same shard as others are added or removed, and changing the filter
+with :meth:`ShardedFilterStream.update_filter` only reconnects the shards
+whose terms actually changed. A tweet matching terms on several shards is
+returned once.
+"""
+
+import hashlib
+import math
+import struct
+import time
+import threading
+from collections import deque
+
+from .streamclasses import BaseStream, FilterStream, _SKIP
+from .matching import LocalFilter, _parse_boxes
+from .messages import TWEET
+from .dedupe import RecentIds
+from .resilient import ResilientStream, DEFAULT_SCHEDULES
+
+#: Maximum number of items of each filter parameter on one connection.
+LIMITS = dict(track=400, follow=5000, locations=25)
+
+PARAMETERS = ('track', 'follow', 'locations')
+
+
+def _hash(text):
+    # crc32 is too regular here: the rankings of similar items would be
+    # correlated and far more of them would move when a shard is added.
+    return struct.unpack('>Q', hashlib.md5(text.encode('utf-8')).digest()[:8])[0]
+
+
+def assign(items, shards, capacity):
+    """Split ``items`` (strings) into ``shards`` lists of at most ``capacity``
+    items each.
+
+    Each item goes to the shard ranking highest for it by a hash of the item
+    and the shard number, or the next one down if that shard is full. An
+    item's ranking doesn't depend on the other items, so adding or removing
+    items (or a shard) leaves nearly all the others where they were.
+    """
+    items = list(items)
+    if len(items) > shards * capacity:
+        raise ValueError('%d items do not fit in %d shards of %d'
+                         % (len(items), shards, capacity))
+    result = [[] for n in range(shards)]
+    # Items are placed in an order that only depends on the items themselves,
+    # so that the same set always gives the same result.
+    for item in sorted(items, key=lambda item: (_hash(item), item)):
+        ranking = sorted(range(shards), reverse=True,
+                         key=lambda n: _hash('%d:%s' % (n, item)))
+        for n in ranking:
+            if len(result[n]) < capacity:
+                result[n].append(item)
+                break
+    return result
+
+
+def _normalize(track, follow, locations):
+    """The filter parameters as lists of strings, with one string per
+    bounding box for locations"""
+    return dict(
+        track=[str(term) for term in (track or ())],
+        follow=[str(user_id) for user_id in (follow or ())],
+        locations=[','.join('%r' % value for value in box)
+                   for box in _parse_boxes(locations or ())],
+    )
+
+
+class Shard(object):
+    """One of the connections of a :class:`ShardedFilterStream`.
+
+    .. attribute:: index
+
+        Position of the shard in :attr:`ShardedFilterStream.shards`.
+
+    .. attribute:: parameters
+
+        The ``track``, ``follow`` and ``locations`` lists of this shard.
+
+    .. attribute:: stream
+
+        The :class:`~tweetstream.FilterStream` for the shard, or None if the
+        shard has no terms.
+
+    .. attribute:: supervisor
+
+        The :class:`~tweetstream.ResilientStream` reconnecting the shard.
+
+    .. attribute:: received
+
+        Number of messages received on the shard, including duplicates and
+        messages that aren't tweets.
+
+    .. attribute:: last_received
+
+        Time the last message was received, or None.
+
+    .. attribute:: rate
+
+        Messages per second received over the last
+        :attr:`ShardedFilterStream.rate_period`.
+    """
+
+    def __init__(self, index, parameters, stream, supervisor):
+        self.index = index
+        self.parameters = parameters
+        self.stream = stream
+        self.supervisor = supervisor
+        self.received = 0
+        self.last_received = None
+        self.rate = 0
+        self.error = None
+        self.replaces = None
+        self._rate_start = None
+        self._rate_count = 0
+        self._thread = None
+
+    @property
+    def connected(self):
+        return self.stream is not None and self.stream.connected
+
+    @property
+    def reconnects(self):
+        return self.supervisor.reconnects if self.supervisor else 0
+
+    @property
+    def failures(self):
+        return self.supervisor.failures if self.supervisor else 0
+
+    @property
+    def last_error(self):
+        if self.error is not None:
+            return self.error
+        return self.supervisor.last_error if self.supervisor else None
+
+    @property
+    def healthy(self):
+        """True if the shard is connected and has not failed since it last
+        received a message"""
+        return self.connected and not self.failures and self.error is None
+
+    def stats(self):
+        """The shard's state as a dict"""
+        return dict(
+            index=self.index,
+            track=len(self.parameters['track']),
+            follow=len(self.parameters['follow']),
+            locations=len(self.parameters['locations']),
+            connected=self.connected,
+            healthy=self.healthy,
+            received=self.received,
+            last_received=self.last_received,
+            rate=self.rate,
+            reconnects=self.reconnects,
+            failures=self.failures,
+            last_error=repr(self.last_error) if self.last_error else None,
+        )
+
+    def _count(self, period):
+        now = time.time()
+        self.received += 1
+        self.last_received = now
+        if self._rate_start is None:
+            self._rate_start = now
+        self._rate_count += 1
+        elapsed = now - self._rate_start
+        if elapsed >= period:
+            self.rate = self._rate_count / elapsed
+            self._rate_start = now
+            self._rate_count = 0
+
+    def _connected(self):
+        """Close the shard this one replaces once it is connected"""
+        replaced, self.replaces = self.replaces, None
+        if replaced is not None:
+            replaced.stop()
+
+    def stop(self):
+        if self.supervisor is not None:
+            self.supervisor.close()
+
+    def __repr__(self):
+        return '<Shard %d track=%d follow=%d locations=%d>' % (
+            self.index, len(self.parameters['track']),
+            len(self.parameters['follow']), len(self.parameters['locations']))
+
+
+class ShardedFilterStream(BaseStream):
+    """Filter stream spread over several connections.
+
+    Takes the same keyword arguments as :class:`~tweetstream.FilterStream`,
+    except ``catchup`` and ``checkpoint``, and also:
+
+    :keyword shards: Minimum number of connections. More are used if the
+      parameters don't fit, filling each up to :attr:`fill` of the limits.
+    :keyword maxsize: Maximum number of messages waiting to be taken from
+      the shards. Shard threads stop reading while it is full.
+    :keyword jitter, max_failures, schedules: Reconnection settings for each
+      shard, see :class:`~tweetstream.ResilientStream`.
+    :keyword session: ``requests.Session`` shared by all the connections. By
+      default each has its own.
+    :keyword record: As for :class:`~tweetstream.FilterStream`. All the shards
+      record into the same archive, before duplicates are removed.
+
+    Every shard reconnects by itself after errors, following Twitter's
+    backoff guidance. Errors that end a shard, such as
+    :class:`~tweetstream.FatalError` or giving up after ``max_failures``,
+    are raised in the consumer and close the stream.
+
+    Duplicates are detected by tweet id, so with more than one shard tweets
+    are always parsed, even with ``parse_json=False`` or ``lazy=True``.
+
+    .. attribute:: shards
+
+        List of :class:`Shard` objects, showing the state of each
+        connection.
+    """
+
+    url = FilterStream.url
+
+    #: Fraction of :data:`LIMITS` to fill on each shard when working out how
+    #: many shards are needed, leaving room for updates.
+    fill = 0.8
+
+    #: Maximum number of tweet ids remembered for removing duplicates.
+    dedupe_size = 100000
+
+    def __init__(self, auth=None, follow=None, locations=None, track=None,
+                 shards=1, parse_json=True, decode_unicode=True, timeout=90,
+                 url=None, delimited=None, decoder=None, drop=(),
+                 fields=None, lazy=False, local_filter=None, session=None,
+                 maxsize=10000, jitter=0.1, max_failures=None,
+                 schedules=DEFAULT_SCHEDULES, keepalive_interval=30,
+                 missed_keepalives=1, compression=False,
+                 transport='requests', record=None, user_cache=None):
+        if not track and not follow and not locations:
+            raise ValueError('Must specify at least one of track, follow or '
+                             'locations.')
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        BaseStream.__init__(self, auth=auth, session=None,
+                            parse_json=parse_json,
+                            decode_unicode=decode_unicode, timeout=timeout,
+                            url=url, delimited=delimited, decoder=decoder,
+                            drop=drop, fields=fields, lazy=lazy,
+                            keepalive_interval=keepalive_interval,
+                            missed_keepalives=missed_keepalives,
+                            compression=compression, transport=transport,
+                            record=record, user_cache=user_cache)
+        self.parameters = dict(track=track, follow=follow,
+                               locations=locations)
+        # A filter made from the parameters is remade when they change
+        self._derived_filter = local_filter is True
+        if local_filter is True:
+            local_filter = LocalFilter(**self.parameters)
+        elif isinstance(local_filter, dict):
+            local_filter = LocalFilter(**local_filter)
+        self.local_filter = local_filter
+
+        self.min_shards = shards
+        self.maxsize = maxsize
+        self._session = session
+        self._resilience = dict(jitter=jitter, max_failures=max_failures,
+                                schedules=schedules)
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._error = None
+        self._started = False
+        self._stopped = False
+        self._recent = None
+
+        self.shards = [self._make_shard(n, parameters) for n, parameters
+                       in enumerate(self._partition(self.parameters))]
+
+    def _shard_count(self, parameters):
+        count = self.min_shards
+        for name in PARAMETERS:
+            per_shard = max(1, int(LIMITS[name] * self.fill))
+            needed = int(math.ceil(len(parameters[name]) / float(per_shard)))
+            count = max(count, needed)
+        return count
+
+    def _partition(self, parameters):
+        """Split the parameters into one dict per shard"""
+        parameters = _normalize(**parameters)
+        count = self._shard_count(parameters)
+        split = dict((name, assign(parameters[name], count, LIMITS[name]))
+                     for name in PARAMETERS)
+        return [dict((name, split[name][n]) for name in PARAMETERS)
+                for n in range(count)]
+
+    def _make_shard(self, index, parameters):
+        if not any(parameters.values()):
+            return Shard(index, parameters, None, None)
+        stream = FilterStream(auth=self._auth, session=self._session,
+                              parse_json=False, decode_unicode=False,
+                              timeout=self._timeout, url=self.url,
+                              delimited=self._delimited,
+                              keepalive_interval=self.keepalive_interval,
+                              missed_keepalives=self.missed_keepalives,
+                              compression=self._compression,
+                              transport=self._transport,
+                              record=self.recorder, **parameters)
+        stream.user_agent = self.user_agent
+        supervisor = ResilientStream(stream, **self._resilience)
+        return Shard(index, parameters, stream, supervisor)
+
+    @property
+    def connected(self):
+        return any(shard.connected for shard in self.shards)
+
+    @connected.setter
+    def connected(self, value):
+        pass  # set by BaseStream.__init__; derived from the shards
+
+    def _start_shard(self, shard):
+        if shard.stream is None:
+            return
+        shard._thread = threading.Thread(target=self._run, args=(shard,))
+        shard._thread.daemon = True
+        shard._thread.start()
+
+    def start(self):
+        """Connect the shards. Called on first iteration if needed."""
+        if self._started:
+            return
+        if self._stopped:
+            # Shards can't be restarted, so make new ones
+            self.shards = [self._make_shard(shard.index, shard.parameters)
+                           for shard in self.shards]
+        self._started = True
+        self._stopped = False
+        self._error = None
+        if not self.starttime:
+            self.starttime = time.time()
+        active = [shard for shard in self.shards if shard.stream is not None]
+        if len(active) > 1 and self._recent is None:
+            self._recent = RecentIds(self.dedupe_size)
+        for shard in active:
+            self._start_shard(shard)
+
+    def _run(self, shard):
+        def connection_lines(stream):
+            if not stream.connected:
+                stream._init_conn()
+            shard._connected()
+            return stream._read_lines()
+
+        try:
+            for line in shard.supervisor._supervise(connection_lines):
+                shard._count(self.rate_period)
+                self._put(line)
+                if self._stopped:
+                    return
+        except Exception as e:
+            if self._stopped or shard.supervisor._closed.is_set():
+                return
+            shard.error = e
+            with self._cond:
+                if self._error is None:
+                    self._error = e
+                self._cond.notify_all()
+        finally:
+            # The shard may have reconnected while it was being stopped
+            shard.stream.close()
+
+    def _put(self, line):
+        with self._cond:
+            while len(self._queue) >= self.maxsize and not self._stopped:
+                self._cond.wait()
+            if self._stopped:
+                return
+            self._queue.append(line)
+            self._cond.notify_all()
+
+    def _get(self):
+        with self._cond:
+            while True:
+                if self._queue:
+                    line = self._queue.popleft()
+                    self._cond.notify_all()
+                    return line
+                if self._error is not None:
+                    error = self._error
+                    self._error = None
+                    self.close()
+                    raise error
+                self._cond.wait()
+
+    def _is_new(self, parsed):
+        try:
+            tweet_id = parsed.get('id')
+        except AttributeError:
+            return True
+        return tweet_id is None or self._recent.add(tweet_id)
+
+    def __iter__(self):
+        self.start()
+        while True:
+            line = self._get()
+            message_type = self._select(line)
+            if message_type is None:
+                continue
+
+            parsed = None
+            if message_type == TWEET and self._recent is not None:
+                parsed = self._parse(line)
+                if not self._is_new(parsed):
+                    continue
+            local_filter = self.local_filter
+            if message_type == TWEET and local_filter is not None:
+                if parsed is None:
+                    parsed = self._parse(line)
+                if not local_filter.matches(parsed):
+                    continue
+
+            if self._lazy_class is not None or not self._parse_json:
+                parsed = None
+            tweet = self._deliver(message_type, self._convert(line, parsed))
+            if tweet is not _SKIP:
+                yield tweet
+
+    def update_filter(self, track=None, follow=None, locations=None):
+        """Change the filter parameters, reconnecting only the shards whose
+        terms change.
+
+        Each changed shard keeps running until its replacement is connected,
+        and tweets arriving on both are only returned once. Returns the
+        indexes of the changed shards. Can be called from any thread.
+        """
+        if not track and not follow and not locations:
+            raise ValueError('Must specify at least one of track, follow or '
+                             'locations.')
+        parameters = dict(track=track, follow=follow, locations=locations)
+        partition = self._partition(parameters)
+        local_filter = self.local_filter
+        if self._derived_filter:
+            local_filter = LocalFilter(**parameters)
+        self.parameters = parameters
+        self.local_filter = local_filter
+
+        old = self.shards
+        shards = []
+        changed = []
+        for n, shard_parameters in enumerate(partition):
+            if n < len(old) and old[n].parameters == shard_parameters:
+                shards.append(old[n])
+                continue
+            shard = self._make_shard(n, shard_parameters)
+            if n < len(old):
+                shard.replaces = old[n]
+            shards.append(shard)
+            changed.append(n)
+        removed = old[len(partition):]
+        self.shards = shards
+
+        if self._started:
+            if self._recent is None:
+                self._recent = RecentIds(self.dedupe_size)
+            for n in changed:
+                shard = shards[n]
+                if shard.stream is None:
+                    if shard.replaces is not None:
+                        shard.replaces.stop()
+                        shard.replaces = None
+                else:
+                    self._start_shard(shard)
+            for shard in removed:
+                shard.stop()
+        return changed
+
+    def stats(self):
+        """List of :meth:`Shard.stats` dicts, one per shard"""
+        return [shard.stats() for shard in self.shards]
+
+    def close(self):
+        """Close all the shards"""
+        with self._cond:
+            self._stopped = True
+            self._started = False
+            self._queue.clear()
+            self._cond.notify_all()
+        for shard in self.shards:
+            if shard.replaces is not None:
+                shard.replaces.stop()
+                shard.replaces = None
+            shard.stop()
+        for shard in self.shards:
+            if shard._thread is not None and \
+                    shard._thread is not threading.current_thread():
+                shard._thread.join(1)
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def _disconnect(self):
+        self.close()
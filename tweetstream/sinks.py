@@ -0,0 +1,396 @@
+"""Writing streams to disk in batches.
+
+Writing each message as it comes out of the iterator costs a system call,
+or a database transaction, per tweet. A sink collects messages and writes
+them in batches instead, committing a batch once it holds ``max_items``
+messages or ``max_latency`` seconds after its first message arrived,
+whichever comes first::
+
+    stream = SampleStream(auth=auth, parse_json=False, decode_unicode=False)
+    with JSONLinesSink('tweets') as sink:
+        sink.consume(stream)
+
+:meth:`~BatchSink.consume` reads a stream with ``iter_batches`` where it
+has one, so a batch is framed, processed and written in one go. Messages
+can also be added one at a time with :meth:`~BatchSink.write`; a background
+thread commits batches that are due even when no more messages come.
+
+Raw messages (``parse_json=False, decode_unicode=False``) are written as the
+bytes received, without being decoded or parsed. Parsed messages, including
+records, are written as compact JSON.
+"""
+
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+
+from .messages import classify, classify_object
+from .records import Record, LazyRecord
+
+try:
+    text_type = unicode
+except NameError:  # Python 3
+    text_type = str
+
+_identifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _as_json(message):
+    """Return a message from a stream as JSON: bytes for raw and decoded
+    messages, which are passed through, or text for parsed ones"""
+    if isinstance(message, bytes):
+        return message
+    if isinstance(message, text_type):
+        return message.encode('utf-8')
+    if isinstance(message, LazyRecord) and message._projection is None:
+        return message.raw
+    if isinstance(message, (Record, LazyRecord)):
+        message = message._asdict()
+    return json.dumps(message, ensure_ascii=False, separators=(',', ':'))
+
+
+class BatchSink(object):
+    """Base class of the sinks, collecting messages into batches.
+
+    :keyword max_items: Commit a batch once it holds this many messages.
+    :keyword max_latency: Commit a batch at most this many seconds after its
+      first message was written.
+    :keyword sync_interval: Make committed batches durable, e.g. with
+      ``fsync``, at most this many seconds after they were committed. 0
+      syncs every batch, None leaves it to the operating system.
+
+    Sinks are thread safe, and are context managers that close on exit.
+    Errors writing in the background thread are raised by the next call.
+
+    .. attribute:: written
+
+        Number of messages committed.
+
+    .. attribute:: batches
+
+        Number of batches committed.
+
+    .. attribute:: syncs
+
+        Number of times committed data was synced.
+    """
+
+    def __init__(self, max_items=1000, max_latency=1.0, sync_interval=1.0):
+        if max_items < 1:
+            raise ValueError('max_items must be at least 1')
+        self.max_items = max_items
+        self.max_latency = max_latency
+        self.sync_interval = sync_interval
+        self.written = 0
+        self.batches = 0
+        self.syncs = 0
+
+        self._cond = threading.Condition()
+        self._pending = []
+        self._deadline = None   # when the pending batch must be committed
+        self._sync_due = None   # when committed data must be synced
+        self._error = None
+        self._closed = False
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *params):
+        self.close()
+        return False
+
+    def _write(self, messages, now):
+        """Commit a batch. Implemented by subclasses."""
+        raise NotImplementedError
+
+    def _sync(self):
+        """Make committed batches durable. Implemented by subclasses."""
+
+    def _close(self):
+        """Release files and connections. Implemented by subclasses."""
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        if self._closed:
+            raise ValueError('Sink is closed')
+
+    def write(self, message):
+        """Add a message to the current batch"""
+        self.write_many([message])
+
+    def write_many(self, messages, flush=False):
+        """Add messages to the current batch, committing it right away if
+        ``flush`` is True"""
+        with self._cond:
+            self._check()
+            if not self._pending:
+                self._deadline = time.time() + self.max_latency
+            self._pending.extend(messages)
+            if flush or len(self._pending) >= self.max_items:
+                self._flush()
+            else:
+                self._wake()
+
+    def flush(self):
+        """Commit the current batch, and sync everything committed"""
+        with self._cond:
+            self._check()
+            self._flush(sync=True)
+
+    def _wake(self):
+        """Have the background thread check for work that is due"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        self._cond.notify()
+
+    def _flush(self, sync=False):
+        """Commit the pending batch and sync if it's time to. Called with
+        the lock held."""
+        now = time.time()
+        pending = self._pending
+        if pending:
+            self._pending = []
+            self._deadline = None
+            self._write(pending, now)
+            self.written += len(pending)
+            self.batches += 1
+            if self.sync_interval is not None and self._sync_due is None:
+                self._sync_due = now + self.sync_interval
+        if self._sync_due is not None:
+            if sync or now >= self._sync_due:
+                self._sync()
+                self._sync_due = None
+                self.syncs += 1
+            else:
+                self._wake()
+
+    def _run(self):
+        with self._cond:
+            while not self._closed:
+                due = [t for t in (self._deadline, self._sync_due)
+                       if t is not None]
+                if not due or self._error is not None:
+                    self._cond.wait()
+                    continue
+                delay = min(due) - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                try:
+                    self._flush()
+                except Exception as e:
+                    self._error = e
+
+    def consume(self, stream):
+        """Write everything ``stream`` returns until it ends, committing a
+        batch per batch the stream returns. The sink is flushed before
+        returning, and before any exception from the stream is raised."""
+        batches = getattr(stream, 'iter_batches', None)
+        try:
+            if batches is not None:
+                for batch in batches(max_items=self.max_items,
+                                     max_latency=self.max_latency):
+                    self.write_many(batch, flush=True)
+            else:
+                for message in stream:
+                    self.write(message)
+        finally:
+            self.flush()
+
+    def close(self):
+        """Commit and sync what is pending, and close the files"""
+        with self._cond:
+            if self._closed:
+                return
+            try:
+                if self._error is None:
+                    self._flush(sync=True)
+            finally:
+                self._closed = True
+                self._cond.notify()
+                self._close()
+        if self._thread is not None:
+            self._thread.join(1)
+        if self._error is not None:
+            self._check()
+
+
+class JSONLinesSink(BatchSink):
+    """Write messages to rotating files, one JSON message per line.
+
+    :param path: Directory for the files, created if needed. Files are named
+      ``<prefix>-000001.jsonl`` and so on; writing into a directory that
+      already has some carries on after the last one.
+    :keyword prefix: Start of the file names.
+    :keyword rotate_bytes: Start a new file once this many bytes have been
+      written to the current one.
+    :keyword rotate_seconds: Start a new file after this many seconds, or
+      None to only rotate by size.
+
+    ``max_items``, ``max_latency`` and ``sync_interval`` are as for
+    :class:`BatchSink`; syncing is done with ``fsync``. Every batch is
+    passed to the operating system as it is committed, so other processes
+    can read it right away.
+
+    .. attribute:: filename
+
+        Path of the file being written, or None.
+    """
+
+    def __init__(self, path, prefix='tweets', rotate_bytes=256 << 20,
+                 rotate_seconds=None, max_items=1000, max_latency=1.0,
+                 sync_interval=1.0):
+        BatchSink.__init__(self, max_items=max_items,
+                           max_latency=max_latency,
+                           sync_interval=sync_interval)
+        self.path = path
+        self.prefix = prefix
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        pattern = re.compile(r'^%s-(\d+)\.jsonl$' % re.escape(prefix))
+        numbers = [int(match.group(1)) for match in
+                   (pattern.match(name) for name in os.listdir(path))
+                   if match]
+        self._next = max(numbers or [0]) + 1
+        self.filename = None
+        self._file = None
+        self._opened = None
+        self._size = 0
+
+    def _open(self, now):
+        self.filename = os.path.join(self.path, '%s-%06d.jsonl'
+                                     % (self.prefix, self._next))
+        self._next += 1
+        self._file = open(self.filename, 'ab')
+        self._opened = now
+        self._size = 0
+
+    def _finish(self):
+        if self._file is None:
+            return
+        self._file.flush()
+        if self.sync_interval is not None:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+    def _write(self, messages, now):
+        if self._file is not None and (
+                self._size >= self.rotate_bytes or
+                (self.rotate_seconds is not None and
+                 now - self._opened >= self.rotate_seconds)):
+            self._finish()
+        if self._file is None:
+            self._open(now)
+        lines = [_as_json(message) for message in messages]
+        for n, line in enumerate(lines):
+            if not isinstance(line, bytes):
+                lines[n] = line.encode('utf-8')
+        data = b"\n".join(lines) + b"\n"
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+
+    def _sync(self):
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+
+    def _close(self):
+        self._finish()
+
+
+class SQLiteSink(BatchSink):
+    """Write messages to a SQLite table, a transaction per batch.
+
+    :param path: The database file, created if needed.
+    :keyword table: Name of the table, created if needed with the columns
+      ``id`` (the message's top level id, or NULL), ``type`` (see
+      :mod:`tweetstream.messages`), ``received`` (time the batch was
+      committed) and ``message`` (the message as JSON text).
+    :keyword synchronous: SQLite's ``synchronous`` setting. With the default,
+      ``NORMAL``, and the write-ahead log, a committed batch survives the
+      process crashing, and is synced to disk at SQLite's checkpoints.
+
+    ``max_items`` and ``max_latency`` are as for :class:`BatchSink`. Each
+    batch is inserted with a single ``executemany`` call. Raw messages are
+    stored without being decoded in Python, with their ids read by SQLite's
+    ``json_extract`` where it is available.
+    """
+
+    def __init__(self, path, table='tweets', synchronous='NORMAL',
+                 max_items=1000, max_latency=1.0):
+        BatchSink.__init__(self, max_items=max_items,
+                           max_latency=max_latency, sync_interval=None)
+        if not _identifier.match(table):
+            raise ValueError('Invalid table name %r' % (table,))
+        if synchronous.upper() not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            raise ValueError('Invalid synchronous setting %r' % (synchronous,))
+        self.path = path
+        self.table = table
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=%s' % synchronous.upper())
+        self._db.execute('CREATE TABLE IF NOT EXISTS %s (id INTEGER, '
+                         'type TEXT, received REAL, message TEXT)' % table)
+        try:
+            self._db.execute("SELECT json_extract('{}', '$.id')")
+            raw_id = "json_extract(CAST(?1 AS TEXT), '$.id')"
+        except sqlite3.OperationalError:  # built without JSON support
+            raw_id = "NULL"
+        self._insert_raw = (
+            'INSERT INTO %s (id, type, received, message) '
+            'VALUES (%s, ?2, ?3, CAST(?1 AS TEXT))' % (table, raw_id))
+        self._insert = ('INSERT INTO %s (id, type, received, message) '
+                        'VALUES (?, ?, ?, ?)' % table)
+
+    def _rows(self, message, now):
+        """The statement inserting a message, and its parameters"""
+        if isinstance(message, text_type):
+            message = message.encode('utf-8')
+        elif isinstance(message, LazyRecord) and message._projection is None:
+            message = message.raw
+        if isinstance(message, bytes):
+            return self._insert_raw, (message, classify(message), now)
+        if isinstance(message, (Record, LazyRecord)):
+            message_type = 'tweet'
+            tweet_id = message.get('id')
+        else:
+            message_type = classify_object(message)
+            tweet_id = message.get('id') if isinstance(message, dict) else None
+        return self._insert, (tweet_id, message_type, now, _as_json(message))
+
+    def _write(self, messages, now):
+        db = self._db
+        db.execute('BEGIN')
+        try:
+            # One executemany per run of messages inserted the same way,
+            # keeping them in order
+            statement = None
+            rows = []
+            for message in messages:
+                next_statement, row = self._rows(message, now)
+                if next_statement is not statement and rows:
+                    db.executemany(statement, rows)
+                    rows = []
+                statement = next_statement
+                rows.append(row)
+            if rows:
+                db.executemany(statement, rows)
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _close(self):
+        self._db.close()
@@ -1,8 +1,13 @@
 from __future__ import unicode_literals
 
+import copy
 import time
-import json
 import ssl
+import select
+import socket
+import threading
+import zlib
+from collections import deque
 
 import requests
 try:
@@ -11,19 +16,50 @@ except ImportError:
     from httplib import IncompleteRead
 
 from . import USER_AGENT
+from .framing import LineFramer, LengthFramer
+from .decoders import get_decoder
+from .messages import classify, TWEET, MESSAGE_TYPES
+from .matching import LocalFilter
+from .records import Projection, lazy_record_class
+from .dedupe import RecentIds
+from .metrics import StreamMetrics, timer
+from .transport import open_socket, SocketResponse
+from .archive import ArchiveWriter
+from .checkpoint import Checkpoint
+from .users import UserCache
+from .columns import Columns
 from .exceptions import (
-    ReconnectImmediatelyError, ReconnectLinearlyError, EnhanceYourCalmError,
-    ReconnectExponentiallyError, AuthenticationError, FatalError,
+    ReconnectError, ReconnectImmediatelyError, ReconnectLinearlyError,
+    EnhanceYourCalmError, ReconnectExponentiallyError, AuthenticationError,
+    FatalError,
 )
 
+# Returned by _process_line for messages that shouldn't be yielded
+_SKIP = object()
+
+# Errors from reading the response, translated by _connection_error
+_READ_ERRORS = (requests.Timeout, requests.ConnectionError, socket.timeout,
+                socket.error, ssl.SSLError, IncompleteRead)
+_ChunkedEncodingError = getattr(requests.exceptions, 'ChunkedEncodingError',
+                                None)
+if _ChunkedEncodingError is not None:
+    _READ_ERRORS += (_ChunkedEncodingError,)
+
 
 class BaseStream(object):
     """A network connection to Twitters streaming API
 
     :param username: Twitter username for the account accessing the API.
     :param password: Twitter password for the account accessing the API.
-    :keyword count: Number of tweets from the past to get before switching to
-      live stream.
+    :keyword catchup: Number of tweets from the past to get before switching
+      to live stream, on every connection. With a ``checkpoint``, the most
+      to ask for instead.
+    :keyword checkpoint: Keep track of the last tweet received, and ask for
+      as many past tweets on connecting as are likely to have been missed
+      since, going by the recent tweet rate, up to ``catchup`` or
+      :attr:`max_catchup`. Tweets received before the gap are removed by
+      id. Either the path of a file, which makes the position survive
+      restarts, or a :class:`~tweetstream.checkpoint.Checkpoint`.
     :keyword raw: If True, return each tweet's raw data direct from the socket,
       without UTF8 decoding or parsing, rather than a parsed object. The
       default is False.
@@ -32,6 +68,55 @@ class BaseStream(object):
       can cause the connection to hang, leading to indefinite blocking that
       requires kill -9 to resolve. Setting a timeout leads to an orderly
       shutdown in these cases. The default is Twitter's suggested 90 seconds.
+    :keyword keepalive_interval: Seconds between the keep-alive lines the
+      server sends on an idle stream. Twitter sends them every 30 seconds.
+    :keyword missed_keepalives: Consider the connection stalled, and raise
+      :class:`~tweetstream.ReconnectImmediatelyError`, once this many
+      keep-alives in a row have failed to arrive with no data in between.
+      With the defaults a dead connection is noticed within 36 seconds
+      rather than after the 90 second ``timeout``. None leaves it to
+      ``timeout``.
+    :keyword compression: If True, ask for the stream to be gzip compressed,
+      which cuts the bandwidth used several times over. The body is
+      decompressed incrementally as it arrives, so tweets are not held back.
+      The default is to ask for an uncompressed stream.
+    :keyword transport: ``"requests"`` (the default) to connect and read
+      through :mod:`requests`, or ``"socket"`` to read the response body
+      straight from the socket into a preallocated buffer, decoding chunked
+      encoding without copying. The request is built and authenticated by
+      :mod:`requests` either way. The socket transport doesn't use proxies
+      or the session's certificate settings.
+    :keyword record: Record every message received, with the time it arrived,
+      for later replay with :class:`~tweetstream.replay.ReplayStream`.
+      Either the path of an archive directory or an
+      :class:`~tweetstream.archive.ArchiveWriter`. Messages are recorded raw,
+      before they are dropped, filtered or parsed.
+    :keyword delimited: If set to ``"length"``, ask Twitter to prefix every
+      message with its size in bytes and read messages by length instead of
+      scanning for line breaks. The default, None, uses newline framing.
+    :keyword decoder: JSON decoder used when ``parse_json`` is True. Either a
+      callable taking the raw bytes of a message, or the name of one of the
+      backends in :data:`tweetstream.decoders.decoders`. The default is the
+      fastest one installed (orjson, simdjson or ujson, falling back to the
+      standard library). Decoders parse the raw bytes directly, so there is
+      no separate UTF-8 decoding step.
+    :keyword drop: Message types (see :mod:`tweetstream.messages`) to discard
+      as soon as they are received, before any decoding or parsing. For
+      example ``drop=['delete', 'scrub_geo']``.
+    :keyword fields: Dotted paths of the tweet fields to keep, e.g.
+      ``['id', 'text', 'user.screen_name']``. Parsed messages are returned as
+      compact :class:`~tweetstream.records.Record` objects holding only those
+      fields instead of dicts.
+    :keyword lazy: If True, return :class:`~tweetstream.records.LazyRecord`
+      objects that keep the raw bytes of each message and only parse it
+      when a field is first accessed. Combines with ``fields``. Invalid
+      JSON is not detected until then.
+    :keyword user_cache: If True, or a :class:`~tweetstream.users.UserCache`,
+      tweets from the same user share one ``user`` dict while the user's
+      fields stay the same, and repeated strings such as ``lang`` and
+      ``source`` are interned, which saves memory when many tweets are kept.
+      Needs ``parse_json``, and doesn't work with ``lazy``. Statistics are
+      in :attr:`metrics`.
     :keyword url: Endpoint URL for the object. Note: you should not
       need to edit this. It's present to make testing easier.
 
@@ -57,6 +142,26 @@ class BaseStream(object):
         The rate at which tweets have been returned from the object as a
         float. see also :attr: `rate_period`.
 
+    .. attribute:: metrics
+
+        A :class:`~tweetstream.metrics.StreamMetrics` object with message and
+        byte rates, counts per message type, keep-alives, reconnects and
+        parsing times.
+
+    .. attribute:: recorder
+
+        The :class:`~tweetstream.archive.ArchiveWriter` messages are recorded
+        with, or None. Closing the stream finishes the current segment.
+
+    .. attribute:: checkpoint
+
+        The :class:`~tweetstream.checkpoint.Checkpoint` in use, or None.
+        Closing the stream saves it.
+
+    .. attribute:: user_cache
+
+        The :class:`~tweetstream.users.UserCache` in use, or None.
+
     .. attribute:: rate_period
 
         The ammount of time to sample tweets to calculate tweet rate. By
@@ -65,6 +170,12 @@ class BaseStream(object):
         with time of day etc. so it's usefull to set this to something
         sensible.
 
+    .. attribute:: chunk_size
+
+        The maximum number of bytes read from the socket in one go. The
+        default is 64 KiB. Reads never wait for a full chunk, so this does not
+        delay delivery of tweets on quiet streams.
+
     .. attribute:: user_agent
 
         User agent string that will be included in the request. NOTE: This can
@@ -73,8 +184,29 @@ class BaseStream(object):
         :attr: `USER_AGENT`.
     """
 
+    local_filter = None
+
+    #: Extra time, as a fraction of :attr:`keepalive_interval`, allowed for a
+    #: keep-alive to arrive before it counts as missed.
+    keepalive_slack = 0.2
+
+    #: Largest number of past tweets Twitter sends on connecting.
+    max_catchup = 150000
+
+    #: Factor by which the catchup asked for with a checkpoint exceeds the
+    #: estimated number of missed tweets, allowing for a varying rate.
+    catchup_margin = 1.2
+
+    # [id of the last tweet received before a gap, number of tweets still
+    # to check for it] while tweets sent again may be arriving
+    _overlap = None
+
     def __init__(self, auth=None, session=None, catchup=None, parse_json=True,
-                 decode_unicode=True, timeout=90, url=None):
+                 decode_unicode=True, timeout=90, url=None, delimited=None,
+                 decoder=None, drop=(), fields=None, lazy=False,
+                 keepalive_interval=30, missed_keepalives=1,
+                 compression=False, transport='requests', record=None,
+                 checkpoint=None, user_cache=None):
         self._conn = None
         self._rate_ts = None
         self._rate_cnt = 0
@@ -84,15 +216,49 @@ class BaseStream(object):
             raise ValueError('Cannot parse json without first decoding.')
         self._parse_json = parse_json
         self._decode_unicode = decode_unicode
+        self._decoder = get_decoder(decoder)
+        if (fields or lazy) and not parse_json:
+            raise ValueError('fields and lazy records need parse_json.')
+        self._projection = Projection(fields) if fields and not lazy else None
+        self._lazy_class = lazy_record_class(self._decoder, fields) if lazy else None
+        if user_cache is False:
+            user_cache = None
+        if user_cache is not None and (lazy or not parse_json):
+            raise ValueError('user_cache needs parse_json and not lazy.')
+        if user_cache is True:
+            user_cache = UserCache()
+        self.user_cache = user_cache
+        self._drop = frozenset(drop)
+        for message_type in self._drop:
+            self._check_message_type(message_type)
+        self._handlers = {}
         self._timeout = timeout
-        self._iter = self.__iter__()
+        self.keepalive_interval = keepalive_interval
+        self.missed_keepalives = missed_keepalives
+        self._compression = compression
+        if transport not in ('requests', 'socket'):
+            raise ValueError('transport must be "requests" or "socket".')
+        self._transport = transport
+        if delimited not in (None, 'length'):
+            raise ValueError('delimited must be None or "length".')
+        self._delimited = delimited
+        self._iter = None
+        if record is not None and not hasattr(record, 'write'):
+            record = ArchiveWriter(record)
+        self.recorder = record
+        if checkpoint is not None and not isinstance(checkpoint, Checkpoint):
+            checkpoint = Checkpoint(checkpoint, decoder=self._decoder)
+        self.checkpoint = checkpoint
 
         self.rate_period = 10  # in seconds
         self.connected = False
         self.starttime = None
         self.count = 0
         self.rate = 0
+        self.metrics = StreamMetrics()
+        self.metrics.users = self.user_cache
         self.user_agent = USER_AGENT
+        self.chunk_size = 65536
         if url: self.url = url
 
         self._auth = auth
@@ -105,117 +271,664 @@ class BaseStream(object):
         self.close()
         return False
 
-    def _init_conn(self):
-        """Open the connection to the twitter server"""
+    def _prepare_client(self):
+        """Set up the session and return the request method, post data and
+        query parameters for connecting to the stream"""
 
         if not self._client:
             self._client = requests.Session()
 
-        self._client.headers.update({'User-Agent': self.user_agent})
+        self._client.headers.update({
+            'User-Agent': self.user_agent,
+            'Accept-Encoding': 'gzip' if self._compression else 'identity',
+        })
 
         if self._auth:
             self._client.auth = self._auth
 
         postdata = self._get_post_data() or {}
-        if self._catchup_count:
-            postdata["count"] = self._catchup_count
+        count = self._catchup()
+        if count:
+            postdata["count"] = count
 
         req_method = 'post' if postdata else 'get'
 
+        params = {}
+        if self._delimited:
+            params["delimited"] = self._delimited
+
+        return req_method, postdata, params
+
+    def _catchup(self):
+        """The number of past tweets to ask for on connecting"""
+        checkpoint = self.checkpoint
+        if checkpoint is None:
+            return self._catchup_count
+        count = min(checkpoint.backfill(time.time(), self.catchup_margin),
+                    self._catchup_count or self.max_catchup,
+                    self.max_catchup)
+        if count and checkpoint.last_id is not None:
+            self._overlap = [checkpoint.last_id, count]
+        else:
+            self._overlap = None
+        return count
+
+    def _prepare_request(self):
+        """Build and authenticate the request for transports that send it
+        themselves"""
+        req_method, postdata, params = self._prepare_client()
+        headers = dict(self._client.headers)
+        # The connection is ours alone. Accept-Encoding is already set by
+        # _prepare_client, and compressed bodies are handled in _iter_chunks.
+        headers['Connection'] = 'close'
+        request = requests.Request(req_method.upper(), self.url, data=postdata,
+                                   params=params, headers=headers,
+                                   auth=self._client.auth)
+        return request.prepare()
+
+    def _open_socket(self):
+        """Connect with the socket transport, returning the response"""
+        try:
+            conn = open_socket(self._prepare_request(), self._timeout)
+        except (socket.error, ssl.SSLError, ValueError) as e:
+            raise ReconnectExponentiallyError(str(e) or e.__class__.__name__)
+        if conn.status >= 400:
+            conn.close()
+            self._raise_for_status(conn.status, "%s %s for url: %s"
+                                   % (conn.status, conn.reason, self.url))
+        return conn
+
+    def _raise_for_status(self, code, message):
+        """Raise the exception matching an HTTP error status code"""
+        if code == 401:
+            raise AuthenticationError("Access denied")
+        elif code == 404:
+            raise FatalError("%s: %s" % (self.url, message))
+        elif code in (406, 413, 416):
+            raise FatalError(message)
+        elif code == 420:
+            raise EnhanceYourCalmError
+        else:
+            raise ReconnectExponentiallyError(message)
+
+    def _init_conn(self):
+        """Open the connection to the twitter server"""
+
+        if self._transport == 'socket':
+            self._conn = self._open_socket()
+            self.connected = True
+            self.metrics.connects += 1
+            self._arm_watchdog()
+            if not self.starttime:
+                self.starttime = time.time()
+            return
+
+        req_method, postdata, params = self._prepare_client()
+
         # If connecting fails, convert to ReconnectExponentiallyError so
         # clients can implement appropriate backoff.
         try:
             self._conn = self._client.request(req_method, self.url, data=postdata,
-                                              stream=True, timeout=self._timeout)
+                                              params=params, stream=True,
+                                              timeout=self._timeout)
             self._conn.raise_for_status()
         except requests.HTTPError as e:
-            code = e.response.status_code
-            if code == 401:
-                raise AuthenticationError("Access denied")
-            elif code == 404:
-                raise FatalError("%s: %s" % (self.url, e))
-            elif code in (406, 413, 416):
-                raise FatalError(str(e))
-            elif code == 420:
-                raise EnhanceYourCalmError
-            else:
-                raise ReconnectExponentiallyError(str(e))
+            self._raise_for_status(e.response.status_code, str(e))
         except requests.ConnectionError as e:
             raise ReconnectExponentiallyError(str(e))
         else:
             self.connected = True
+            self.metrics.connects += 1
+            self._arm_watchdog()
         if not self.starttime:
             self.starttime = time.time()
 
+    @property
+    def stall_timeout(self):
+        """Seconds without any data or keep-alive after which the connection
+        is considered stalled, or None if that isn't checked"""
+        if not self.missed_keepalives or not self.keepalive_interval:
+            return None
+        return self.keepalive_interval * (self.missed_keepalives +
+                                          self.keepalive_slack)
+
+    def _read_timeout(self):
+        """The read timeout in effect, and whether it is the stall timeout"""
+        timeout = self._timeout
+        if isinstance(timeout, tuple):
+            timeout = timeout[1]
+        stall = self.stall_timeout
+        if stall is not None and (timeout is None or stall < timeout):
+            return stall, True
+        return timeout, False
+
+    def _arm_watchdog(self):
+        """Make reads from the new connection time out once it has stalled.
+
+        Any data, keep-alives included, satisfies a socket read, so a read
+        timeout is exactly "nothing received for this long", and costs
+        nothing while data is flowing."""
+        timeout, stall = self._read_timeout()
+        sock = self._socket() if stall else None
+        if sock is not None:
+            sock.settimeout(timeout)
+
+    def _timed_out(self):
+        self._disconnect()
+        timeout, stall = self._read_timeout()
+        if stall:
+            self.metrics.stalls += 1
+            raise ReconnectImmediatelyError(
+                "Stream stalled: nothing received for %g seconds." % timeout)
+        raise ReconnectImmediatelyError("Stream timed out.")
+
     def _get_post_data(self):
         """Subclasses that need to add post data to the request can override
         this method and return post data. The data should be in the format
         returned by urllib.urlencode."""
         return None
 
+    def _iter_chunks(self):
+        """Yield blocks of body data as soon as they arrive on the socket.
+
+        ``iter_content`` blocks until it has read a full ``chunk_size`` block,
+        which holds tweets back on quiet streams unless the chunk size is 1.
+        When the underlying ``HTTPResponse`` supports ``read1`` we use that
+        instead, getting whatever is available (up to :attr:`chunk_size`
+        bytes) in a single call. Python 2's doesn't, so a chunked response
+        is read up to the end of the HTTP chunk in progress instead, see
+        :meth:`_read_in_chunk`.
+
+        With the socket transport, chunks are memoryviews of the receive
+        buffer, only valid until the next chunk is read."""
+        conn = self._conn
+        if isinstance(conn, SocketResponse):
+            chunks = conn.iter_body(self.chunk_size)
+        else:
+            fp = getattr(conn.raw, '_fp', None)
+            read1 = getattr(fp, 'read1', None)
+            if read1 is None and getattr(fp, 'chunked', False):
+                read1 = lambda size: self._read_in_chunk(fp, size)
+            if read1 is None:
+                for chunk in conn.iter_content(chunk_size=1):
+                    self.metrics.wire_bytes += len(chunk)
+                    yield chunk
+                return
+            chunks = iter(lambda: read1(self.chunk_size), b"")
+
+        # Reading from the raw response bypasses urllib3's decoding, so a
+        # compressed body is decompressed here instead.
+        decompressor = self._decompressor(conn.headers.get('content-encoding'))
+        try:
+            for chunk in chunks:
+                # Looked up for every chunk, as a filter update hands the
+                # connection over to another stream's metrics
+                self.metrics.wire_bytes += len(chunk)
+                if decompressor is not None:
+                    chunk = self._decompress(decompressor, chunk)
+                    if not chunk:
+                        continue
+                yield chunk
+        except ValueError as e:
+            # Malformed chunked encoding, from the socket transport
+            self._disconnect()
+            raise ReconnectImmediatelyError("Got invalid data from twitter",
+                                            details=str(e))
+        if decompressor is not None:
+            rest = decompressor.flush()
+            if rest:
+                yield rest
+
+    @staticmethod
+    def _read_in_chunk(fp, size):
+        """Read up to ``size`` bytes from a chunked ``HTTPResponse``
+        without waiting for more than the rest of the HTTP chunk being
+        read, which the server has already started sending. A new chunk is
+        started with a one byte read, taking in its size line."""
+        left = fp.chunk_left
+        return fp.read(min(left, size) if left else 1)
+
+    @staticmethod
+    def _decompressor(content_encoding):
+        """Return a decompressor for a response body, or None if it isn't
+        compressed"""
+        if (content_encoding or '').lower() in ('gzip', 'x-gzip'):
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return None
+
+    def _decompress(self, decompressor, data):
+        """Decompress as much of the body as possible. Whatever has arrived
+        is returned at once; there is no waiting for a full block."""
+        try:
+            return decompressor.decompress(data)
+        except zlib.error as e:
+            self._disconnect()
+            raise ReconnectImmediatelyError("Got invalid data from twitter",
+                                            details=str(e))
+
+    def _make_framer(self):
+        return LengthFramer() if self._delimited else LineFramer()
+
+    def _frame(self, framer, chunk):
+        """Feed a chunk to the framer, returning the completed lines"""
+        keepalives = framer.keepalives
+        try:
+            lines = framer.feed(chunk)
+        except ValueError as e:
+            self._invalid_data(e)
+        now = time.time()
+        if lines and self.recorder is not None:
+            self.recorder.write(lines, now)
+        self.metrics._received(len(chunk), len(lines),
+                               framer.keepalives - keepalives, now)
+        self._update_rate(now)
+        return lines
+
+    def _invalid_data(self, error):
+        """Disconnect on data that can't be framed. Lines framed before it
+        are returned by the framer first, with the error in its ``error``
+        for the caller to pass here once they have been delivered."""
+        self._disconnect()
+        raise ReconnectImmediatelyError("Got invalid data from twitter",
+                                        details=str(error))
+
+    def _update_rate(self, now):
+        """Recalculate :attr:`rate` once every :attr:`rate_period`"""
+        if self._rate_ts is None:
+            self._rate_ts = now
+            self._rate_cnt = self.count
+        elif now - self._rate_ts >= self.rate_period and now > self._rate_ts:
+            self.rate = (self.count - self._rate_cnt) / (now - self._rate_ts)
+            self._rate_ts = now
+            self._rate_cnt = self.count
+
+    @staticmethod
+    def _check_message_type(message_type):
+        if message_type not in MESSAGE_TYPES:
+            raise ValueError('Unknown message type %r' % (message_type,))
+
+    def on(self, message_type, handler):
+        """Register ``handler`` to be called for every message of the given
+        type (see :mod:`tweetstream.messages`). Messages with a handler are
+        passed to it, decoded and parsed like any other, instead of being
+        returned by the iterator. Handlers are called in the order they were
+        registered."""
+        self._check_message_type(message_type)
+        self._handlers.setdefault(message_type, []).append(handler)
+
+    def _parse(self, line):
+        """Parse a raw line with the stream's JSON decoder"""
+        try:
+            metrics = self.metrics
+            if not metrics._timing:
+                return self._decoder(line)
+            metrics._timing = False
+            start = timer()
+            parsed = self._decoder(line)
+            metrics.parse_latency.observe(timer() - start)
+            return parsed
+        except UnicodeError:
+            raise ReconnectImmediatelyError("Could not decode as unicode")
+        except ValueError:
+            self._disconnect()
+            raise ReconnectImmediatelyError("Got invalid data from twitter", details=line)
+
+    def _parse_many(self, lines):
+        """Parse a batch of lines with a single decoder call.
+
+        Returns the parsed objects and None, or, if one of the lines is
+        invalid, the objects parsed before it and the exception to raise."""
+        if not lines:
+            return [], None
+        start = timer()
+        try:
+            parsed = self._decoder(b"[" + b",".join(lines) + b"]")
+        except ValueError:
+            parsed = None
+        # Joined fragments of broken messages could still form a valid
+        # array, but never one with the right number of items.
+        if isinstance(parsed, list) and len(parsed) == len(lines):
+            self.metrics.parse_latency.observe(
+                (timer() - start) / len(lines), len(lines))
+            return parsed, None
+
+        parsed = []
+        for line in lines:
+            try:
+                parsed.append(self._parse(line))
+            except ReconnectImmediatelyError as e:
+                return parsed, e
+        return parsed, None
+
+    def _select(self, line):
+        """Return the message type of a line, or None if the line is dropped
+        or can't pass the local filter."""
+        message_type = classify(line)
+        self.metrics.types[message_type] += 1
+        if message_type in self._drop:
+            return None
+        if message_type == TWEET:
+            if self.checkpoint is not None and not self._checkpoint(line):
+                return None
+            if self.local_filter is not None and \
+                    not self.local_filter.candidate(line):
+                return None
+        return message_type
+
+    def _checkpoint(self, line):
+        """Note a tweet in the checkpoint, returning False if it was
+        received before the last gap"""
+        checkpoint = self.checkpoint
+        overlap = self._overlap
+        if overlap is not None:
+            overlap[1] -= 1
+            if overlap[1] <= 0:
+                self._overlap = None
+            tweet_id = checkpoint.tweet_id(line)
+            if tweet_id is not None and tweet_id <= overlap[0]:
+                checkpoint.duplicates += 1
+                return False
+        checkpoint.seen(line, self.metrics.last_byte or time.time())
+        return True
+
+    def _convert(self, line, parsed=None):
+        """Turn a line into what the stream returns, reusing ``parsed`` if
+        the line has already been parsed"""
+        if self._lazy_class is not None:
+            return self._lazy_class(line)
+        elif self._parse_json:
+            tweet = self._parse(line) if parsed is None else parsed
+            if self.user_cache is not None:
+                tweet = self.user_cache(tweet)
+            if self._projection is not None:
+                tweet = self._projection(tweet)
+            return tweet
+        elif self._decode_unicode:
+            try:
+                metrics = self.metrics
+                if not metrics._timing:
+                    return line.decode('utf-8')
+                metrics._timing = False
+                start = timer()
+                text = line.decode('utf-8')
+                metrics.decode_latency.observe(timer() - start)
+                return text
+            except UnicodeError:
+                raise ReconnectImmediatelyError("Could not decode as unicode")
+        return line
+
+    def _deliver(self, message_type, tweet):
+        """Count a message and pass it to its handlers. Returns _SKIP if it
+        was handled."""
+        if message_type == TWEET:
+            self.count += 1
+        handlers = self._handlers.get(message_type)
+        if handlers:
+            for handler in handlers:
+                handler(tweet)
+            return _SKIP
+        return tweet
+
+    def _process_line(self, line):
+        """Decode and parse a single line according to the stream options.
+        Returns _SKIP for messages that are dropped or handled."""
+        message_type = self._select(line)
+        if message_type is None:
+            return _SKIP
+
+        parsed = None
+        if message_type == TWEET and self.local_filter is not None:
+            parsed = self._parse(line)
+            if not self.local_filter.matches(parsed):
+                return _SKIP
+
+        return self._deliver(message_type, self._convert(line, parsed))
+
+    def _process_batch(self, lines):
+        """Batch version of _process_line. Returns the list of messages and
+        the exception to raise after them, if any."""
+        types = []
+        selected = []
+        for line in lines:
+            message_type = self._select(line)
+            if message_type is not None:
+                types.append(message_type)
+                selected.append(line)
+
+        error = None
+        if self._parse_json and self._lazy_class is None:
+            parsed, error = self._parse_many(selected)
+        else:
+            parsed = [None] * len(selected)
+
+        tweets = []
+        for message_type, line, obj in zip(types, selected, parsed):
+            if message_type == TWEET and self.local_filter is not None:
+                if obj is None:
+                    obj = self._parse(line)
+                if not self.local_filter.matches(obj):
+                    continue
+            tweet = self._deliver(message_type, self._convert(line, obj))
+            if tweet is not _SKIP:
+                tweets.append(tweet)
+        return tweets, error
+
+    def _raw_block(self, lines):
+        """Join the lines that aren't dropped into one block of raw data"""
+        selected = []
+        for line in lines:
+            message_type = classify(line)
+            self.metrics.types[message_type] += 1
+            if message_type in self._drop:
+                continue
+            if message_type == TWEET:
+                if self.checkpoint is not None and not self._checkpoint(line):
+                    continue
+                self.count += 1
+            selected.append(line)
+        if not selected:
+            return b""
+        return b"\r\n".join(selected) + b"\r\n"
+
     def _iter_lines(self):
-        buf = b""
+        for lines in self._iter_line_groups():
+            for line in lines:
+                yield line
 
-        for chunk in self._conn.iter_content(chunk_size=1):
-            buf += chunk
+    def _iter_line_groups(self):
+        """Yield a list of the lines framed from each chunk read"""
+        framer = self._make_framer()
 
-            if buf == b"":  # something is wrong
+        for chunk in self._iter_chunks():
+            if not chunk and not framer.pending:  # something is wrong
                 self.close()
                 raise ReconnectLinearlyError("Got entry of length 0. Disconnected")
 
-            if buf.isspace():
-                buf = b""
-                continue
-            elif b"\r\n" not in buf:  # not enough data yet. Loop around
-                continue
-
-            lines = buf.splitlines()
-            if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
-                buf = lines.pop()
-            else:
-                buf = b""
+            yield self._frame(framer, chunk)
+            if framer.error is not None:
+                self._invalid_data(framer.error)
 
-            for line in lines:
-                if line:
-                    yield line
+    def _connection_error(self, e):
+        """Translate errors from reading the response into tweetstream
+        exceptions"""
+        if isinstance(e, (requests.Timeout, socket.timeout)):
+            self._timed_out()
+        elif isinstance(e, ssl.SSLError) and 'timed out' in str(e):
+            # When using https timeouts can cause a generic SSLError to be
+            # raised so we need to check the error text.
+            self._timed_out()
+        else:
+            # The response was cut short or the connection reset
+            self._disconnect()
+            raise ReconnectImmediatelyError(str(e) or e.__class__.__name__)
 
     def __iter__(self):
+        for line in self._read_lines():
+            tweet = self._process_line(line)
+            if tweet is not _SKIP:
+                yield tweet
+
+    def _read_lines(self):
+        """Connect if needed and yield raw, framed lines, raising the same
+        exceptions as iterating over the stream"""
         if not self.connected:
             self._init_conn()
         try:
             for line in self._iter_lines():
-                if self._decode_unicode:
-                    try:
-                        line = line.decode('utf-8')
-                    except UnicodeError:
-                        raise ReconnectImmediatelyError("Could not decode as unicode")
-                if self._parse_json:
-                    try:
-                        tweet = json.loads(line)
-                    except ValueError:
-                        self.close()
-                        raise ReconnectImmediatelyError("Got invalid data from twitter", details=line)
-                else:
-                    tweet = line
+                yield line
+        except _READ_ERRORS as e:
+            self._connection_error(e)
 
-                if 'text' in tweet:
-                    self.count += 1
-                yield tweet
-        except (requests.Timeout, ssl.SSLError) as e:
-            if isinstance(e, ssl.SSLError):
-                # When using https timeouts cause a generic SSLError to be raised
-                # so we need to check the error text.
-                if not 'timed out' in e.message:
-                    raise
+        raise ReconnectImmediatelyError("Server disconnected.")
+
+    def _socket(self):
+        """The socket the response is read from, if it can be found"""
+        if isinstance(self._conn, SocketResponse):
+            return self._conn.sock
+        fp = getattr(getattr(self._conn.raw, '_fp', None), 'fp', None)
+        sock = getattr(getattr(fp, 'raw', None), '_sock', None)
+        if sock is None:
+            sock = getattr(fp, '_sock', None)
+        return sock
+
+    def _wait_readable(self, timeout):
+        """Wait up to ``timeout`` seconds for data on the socket. Returns
+        False on timeout. Data already buffered in the response isn't seen,
+        so this may return False early, but never blocks for too long."""
+        sock = self._socket()
+        if sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([sock], [], [], max(timeout, 0))
+        except (ValueError, select.error):
+            return True
+        return bool(readable)
+
+    def _column_block(self, lines, columns):
+        """Columnar version of _process_batch. Returns a
+        :class:`~tweetstream.columns.ColumnBlock` of the messages, or None
+        if there are none, and the exception to raise after them."""
+        types = []
+        selected = []
+        for line in lines:
+            message_type = self._select(line)
+            if message_type is not None:
+                types.append(message_type)
+                selected.append(line)
+        parsed, error = self._parse_many(selected)
+
+        kept_types = []
+        kept = []
+        local_filter = self.local_filter
+        for message_type, obj in zip(types, parsed):
+            if message_type == TWEET and local_filter is not None and \
+                    not local_filter.matches(obj):
+                continue
+            if self._deliver(message_type, obj) is not _SKIP:
+                kept_types.append(message_type)
+                kept.append(obj)
+        block = columns.block(kept, kept_types) if kept else None
+        return block, error
+
+    def _batch(self, lines, raw, columns=None):
+        """Yield what iter_batches returns for a batch of lines, then raise
+        any error in it"""
+        if not lines:
+            return
+        if raw:
+            block = self._raw_block(lines)
+            if block:
+                yield block
+            return
+        if columns is not None:
+            tweets, error = self._column_block(lines, columns)
+        else:
+            tweets, error = self._process_batch(lines)
+        if tweets:
+            yield tweets
+        if error is not None:
+            raise error
+
+    def _columns(self, raw, columns):
+        """Check the iter_batches options, returning the
+        :class:`~tweetstream.columns.Columns` to use, if any"""
+        if columns is None:
+            return None
+        if raw or not self._parse_json:
+            raise ValueError('Columnar batches need parse_json and not raw.')
+        if not isinstance(columns, Columns):
+            columns = Columns(columns)
+        return columns
+
+    def iter_batches(self, max_items=100, max_latency=1.0, raw=False,
+                     columns=None):
+        """Iterate over lists of tweets instead of single tweets.
+
+        A batch is returned as soon as it holds ``max_items`` messages, or
+        ``max_latency`` seconds after its first message arrived, whichever
+        comes first, so quiet streams are still delivered promptly. The
+        messages of a batch are framed and parsed together, with a single
+        call to the JSON decoder.
+
+        If ``raw`` is True each batch is instead one ``bytes`` block of the
+        raw messages, each followed by ``\\r\\n``. Dropped message types
+        are left out but nothing is decoded, so handlers and the local
+        filter don't apply.
+
+        If ``columns`` is given, a list of fields as for
+        :class:`~tweetstream.columns.Columns` (or a ``Columns`` object),
+        each batch is instead a :class:`~tweetstream.columns.ColumnBlock`
+        holding those fields of its messages in arrays. The stream's
+        ``fields`` and ``lazy`` options don't apply, and messages with a
+        handler are left out.
+
+        :attr:`count` and the exceptions raised on errors and disconnects are
+        the same as when iterating over the stream directly. Messages
+        received before an error are returned before it is raised.
+        """
+        columns = self._columns(raw, columns)
+        if not self.connected:
+            self._init_conn()
+        groups = self._iter_line_groups()
+        pending = []
+        deadline = None
+        error = ReconnectImmediatelyError("Server disconnected.")
+        try:
+            while True:
+                timed_out = False
+                if pending and not self._wait_readable(deadline - time.time()):
+                    timed_out = True
                 else:
-                    raise ReconnectImmediatelyError("Stream timed out.")
-        except IncompleteRead as e:
-            raise ReconnectImmediatelyError(str(e))
+                    lines = next(groups, None)
+                    if lines is None:
+                        break
+                    if lines and not pending:
+                        deadline = time.time() + max_latency
+                    pending.extend(lines)
 
-        raise ReconnectImmediatelyError("Server disconnected.")
+                while len(pending) >= max_items or pending and (
+                        timed_out or time.time() >= deadline):
+                    batch, pending = pending[:max_items], pending[max_items:]
+                    deadline = time.time() + max_latency
+                    for block in self._batch(batch, raw, columns):
+                        yield block
+        except _READ_ERRORS as e:
+            # The messages already read are returned before the error
+            try:
+                self._connection_error(e)
+            except Exception as translated:
+                error = translated
+        except ReconnectError as e:
+            error = e
+
+        for block in self._batch(pending, raw, columns):
+            yield block
+        raise error
 
     def __next__(self):
         """Return the next available tweet. This call is blocking!"""
+        if self._iter is None:
+            self._iter = self.__iter__()
         return next(self._iter)
 
     next = __next__
@@ -224,6 +937,13 @@ class BaseStream(object):
         """
         Close the connection to the streaming server.
         """
+        self._disconnect()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.checkpoint is not None:
+            self.checkpoint.save()
+
+    def _disconnect(self):
         self.connected = False
         if self._conn:
             self._conn.close()
@@ -234,21 +954,81 @@ class SampleStream(BaseStream):
 
 
 class FilterStream(BaseStream):
+    """Stream of tweets matching one or more of ``track``, ``follow`` and
+    ``locations``. Takes the same keyword arguments as :class:`BaseStream`,
+    and also:
+
+    :keyword local_filter: Filter tweets locally, on top of what Twitter
+      sends, before they are parsed. Either a
+      :class:`~tweetstream.matching.LocalFilter`, a dict of ``track``,
+      ``follow`` and ``locations`` keyword arguments for one, or True to use
+      the stream's own parameters. Messages that aren't tweets are not
+      filtered.
+
+    The filter can be changed while the stream is running with
+    :meth:`update_filter`.
+
+    .. attribute:: local_filter
+
+        The :class:`~tweetstream.matching.LocalFilter` in use, if any. Its
+        counters show how many messages had to be parsed.
+    """
+
     url = "https://stream.twitter.com/1.1/statuses/filter.json"
 
+    #: Number of seconds after switching to a new connection in
+    #: :meth:`update_filter` during which duplicate tweets are removed.
+    dedupe_window = 60
+
+    #: Longest time in seconds the old connection is read for after the new
+    #: one starts delivering in :meth:`update_filter`, waiting for it to
+    #: send a tweet the new one has sent too. Checked as data arrives on
+    #: the old connection, keep-alives included.
+    handover_grace = 5
+
+    #: Maximum number of tweet ids remembered for removing duplicates.
+    dedupe_size = 100000
+
+    _incoming = None
+    _draining = None
+    _recent = None
+    _dedupe_until = None
+    _derived_filter = False
+
     def __init__(self, auth=None, follow=None, locations=None,
                  track=None, catchup=None, parse_json=True,
-                 decode_unicode=True, timeout=90, url=None):
-        if not track and not follow:
-            raise ValueError('Must specify at least one track or follow.')
+                 decode_unicode=True, timeout=90, url=None, delimited=None,
+                 decoder=None, drop=(), fields=None, lazy=False,
+                 local_filter=None, session=None, keepalive_interval=30,
+                 missed_keepalives=1, compression=False,
+                 transport='requests', record=None, checkpoint=None,
+                 user_cache=None):
+        if not track and not follow and not locations:
+            raise ValueError('Must specify at least one of track, follow or '
+                             'locations.')
 
         self.parameters = dict(
             track=track, follow=follow, locations=locations
         )
 
-        BaseStream.__init__(self, auth=auth, parse_json=parse_json,
+        # A filter made from the parameters is remade when they change
+        self._derived_filter = local_filter is True
+        if local_filter is True:
+            local_filter = LocalFilter(**self.parameters)
+        elif isinstance(local_filter, dict):
+            local_filter = LocalFilter(**local_filter)
+        self.local_filter = local_filter
+
+        BaseStream.__init__(self, auth=auth, session=session,
+                            catchup=catchup, parse_json=parse_json,
                             decode_unicode=decode_unicode, timeout=timeout,
-                            url=url)
+                            url=url, delimited=delimited, decoder=decoder,
+                            drop=drop, fields=fields, lazy=lazy,
+                            keepalive_interval=keepalive_interval,
+                            missed_keepalives=missed_keepalives,
+                            compression=compression, transport=transport,
+                            record=record, checkpoint=checkpoint,
+                            user_cache=user_cache)
 
     def _get_post_data(self):
         post_data = {}
@@ -256,3 +1036,276 @@ class FilterStream(BaseStream):
             if value:
                 post_data[key] = ','.join(value)
         return post_data
+
+    def update_filter(self, track=None, follow=None, locations=None):
+        """Change the filter parameters without losing tweets.
+
+        A connection with the new parameters is opened and read alongside
+        the current one. Once it delivers data, the old connection is read
+        until it sends a tweet the new one has sent too, or for at most
+        :attr:`handover_grace` seconds, at which point the stream switches
+        over to the new one and the old connection is closed. Tweets
+        arriving on both connections are only returned once. If the new
+        connection can't be opened, the exception is raised here and the
+        stream carries on unchanged.
+
+        Call this from the thread iterating over the stream (e.g. inside the
+        ``for`` loop), or while it isn't being iterated.
+        """
+        if not track and not follow and not locations:
+            raise ValueError('Must specify at least one of track, follow or '
+                             'locations.')
+        parameters = dict(track=track, follow=follow, locations=locations)
+        local_filter = self.local_filter
+        if self._derived_filter:
+            local_filter = LocalFilter(**parameters)
+        if not self.connected:
+            self.parameters = parameters
+            self.local_filter = local_filter
+            return
+
+        new = copy.copy(self)
+        new.parameters = parameters
+        # Nothing is missed while the old connection carries on
+        new._catchup_count = new.checkpoint = None
+        new._conn = None
+        new.connected = False
+        new._incoming = None
+        new._init_conn()
+        # The handover thread counts what it reads separately, and leaves
+        # recording the lines to the stream
+        new.metrics = StreamMetrics()
+        new.recorder = None
+
+        if self._incoming is not None:
+            self._incoming.cancel()
+        self.parameters = parameters
+        self.local_filter = local_filter
+        if self._recent is None:
+            self._recent = RecentIds(self.dedupe_size)
+        self._dedupe_until = None
+        self._incoming = _Handover(new)
+
+    def _tweet_id(self, line):
+        """The id of a tweet, while checking for duplicates around a filter
+        update, otherwise None"""
+        if self._recent is None:
+            return None
+        if self._dedupe_until is not None and time.time() > self._dedupe_until:
+            self._recent = self._dedupe_until = None
+            return None
+        if classify(line) != TWEET:
+            return None
+        try:
+            return self._decoder(line).get('id')
+        except (ValueError, AttributeError):
+            return None  # let normal processing deal with it
+
+    def _is_new(self, tweet_id):
+        """False for tweets already seen around a filter update"""
+        recent = self._recent
+        return tweet_id is None or recent is None or recent.add(tweet_id)
+
+    def _iter_line_groups(self):
+        framer = self._make_framer()
+        chunks = self._iter_chunks()
+        while True:
+            try:
+                for chunk in chunks:
+                    if not chunk and not framer.pending:  # something is wrong
+                        self.close()
+                        raise ReconnectLinearlyError("Got entry of length 0. Disconnected")
+
+                    # Once the new connection delivers, the old one is read
+                    # until it catches up with it, so nothing sent on it
+                    # before the switch is lost
+                    handover = self._incoming
+                    overlap = handover is not None and handover.delivering
+                    caught_up = False
+                    lines = []
+                    for line in self._frame(framer, chunk):
+                        tweet_id = self._tweet_id(line)
+                        if overlap and handover.has(tweet_id):
+                            caught_up = True
+                        if self._is_new(tweet_id):
+                            lines.append(line)
+                    yield lines
+                    if framer.error is not None:
+                        self._invalid_data(framer.error)
+                    if overlap and handover is self._incoming and (
+                            caught_up or handover.expired(self.handover_grace)):
+                        break
+                else:
+                    if self._incoming is None:
+                        return
+            except ReconnectError:
+                # Twitter may well close the old connection as soon as the
+                # new one is up.
+                if self._incoming is None:
+                    raise
+
+            handover = self._incoming
+            self._incoming = None
+            if self._conn:
+                self._conn.close()
+            self._conn = handover.stream._conn
+            self.connected = True
+            self._dedupe_until = time.time() + self.dedupe_window
+            self._draining = handover
+            try:
+                for lines in handover.drain():
+                    lines = [line for line in lines
+                             if self._is_new(self._tweet_id(line))]
+                    if lines and self.recorder is not None:
+                        self.recorder.write(lines)
+                    yield lines
+            finally:
+                self._draining = None
+            self._take_metrics(handover.stream)
+            # Carry on reading the body where the handover thread stopped,
+            # with its framing and decompression state
+            framer = handover.framer
+            chunks = handover.chunks
+
+    def _take_metrics(self, stream):
+        """Add what the handover thread counted to :attr:`metrics`, which
+        counts the rest of the new connection from now on"""
+        counted = stream.metrics
+        metrics = self.metrics
+        metrics.wire_bytes += counted.wire_bytes
+        metrics.stalls += counted.stalls
+        if counted.last_byte is not None:
+            metrics._received(counted.bytes, counted.messages,
+                              counted.keepalives, time.time())
+        stream.metrics = metrics
+
+    def _wait_readable(self, timeout):
+        # While the handover thread finishes its last read, the lines it
+        # has queued are what there is to read
+        handover = self._draining
+        if handover is not None:
+            return handover.wait(timeout)
+        return BaseStream._wait_readable(self, timeout)
+
+    def close(self):
+        if self._incoming is not None:
+            self._incoming.cancel()
+            self._incoming = None
+        BaseStream.close(self)
+
+
+class _Handover(object):
+    """Reads a newly opened connection in a background thread until the
+    stream iterator takes it over"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.framer = stream._make_framer()
+        self.chunks = stream._iter_chunks()
+        self._ids = set()
+        self._started = None
+        self._lines = deque()
+        self._cond = threading.Condition()
+        self._error = None
+        self._stop = False
+        self._done = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def delivering(self):
+        """True once the new connection has sent a message or failed"""
+        with self._cond:
+            return bool(self._lines) or self._done
+
+    def has(self, tweet_id):
+        """True if the new connection has sent the tweet with this id"""
+        with self._cond:
+            return tweet_id in self._ids
+
+    def expired(self, grace):
+        """True once the new connection has been delivering for ``grace``
+        seconds"""
+        with self._cond:
+            return self._done or (self._started is not None and
+                                  time.time() - self._started >= grace)
+
+    def _read_ids(self, lines):
+        """Ids of the tweets among lines, for spotting the overlap"""
+        decoder = self.stream._decoder
+        ids = []
+        for line in lines:
+            if classify(line) == TWEET:
+                try:
+                    ids.append(decoder(line).get('id'))
+                except (ValueError, AttributeError):
+                    pass
+        return ids
+
+    def _run(self):
+        stream = self.stream
+        try:
+            try:
+                # Returning leaves self.chunks open, for the stream to
+                # carry on with
+                for chunk in self.chunks:
+                    lines = stream._frame(self.framer, chunk)
+                    ids = self._read_ids(lines)
+                    with self._cond:
+                        if lines and self._started is None:
+                            self._started = time.time()
+                        self._lines.extend(lines)
+                        self._ids.update(ids)
+                        self._cond.notify_all()
+                        if self._stop and self.framer.error is None:
+                            return
+                    if self.framer.error is not None:
+                        stream._invalid_data(self.framer.error)
+            except _READ_ERRORS as e:
+                stream._connection_error(e)
+            raise ReconnectImmediatelyError("Server disconnected.")
+        except Exception as e:
+            self._error = e
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def wait(self, timeout):
+        """Wait up to ``timeout`` seconds for lines to take, or the thread
+        to finish. Returns False on timeout."""
+        deadline = time.time() + max(timeout, 0)
+        with self._cond:
+            while not self._lines and not self._done:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def drain(self):
+        """Tell the thread to stop, and yield lists of the lines read so far
+        at once, then of those from the read it is in the middle of, if
+        any, as they arrive. Errors in the thread are raised here."""
+        with self._cond:
+            self._stop = True
+        while True:
+            with self._cond:
+                while not self._lines and not self._done:
+                    self._cond.wait()
+                lines = list(self._lines)
+                self._lines.clear()
+                done = self._done
+            if lines:
+                yield lines
+            if done and not lines:
+                break
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def cancel(self):
+        with self._cond:
+            self._stop = True
+        self.stream.close()
@@ -0,0 +1,284 @@
+"""Minimal HTTP/1.1 plumbing for transports that don't read through requests.
+
+Requests are still built by :mod:`requests`, so authentication handlers
+(basic auth, OAuth signing etc.) work unchanged. The helpers turning a
+prepared request into bytes and picking apart the response don't do any I/O
+themselves, so the same code serves blocking and non-blocking transports.
+
+:func:`open_socket` uses them for the blocking ``transport="socket"`` of the
+stream classes, which reads the body straight from the socket into a
+preallocated buffer.
+"""
+
+import socket
+import ssl
+try:
+    from urllib.parse import urlsplit
+    from http.client import IncompleteRead
+except ImportError:
+    from urlparse import urlsplit
+    from httplib import IncompleteRead
+
+
+def _header_str(value):
+    if isinstance(value, bytes):
+        return value.decode('latin-1')
+    return value
+
+
+def serialize_request(request):
+    """Return the bytes to send on the wire for a ``PreparedRequest``"""
+    url = urlsplit(request.url)
+    target = url.path or '/'
+    if url.query:
+        target += '?' + url.query
+
+    headers = dict((_header_str(k), _header_str(v))
+                   for k, v in request.headers.items())
+    if not any(k.lower() == 'host' for k in headers):
+        headers['Host'] = url.netloc
+
+    body = request.body or b''
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    if body and not any(k.lower() == 'content-length' for k in headers):
+        headers['Content-Length'] = str(len(body))
+
+    lines = ['%s %s HTTP/1.1' % (request.method, target)]
+    lines.extend('%s: %s' % item for item in headers.items())
+    head = '\r\n'.join(lines) + '\r\n\r\n'
+    return head.encode('latin-1') + body
+
+
+def parse_response_head(head):
+    """Split a raw response head into ``(status, reason, headers)``.
+
+    Header names are lower cased. Raises :class:`ValueError` if the status
+    line can't be parsed."""
+    lines = head.decode('latin-1').split('\r\n')
+    parts = lines[0].split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+        raise ValueError('Bad status line %r' % lines[0])
+    try:
+        status = int(parts[1])
+    except ValueError:
+        raise ValueError('Bad status line %r' % lines[0])
+    reason = parts[2] if len(parts) > 2 else ''
+
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return status, reason, headers
+
+
+class ChunkedDecoder(object):
+    """Incrementally decode an HTTP ``Transfer-Encoding: chunked`` body.
+
+    :meth:`feed` takes raw bytes from the socket and returns the list of
+    body fragments they contained. :attr:`done` becomes True once the
+    terminating zero-size chunk and trailers have been consumed. Malformed
+    chunk size lines raise :class:`ValueError`. If fragments came before
+    it in the same data, they are returned and the error is kept in
+    :attr:`error`, to be raised by the next call.
+
+    Given a ``size``, :meth:`feed` reads the first ``size`` bytes of a
+    reusable buffer and returns the fragments as memoryviews of it instead
+    of copies. They are only valid until the buffer is next written to.
+    """
+
+    max_line = 4096
+
+    def __init__(self):
+        self._line = bytearray()
+        self._remaining = 0
+        self._skip = 0
+        self._trailers = False
+        self.done = False
+        self.error = None
+
+    def feed(self, data, size=None):
+        if self.error is not None:
+            raise self.error
+        out = []
+        if size is None:
+            size = len(data)
+            view = data
+        else:
+            view = memoryview(data)
+        pos = 0
+
+        while pos < size and not self.done:
+            if self._remaining:
+                take = min(self._remaining, size - pos)
+                out.append(view[pos:pos + take])
+                pos += take
+                self._remaining -= take
+                if not self._remaining:
+                    self._skip = 2  # CRLF after the chunk data
+                continue
+
+            if self._skip:
+                take = min(self._skip, size - pos)
+                pos += take
+                self._skip -= take
+                continue
+
+            end = data.find(b"\n", pos, size)
+            if end < 0:
+                self._line += data[pos:size]
+                if len(self._line) > self.max_line:
+                    return self._fail(out, "Chunk size line too long")
+                break
+            self._line += data[pos:end]
+            line = bytes(self._line).strip()
+            del self._line[:]
+            pos = end + 1
+
+            if self._trailers:
+                if not line:
+                    self.done = True
+                continue
+
+            try:
+                length = int(line.split(b";", 1)[0], 16)
+            except ValueError:
+                return self._fail(out, "Bad chunk size line %r" % line)
+            if length:
+                self._remaining = length
+            else:
+                self._trailers = True
+
+        return out
+
+    def _fail(self, out, message):
+        self.error = ValueError(message)
+        if not out:
+            raise self.error
+        return out
+
+
+def _read_head(sock, max_size=65536):
+    """Read a response head, returning it and any body bytes after it"""
+    data = bytearray()
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ValueError('Connection closed before the response head')
+        data += chunk
+        end = data.find(b"\r\n\r\n")
+        if end >= 0:
+            return bytes(data[:end + 4]), bytes(data[end + 4:])
+        if len(data) > max_size:
+            raise ValueError('Response head too long')
+
+
+def open_socket(request, timeout=None):
+    """Send a ``PreparedRequest`` over a new socket and read the response
+    head, returning a :class:`SocketResponse`.
+
+    :param timeout: Seconds, or a ``(connect, read)`` tuple as for
+      :mod:`requests`.
+
+    Connection failures raise :class:`socket.error` (:class:`OSError`) or
+    :class:`ssl.SSLError`, and malformed responses :class:`ValueError`.
+    """
+    if isinstance(timeout, tuple):
+        connect_timeout, read_timeout = timeout
+    else:
+        connect_timeout = read_timeout = timeout
+    url = urlsplit(request.url)
+    https = url.scheme == 'https'
+    port = url.port or (443 if https else 80)
+
+    sock = socket.create_connection((url.hostname, port), connect_timeout)
+    try:
+        if https:
+            context = ssl.create_default_context()
+            sock = context.wrap_socket(sock, server_hostname=url.hostname)
+        sock.settimeout(read_timeout)
+        sock.sendall(serialize_request(request))
+        head, rest = _read_head(sock)
+        status, reason, headers = parse_response_head(head)
+    except Exception:
+        sock.close()
+        raise
+    return SocketResponse(sock, status, reason, headers, rest)
+
+
+class SocketResponse(object):
+    """The response to a request sent by :func:`open_socket`.
+
+    .. attribute:: status
+
+        The HTTP status code.
+
+    .. attribute:: headers
+
+        Dict of the response headers, with lower case names.
+    """
+
+    def __init__(self, sock, status, reason, headers, rest=b''):
+        self.sock = sock
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._rest = rest
+        self._chunked = headers.get('transfer-encoding', '').lower() == 'chunked'
+        length = headers.get('content-length')
+        self._length = int(length) if length and not self._chunked else None
+
+    def iter_body(self, buffer_size=65536):
+        """Yield the body as it arrives, decoding chunked encoding.
+
+        Each read from the socket goes into the same preallocated buffer and
+        the fragments yielded are memoryviews of it, so they must be used
+        (or copied) before asking for the next one. A body cut short raises
+        :class:`IncompleteRead`.
+        """
+        buf = bytearray(buffer_size)
+        view = memoryview(buf)
+        recv_into = self.sock.recv_into
+        decoder = ChunkedDecoder() if self._chunked else None
+        remaining = self._length
+        if remaining == 0:
+            return
+
+        # Body bytes that came in with the head are used where they are
+        data = self._rest
+        self._rest = b''
+        while True:
+            if data:
+                size = len(data)
+            else:
+                data = buf
+                size = recv_into(buf)
+                if not size:
+                    if (decoder is not None and not decoder.done) or remaining:
+                        raise IncompleteRead(b'')
+                    return
+
+            if decoder is not None:
+                for piece in decoder.feed(data, size):
+                    yield piece
+                if decoder.error is not None:
+                    raise decoder.error
+                if decoder.done:
+                    return
+            else:
+                if remaining is not None:
+                    size = min(size, remaining)
+                    remaining -= size
+                yield view[:size] if data is buf else memoryview(data)[:size]
+                if remaining == 0:
+                    return
+            data = None
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+            pass
+        self.sock.close()
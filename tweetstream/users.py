@@ -0,0 +1,200 @@
+"""Sharing repeated user objects between tweets.
+
+Every tweet carries a full ``user`` object, and active accounts come up
+again and again, so a window of tweets held in memory holds many identical
+copies of the same users. A :class:`UserCache` keeps the latest user object
+of the most recently seen accounts, by ``user.id``. Every tweet from an
+account gets the cached object instead of its own copy, which is freed at
+once. Counts such as ``statuses_count`` change with almost every tweet, so
+fields that have changed are updated in the cached object, and all the
+tweets sharing it see the user as last seen. Repeated strings such as
+``lang`` and ``source`` are interned, so tweets share one copy of each::
+
+    stream = SampleStream(auth=auth, user_cache=True)
+    for tweet in stream:
+        window.append(tweet)
+    print(stream.metrics.snapshot()['users'])
+
+See the ``user_cache`` argument of
+:class:`~tweetstream.streamclasses.BaseStream`. Tweets with the same user
+share one dict, so copy it before changing it.
+"""
+
+import sys
+from collections import deque
+
+try:
+    string_types = basestring
+except NameError:  # Python 3
+    string_types = (str, bytes)
+
+#: Fields whose string values are interned, in tweets and user objects.
+INTERNED_FIELDS = ('lang', 'source', 'time_zone', 'filter_level')
+
+#: Fields holding tweets embedded in a tweet, whose users are shared too.
+NESTED_TWEETS = ('retweeted_status', 'quoted_status')
+
+
+def estimate_size(obj):
+    """Rough number of bytes taken by a parsed JSON value, counting the
+    containers and the values in them but not dict keys, which decoders
+    usually share between messages"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for value in obj.values():
+            size += estimate_size(value)
+    elif isinstance(obj, list):
+        for value in obj:
+            size += estimate_size(value)
+    return size
+
+
+class UserCache(object):
+    """LRU cache of user objects shared between parsed tweets.
+
+    :keyword maxsize: Number of users kept. The least recently seen are
+      forgotten first.
+    :keyword strings: Fields whose string values are interned, see
+      :data:`INTERNED_FIELDS`.
+    :keyword max_strings: Number of distinct strings interned before the
+      table is cleared and started over.
+
+    Call it with a parsed message to share the user objects in it. Other
+    messages are returned as they are.
+
+    .. attribute:: hits
+
+        Number of users replaced by an unchanged cached copy.
+
+    .. attribute:: misses
+
+        Number of users not in the cache, which were added to it.
+
+    .. attribute:: updates
+
+        Number of users replaced by a cached copy after updating the fields
+        that had changed in it.
+
+    .. attribute:: bytes_saved
+
+        Estimated number of bytes freed by sharing users and strings.
+    """
+
+    def __init__(self, maxsize=10000, strings=INTERNED_FIELDS,
+                 max_strings=100000):
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        self.maxsize = maxsize
+        self.strings = tuple(strings)
+        self.max_strings = max_strings
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+        self.bytes_saved = 0
+        self._users = {}  # user id -> [user, estimated size, last seen]
+        # (last seen, user id) for every time a user was seen, oldest
+        # first. Entries for users seen again since are skipped.
+        self._order = deque()
+        self._clock = 0
+        self._table = {}
+
+    def __len__(self):
+        return len(self._users)
+
+    @property
+    def hit_rate(self):
+        """Fraction of users found in the cache, or None"""
+        total = self.hits + self.misses + self.updates
+        return (self.hits + self.updates) / float(total) if total else None
+
+    def __call__(self, message):
+        if not isinstance(message, dict):
+            return message
+        user = message.get('user')
+        if not isinstance(user, dict):
+            return message
+        message['user'] = self._share(user)
+        self._intern(message)
+        for key in NESTED_TWEETS:
+            nested = message.get(key)
+            if nested is not None:
+                self(nested)
+        return message
+
+    def _share(self, user):
+        """Return the cached copy of ``user``, brought up to date, or cache
+        ``user`` if there is none"""
+        user_id = user.get('id')
+        if user_id is None:
+            return user
+        users = self._users
+        self._clock += 1
+        self._order.append((self._clock, user_id))
+        entry = users.get(user_id)
+        if entry is None:
+            self.misses += 1
+            self._intern(user)
+            users[user_id] = [user, estimate_size(user), self._clock]
+            if len(users) > self.maxsize:
+                self._evict()
+            return user
+
+        entry[2] = self._clock
+        if len(self._order) > 2 * self.maxsize:
+            self._compact()
+        cached, size = entry[0], entry[1]
+        if cached == user:
+            self.hits += 1
+        else:
+            self.updates += 1
+            for key in [key for key in cached if key not in user]:
+                del cached[key]
+            cached.update(user)
+            self._intern(cached)
+        self.bytes_saved += size
+        return cached
+
+    def _evict(self):
+        """Forget the least recently seen users until there are maxsize"""
+        users = self._users
+        order = self._order
+        while len(users) > self.maxsize:
+            seen, user_id = order.popleft()
+            entry = users.get(user_id)
+            if entry is not None and entry[2] == seen:
+                del users[user_id]
+
+    def _compact(self):
+        """Drop the skipped entries from the order, keeping it no longer
+        than twice the cache"""
+        users = self._users
+        self._order = deque(
+            (seen, user_id) for seen, user_id in self._order
+            if user_id in users and users[user_id][2] == seen)
+
+    def _intern(self, obj):
+        table = self._table
+        for key in self.strings:
+            value = obj.get(key)
+            if not isinstance(value, string_types):
+                continue
+            shared = table.get(value)
+            if shared is None:
+                if len(table) >= self.max_strings:
+                    table.clear()
+                table[value] = value
+            elif shared is not value:
+                obj[key] = shared
+                self.bytes_saved += sys.getsizeof(value)
+
+    def snapshot(self):
+        """Return the cache statistics as a dict of plain values"""
+        return dict(
+            size=len(self._users),
+            strings=len(self._table),
+            hits=self.hits,
+            misses=self.misses,
+            updates=self.updates,
+            hit_rate=self.hit_rate,
+            bytes_saved=self.bytes_saved,
+        )